@@ -1,4 +1,5 @@
 import laion_clap
+from laion_clap.clap_module import topk_search
 import glob
 import json
 import torch
@@ -30,9 +31,7 @@ with torch.no_grad():
     text_embed = model.get_text_embedding(all_texts)
     audio_embed = model.get_audio_embedding_from_filelist(x=audio_files)
 
-    ranking = torch.argsort(torch.tensor(audio_embed) @ torch.tensor(text_embed).t(), descending=True)
-    preds = torch.where(ranking == ground_truth)[1]
-    preds = preds.cpu().numpy()
+    preds = topk_search(audio_embed, text_embed, k=0, targets=ground_truth.view(-1)).ranks.numpy()
 
     metrics = {}
     metrics[f"mean_rank"] = preds.mean() + 1
@@ -2,4 +2,8 @@ import os
 import sys
 dir_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(dir_path)
-from .hook import CLAP_Module
\ No newline at end of file
+from .hook import CLAP_Module
+from .inference_pool import CLAPInferencePool
+from .index import IVFPQIndex
+from .store import EmbeddingStore
+from .filters import FilterIndex
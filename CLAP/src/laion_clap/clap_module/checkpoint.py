@@ -0,0 +1,119 @@
+""" Inference checkpoints in the safetensors format
+
+Training checkpoints hold the optimizer state next to the weights and are unpickled in full by torch.load.
+convert_checkpoint strips them down to the model weights in a safetensors file, which load_mmap_state_dict
+maps into memory without reading it: every tensor is a view of the file pages, read on first access.
+Processes that map the same file share those pages through the page cache.
+
+Example:
+    python -m clap_module.checkpoint --input 630k-audioset-best.pt --output 630k-audioset-best.safetensors
+"""
+import argparse
+import json
+import logging
+import mmap
+import struct
+
+import torch
+from torch import nn
+
+try:
+    from safetensors.torch import save_file
+except ImportError:
+    save_file = None
+
+# safetensors dtype names
+_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def convert_checkpoint(checkpoint_path, output_path, modalities=None):
+    """Write the model weights of a training checkpoint (without optimizer state) to a safetensors file."""
+    if save_file is None:
+        raise ImportError("safetensors is required to write safetensors checkpoints, `pip install laion_clap[safetensors]`.")
+    # imported here, factory imports this module
+    from .factory import load_state_dict
+    state_dict = load_state_dict(checkpoint_path, skip_params=True, modalities=modalities)
+    tensors = {}
+    seen_storages = set()
+    for k, v in state_dict.items():
+        # safetensors refuses tensors sharing storage (e.g. tied embeddings), store each on its own
+        ptr = v.untyped_storage().data_ptr()
+        tensors[k] = v.contiguous().clone() if ptr in seen_storages else v.contiguous()
+        seen_storages.add(ptr)
+    save_file(tensors, output_path, metadata={"format": "pt"})
+    logging.info(f"Wrote {len(tensors)} tensors from {checkpoint_path} to {output_path}")
+
+
+def load_mmap_state_dict(path):
+    """
+    State dict of a safetensors file whose tensors are views of a private (copy-on-write) memory map of it.
+    Nothing is read until a tensor is accessed, and unmodified pages stay shared with other processes.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    state_dict = {}
+    for name, info in header.items():
+        dtype = _DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        numel = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        if numel == 0:
+            tensor = torch.empty(info["shape"], dtype=dtype)
+        else:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=data_start + begin)
+        state_dict[name] = tensor.view(info["shape"])
+    return state_dict
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Make the parameters and buffers of `model` the tensors of `state_dict` instead of copying them, so a model
+    loaded from load_mmap_state_dict keeps its weights in the shared page cache. For inference only:
+    the parameters do not require grad.
+    """
+    modules = dict(model.named_modules())
+    expected = model.state_dict().keys()
+    missing = [k for k in expected if k not in state_dict]
+    unexpected = [k for k in state_dict if k not in expected]
+    if missing or unexpected:
+        raise RuntimeError(f"State dict does not match the model, missing {missing}, unexpected {unexpected}.")
+    for key, tensor in state_dict.items():
+        module_name, _, attr = key.rpartition(".")
+        module = modules[module_name]
+        if attr in module._parameters:
+            if module._parameters[attr].shape != tensor.shape:
+                raise RuntimeError(f"Shape mismatch for {key}: {tuple(module._parameters[attr].shape)} in the model, "
+                                   f"{tuple(tensor.shape)} in the state dict.")
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        elif attr in module._buffers:
+            module._buffers[attr] = tensor
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a CLAP training checkpoint to a safetensors inference checkpoint.")
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--modalities", type=str, nargs="+", default=None, choices=["audio", "text"],
+                        help="Only keep the weights of these branches.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    convert_checkpoint(args.input, args.output, set(args.modalities) if args.modalities else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+""" Export of the CLAP audio embedding pipeline
+
+Traces the whole path from a batch of raw waveforms at the model sample rate (48 kHz) to the normalized
+joint embedding: Spectrogram, LogmelFilterBank, bn0, the audio encoder (HTSAT or PANN) and audio_projection,
+to TorchScript and ONNX graphs with a dynamic batch dimension.
+
+Example:
+    python -m clap_module.export --amodel HTSAT-tiny --ckpt 630k-audioset-best.pt --output exports/htsat_tiny
+"""
+import argparse
+import logging
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from .factory import create_model, load_state_dict
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class AudioEmbeddingPipeline(nn.Module):
+    """
+    Waveforms (B, clip_samples) to normalized audio embeddings (B, D), the same computation as
+    CLAP.get_audio_embedding on inputs prepared by get_audio_features with rand_trunc.
+    Cropping or padding clips to clip_samples (and the int16 quantization of CLAP_Module) stays with the caller.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        if model.enable_fusion:
+            raise NotImplementedError("Export of fusion models is not supported, their input is not a plain waveform.")
+        self.audio_cfg = model.audio_cfg
+        self.audio_branch = model.audio_branch
+        self.audio_projection = model.audio_projection
+
+    def forward(self, waveform):
+        audio_input = {"waveform": waveform}
+        if self.audio_cfg.model_type == "HTSAT":
+            audio_embeds = self.audio_branch(audio_input, mixup_lambda=None, outputs=("embedding",))["embedding"]
+        else:
+            audio_embeds = self.audio_branch(audio_input, mixup_lambda=None)["embedding"]
+        audio_embeds = self.audio_projection(audio_embeds)
+        return F.normalize(audio_embeds, dim=-1)
+
+
+def export_audio_embedding(model, output, formats=("torchscript", "onnx"), batch_size=2, opset_version=17):
+    """
+    Export the audio embedding pipeline of `model` to `output`.pt (TorchScript) and/or `output`.onnx.
+    The graphs are traced with a batch of `batch_size` clips, the batch dimension stays dynamic and is checked
+    against the model with a batch of `batch_size` + 1 clips (ONNX only when onnxruntime is installed).
+    Returns the written paths by format.
+    """
+    pipeline = AudioEmbeddingPipeline(model).eval()
+    example = torch.randn(batch_size, model.audio_cfg.clip_samples, device=next(model.parameters()).device)
+    paths = {}
+    with torch.no_grad():
+        if "torchscript" in formats:
+            paths["torchscript"] = output + ".pt"
+            traced = torch.jit.trace(pipeline, example, check_trace=False)
+            torch.jit.save(traced, paths["torchscript"])
+        if "onnx" in formats:
+            paths["onnx"] = output + ".onnx"
+            torch.onnx.export(
+                pipeline,
+                example,
+                paths["onnx"],
+                input_names=["waveform"],
+                output_names=["embedding"],
+                dynamic_axes={"waveform": {0: "batch"}, "embedding": {0: "batch"}},
+                opset_version=opset_version,
+            )
+        # a size captured as a constant during tracing shows up as wrong embeddings at another batch size
+        check = torch.randn(batch_size + 1, model.audio_cfg.clip_samples, device=example.device)
+        expected = pipeline(check).cpu()
+        for fmt, path in paths.items():
+            if fmt == "onnx" and onnxruntime is None:
+                continue
+            exported = load_exported(path)(check.cpu()).cpu()
+            if exported.shape != expected.shape or not torch.allclose(exported, expected, rtol=1e-3, atol=1e-4):
+                raise RuntimeError(f"The {fmt} export at {path} does not match the model at batch size {batch_size + 1}.")
+    for fmt, path in paths.items():
+        logging.info(f"Exported {fmt} audio embedding pipeline to {path}")
+    return paths
+
+
+def load_exported(path):
+    """A callable from a float32 (B, clip_samples) tensor to the embeddings, for a .pt or .onnx export."""
+    if path.endswith(".onnx"):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required to run ONNX exports, `pip install laion_clap[export]`.")
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        return lambda waveform: torch.from_numpy(session.run(None, {"waveform": waveform.cpu().numpy()})[0])
+    traced = torch.jit.load(path, map_location="cpu")
+    return lambda waveform: traced(waveform)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the CLAP audio embedding pipeline.")
+    parser.add_argument("--amodel", type=str, default="HTSAT-tiny", help="Audio encoder, an HTSAT or PANN config.")
+    parser.add_argument("--tmodel", type=str, default="roberta")
+    parser.add_argument("--ckpt", type=str, default=None, help="Checkpoint to export, random weights if not set.")
+    parser.add_argument("--output", type=str, required=True, help="Output path without extension.")
+    parser.add_argument("--formats", type=str, nargs="+", default=["torchscript", "onnx"],
+                        choices=["torchscript", "onnx"])
+    parser.add_argument("--batch-size", type=int, default=2, help="Batch size of the example used for tracing.")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    model, _ = create_model(args.amodel, args.tmodel, precision="fp32", device=torch.device("cpu"))
+    if args.ckpt is not None:
+        model.load_state_dict(load_state_dict(args.ckpt, skip_params=True))
+    export_audio_embedding(model.eval(), args.output, args.formats, args.batch_size, args.opset)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
+import inspect
 import json
 import logging
 import os
 import pathlib
 import re
+import zipfile
 from copy import deepcopy
 from pathlib import Path
 
 import torch
 
-from .model import CLAP, convert_weights_to_fp16
+from .model import CLAP, convert_weights_to_fp16, MODALITY_PREFIXES
+from .checkpoint import load_mmap_state_dict
 from .openai import load_openai_model
 from .pretrained import get_pretrained_url, download_pretrained
 from .transform import image_transform
@@ -47,9 +50,28 @@ def _rescan_model_configs():
 
 _rescan_model_configs()  # initial populate of model config registry
 
+# torch >= 2.1 can memory-map a checkpoint, so the tensors filtered out by modality are never read
+_TORCH_LOAD_MMAP = "mmap" in inspect.signature(torch.load).parameters
 
-def load_state_dict(checkpoint_path: str, map_location="cpu", skip_params=True):
-    checkpoint = torch.load(checkpoint_path, map_location=map_location)
+
+def filter_state_dict(state_dict, modalities):
+    """Drop the tensors of the branches not in `modalities`, as for a CLAP(modalities=...) model."""
+    skipped = tuple(prefix for m, prefixes in MODALITY_PREFIXES.items() if m not in modalities for prefix in prefixes)
+    return {k: v for k, v in state_dict.items() if not k.startswith(skipped)}
+
+
+def load_state_dict(checkpoint_path: str, map_location="cpu", skip_params=True, modalities=None):
+    if checkpoint_path.endswith(".safetensors"):
+        # inference checkpoint from clap_module.checkpoint, memory-mapped and read when copied into the model
+        state_dict = load_mmap_state_dict(checkpoint_path)
+        return filter_state_dict(state_dict, modalities) if modalities is not None else state_dict
+    if modalities is not None and _TORCH_LOAD_MMAP and zipfile.is_zipfile(checkpoint_path):
+        # only the kept branch is paged in, when load_state_dict copies it into the model
+        checkpoint = torch.load(checkpoint_path, map_location=map_location, mmap=True)
+    else:
+        # torch < 2.1 or a checkpoint in the legacy (non-zip) format is read whole,
+        # convert_checkpoint it to .safetensors to get the same memory saving
+        checkpoint = torch.load(checkpoint_path, map_location=map_location)
     if isinstance(checkpoint, dict) and "state_dict" in checkpoint:
         state_dict = checkpoint["state_dict"]
     else:
@@ -57,6 +79,10 @@ def load_state_dict(checkpoint_path: str, map_location="cpu", skip_params=True):
     if skip_params:
         if next(iter(state_dict.items()))[0].startswith("module"):
             state_dict = {k[7:]: v for k, v in state_dict.items()}
+    if modalities is not None:
+        # release the skipped branch right away instead of holding the whole checkpoint
+        state_dict = filter_state_dict(state_dict, modalities)
+        del checkpoint
     # for k in state_dict:
     #     if k.startswith('transformer'):
     #         v = state_dict.pop(k)
@@ -77,14 +103,21 @@ def create_model(
     pretrained_audio: str = "",
     pretrained_text: str = "",
     enable_fusion: bool = False,
-    fusion_type: str = 'None'
+    fusion_type: str = 'None',
+    modalities=None,
     # pretrained_image: bool = False,
 ):
+    """
+    modalities: build only these branches, e.g. {"audio"} for audio embedding services or {"text"} for
+        label banks. Pretrained weights of the other branches are not loaded. Default: both.
+    """
     amodel_name = amodel_name.replace(
         "/", "-"
     )  # for callers using old naming with / in ViT names
     pretrained_orig = pretrained
     pretrained = pretrained.lower()
+    if pretrained == "openai" and modalities is not None:
+        raise NotImplementedError("modalities is not supported with the OpenAI pretrained model.")
     if pretrained == "openai":
         if amodel_name in _MODEL_CONFIGS:
             logging.info(f"Loading {amodel_name} model config.")
@@ -133,7 +166,10 @@ def create_model(
         model_cfg["text_cfg"]["model_type"] = tmodel_name
         model_cfg["enable_fusion"] = enable_fusion
         model_cfg["fusion_type"] = fusion_type
-        model = CLAP(**model_cfg)
+        if modalities is not None:
+            model = CLAP(**model_cfg, modalities=modalities)
+        else:
+            model = CLAP(**model_cfg)
 
         if pretrained:
             checkpoint_path = ""
@@ -144,7 +180,7 @@ def create_model(
                 checkpoint_path = pretrained_orig
             if checkpoint_path:
                 logging.info(f"Loading pretrained {amodel_name}-{tmodel_name} weights ({pretrained}).")
-                ckpt = load_state_dict(checkpoint_path, skip_params=True)
+                ckpt = load_state_dict(checkpoint_path, skip_params=True, modalities=modalities)
                 model.load_state_dict(ckpt)
                 param_names = [n for n, p in model.named_parameters()]
                 for n in param_names:
@@ -249,6 +285,13 @@ def list_models():
     return list(_MODEL_CONFIGS.keys())
 
 
+def get_model_config(model_name):
+    """return a copy of the config of a model architecture, or None if it is unknown"""
+    if model_name in _MODEL_CONFIGS:
+        return deepcopy(_MODEL_CONFIGS[model_name])
+    return None
+
+
 def add_model_config(path):
     """add model config path or file and update registry"""
     if not isinstance(path, Path):
@@ -270,12 +270,59 @@ def window_reverse(windows, window_size, H, W):
     Returns:
         x: (B, H, W, C)
     """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
+    # B is left to view (no int() of the shape), so traced and exported graphs keep a dynamic batch size
+    C = windows.shape[-1]
+    x = windows.view(-1, H // window_size, W // window_size, window_size, window_size, C)
+    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, H, W, C)
     return x
 
 
+def bicubic_weights(in_size, out_size, A=-0.75):
+    """
+    Dense (out_size, in_size) float64 matrix of 1D bicubic interpolation with align_corners=True,
+    with the same kernel and border clamping as F.interpolate(mode="bicubic").
+    """
+    weights = torch.zeros(out_size, in_size, dtype=torch.float64)
+    scale = (in_size - 1) / (out_size - 1) if out_size > 1 else 0.
+    for i in range(out_size):
+        src = i * scale
+        i0 = math.floor(src)
+        t = src - i0
+        coeffs = [
+            ((A * (t + 1) - 5 * A) * (t + 1) + 8 * A) * (t + 1) - 4 * A,
+            ((A + 2) * t - (A + 3)) * t * t + 1,
+            ((A + 2) * (1 - t) - (A + 3)) * (1 - t) * (1 - t) + 1,
+            ((A * (2 - t) - 5 * A) * (2 - t) + 8 * A) * (2 - t) - 4 * A,
+        ]
+        for k, w in enumerate(coeffs):
+            weights[i, min(max(i0 - 1 + k, 0), in_size - 1)] += w
+    return weights
+
+
+def bicubic_fold_operands(T, F, target_T, fold):
+    """
+    Precompute the gather indices and banded weights that resize (B, C, T, F) to (B, C, target_T, F) with
+    bicubic interpolation along T and fold the result into (B, C, fold * F, target_T // fold).
+    Every fold block only reads a window of `band` consecutive input frames, so the resize is a
+    (fold, F, band) x (fold, band, target_T // fold) matmul of the gathered windows.
+    Returns:
+        frame_index: (fold, 1, band) input frames read by each fold block
+        freq_index: (1, F, 1)
+        band_weights: (fold, band, target_T // fold), or None if T == target_T (pure fold)
+    """
+    block = target_T // fold
+    weights = bicubic_weights(T, target_T).view(fold, block, T)
+    cols = [torch.nonzero(weights[r].abs().sum(0)).flatten() for r in range(fold)]
+    band = max(int(c[-1] - c[0]) + 1 for c in cols)
+    starts = [min(int(c[0]), T - band) for c in cols]
+    band_weights = torch.stack([weights[r, :, s:s + band].t() for r, s in enumerate(starts)])
+    frame_index = torch.tensor(starts)[:, None, None] + torch.arange(band)[None, None, :]
+    freq_index = torch.arange(F)[None, :, None]
+    if T == target_T:
+        band_weights = None
+    return frame_index, freq_index, band_weights
+
+
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -322,23 +369,65 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        # use F.scaled_dot_product_attention when the attention map is not requested
+        self.fused_attn = hasattr(F, "scaled_dot_product_attention")
+        self._bias_cache = None
 
-    def forward(self, x, mask=None):
+    def get_relative_position_bias(self):
+        """
+        Gather the relative position bias of every token pair in a window, (nH, Wh*Ww, Wh*Ww).
+        In eval mode without autograd the result is cached until the bias table is modified
+        (e.g. by load_state_dict).
+        """
+        table = self.relative_position_bias_table
+        cacheable = not self.training and not torch.is_grad_enabled()
+        # the table version changes on in-place updates, its data pointer when the module is moved or cast
+        cache_key = (table._version, table.data_ptr())
+        if cacheable and self._bias_cache is not None and self._bias_cache[0] == cache_key:
+            return self._bias_cache[1]
+        relative_position_bias = table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        self._bias_cache = (cache_key, relative_position_bias) if cacheable else None
+        return relative_position_bias
+
+    def forward(self, x, mask=None, return_attn=False):
         """
         Args:
             x: input features with shape of (num_windows*B, N, C)
             mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+            return_attn: also return the attention map, otherwise None is returned in its place
         """
         B_, N, C = x.shape
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
+        relative_position_bias = self.get_relative_position_bias()
+
+        # torch < 2.1 has no ONNX symbolic for scaled_dot_product_attention, ONNX export takes the explicit path
+        if self.fused_attn and not return_attn and not torch.onnx.is_in_onnx_export():
+            # the bias and the shift mask are added to the attention logits as one additive mask.
+            # The mask of a window is the same for every clip of the batch, so the windows are folded into the
+            # head dimension: q, k, v stay 4-D (B, nW*nH, N, d) and the (1, nW*nH, N, N) mask is broadcast
+            # over the batch instead of being copied B times
+            if mask is not None:
+                nW = mask.shape[0]
+                attn_mask = (relative_position_bias.unsqueeze(0) + mask.unsqueeze(1)).view(1, nW * self.num_heads, N, N)
+                q, k, v = [t.reshape(B_ // nW, nW * self.num_heads, N, -1) for t in (q, k, v)]
+            else:
+                attn_mask = relative_position_bias.unsqueeze(0)
+            # scaled_dot_product_attention scales by head_dim ** -0.5, rescale q for a custom qk_scale
+            q = q * (self.scale * math.sqrt(C // self.num_heads))
+            x = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=attn_mask.to(q.dtype), dropout_p=self.attn_drop.p if self.training else 0.
+            )
+            x = x.reshape(B_, self.num_heads, N, -1).transpose(1, 2).reshape(B_, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x, None
 
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -354,7 +443,7 @@ class WindowAttention(nn.Module):
         x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
-        return x, attn
+        return x, attn if return_attn else None
 
     def extra_repr(self):
         return f'dim={self.dim}, window_size={self.window_size}, num_heads={self.num_heads}'
@@ -436,7 +525,7 @@ class SwinTransformerBlock(nn.Module):
 
         self.register_buffer("attn_mask", attn_mask)
 
-    def forward(self, x):
+    def forward(self, x, return_attn=False):
         # pdb.set_trace()
         H, W = self.input_resolution
         # print("H: ", H)
@@ -460,7 +549,7 @@ class SwinTransformerBlock(nn.Module):
         x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA
-        attn_windows, attn = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+        attn_windows, attn = self.attn(x_windows, mask=self.attn_mask, return_attn=return_attn)  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
@@ -575,18 +664,20 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x):
+    def forward(self, x, return_attn=False):
+        # the attention map averaged over the blocks is only computed if return_attn, None otherwise
         attns = []
+        attn = None
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x, _ = checkpoint.checkpoint(blk, x)
             else:
-                x, attn = blk(x)
-                if not self.training:
-                    attns.append(attn.unsqueeze(0))
+                x, blk_attn = blk(x, return_attn=return_attn)
+                if return_attn:
+                    attns.append(blk_attn.unsqueeze(0))
         if self.downsample is not None:
             x = self.downsample(x)
-        if not self.training:
+        if attns:
             attn = torch.cat(attns, dim = 0)
             attn = torch.mean(attn, dim = 0)
         return x, attn
@@ -665,6 +756,7 @@ class HTSAT_Swin_Transformer(nn.Module):
 
         #  process mel-spec ; used only once
         self.freq_ratio = self.spec_size // self.config.mel_bins
+        self._wav2img_cache = {}
         window = 'hann'
         center = True
         pad_mode = 'reflect'
@@ -771,8 +863,12 @@ class HTSAT_Swin_Transformer(nn.Module):
         return {'relative_position_bias_table'}
 
 
-    def forward_features(self, x, longer_idx = None):
+    def forward_features(self, x, longer_idx = None, outputs = None):
         # A deprecated optimization for using a hierarchical output from different blocks
+        # outputs: the keys of the output dict to compute, all of them if None.
+        # CLAP only needs 'embedding', which skips the tscam head and the framewise interpolations.
+        if outputs is None:
+            outputs = ('framewise_output', 'clipwise_output', 'fine_grained_embedding', 'embedding')
 
         frames_num = x.shape[2]        
         x = self.patch_embed(x, longer_idx = longer_idx)
@@ -792,29 +888,32 @@ class HTSAT_Swin_Transformer(nn.Module):
         c_freq_bin = F // self.freq_ratio
         x = x.reshape(B, C, F // c_freq_bin, c_freq_bin, T)
         x = x.permute(0,1,3,2,4).contiguous().reshape(B, C, c_freq_bin, -1)
+        output_dict = {}
         # get latent_output
-        fine_grained_latent_output = torch.mean(x, dim = 2)
-        fine_grained_latent_output = interpolate(fine_grained_latent_output.permute(0,2,1).contiguous(), 8 * self.patch_stride[1]) 
-        
-        latent_output = self.avgpool(torch.flatten(x,2))
-        latent_output = torch.flatten(latent_output, 1)
+        if 'fine_grained_embedding' in outputs:
+            fine_grained_latent_output = torch.mean(x, dim = 2)
+            fine_grained_latent_output = interpolate(fine_grained_latent_output.permute(0,2,1).contiguous(), 8 * self.patch_stride[1]) 
+            output_dict['fine_grained_embedding'] = fine_grained_latent_output
+
+        if 'embedding' in outputs:
+            latent_output = self.avgpool(torch.flatten(x,2))
+            latent_output = torch.flatten(latent_output, 1)
+            output_dict['embedding'] = latent_output
 
         # display the attention map, if needed
 
-        x = self.tscam_conv(x)
-        x = torch.flatten(x, 2) # B, C, T
- 
-        fpx = interpolate(torch.sigmoid(x).permute(0,2,1).contiguous(), 8 * self.patch_stride[1]) 
-            
-        x = self.avgpool(x)
-        x = torch.flatten(x, 1)
+        if 'framewise_output' in outputs or 'clipwise_output' in outputs:
+            x = self.tscam_conv(x)
+            x = torch.flatten(x, 2) # B, C, T
+
+            if 'framewise_output' in outputs:
+                fpx = interpolate(torch.sigmoid(x).permute(0,2,1).contiguous(), 8 * self.patch_stride[1]) 
+                output_dict['framewise_output'] = fpx # already sigmoided
 
-        output_dict = {
-            'framewise_output': fpx, # already sigmoided
-            'clipwise_output': torch.sigmoid(x),
-            'fine_grained_embedding': fine_grained_latent_output,
-            'embedding': latent_output
-        }
+            if 'clipwise_output' in outputs:
+                x = self.avgpool(x)
+                x = torch.flatten(x, 1)
+                output_dict['clipwise_output'] = torch.sigmoid(x)
 
         return output_dict
 
@@ -835,16 +934,29 @@ class HTSAT_Swin_Transformer(nn.Module):
         target_T = int(self.spec_size * self.freq_ratio)
         target_F = self.spec_size // self.freq_ratio
         assert T <= target_T and F <= target_F, "the wav size should less than or equal to the swin input size"
-        # to avoid bicubic zero error
-        if T < target_T:
-            x = nn.functional.interpolate(x, (target_T, x.shape[3]), mode="bicubic", align_corners=True)
-        if F < target_F:
-            x = nn.functional.interpolate(x, (x.shape[2], target_F), mode="bicubic", align_corners=True)
-        x = x.permute(0,1,3,2).contiguous()
-        x = x.reshape(x.shape[0], x.shape[1], x.shape[2], self.freq_ratio, x.shape[3] // self.freq_ratio)
-        # print(x.shape)
-        x = x.permute(0,1,3,2,4).contiguous()
-        x = x.reshape(x.shape[0], x.shape[1], x.shape[2] * x.shape[3], x.shape[4])
+        # the bicubic resize (align_corners=True) and the freq_ratio fold are precomputed per input shape,
+        # so each batch costs one gather and one small matmul instead of interpolate and two permuted copies
+        key = (T, F, x.device, x.dtype)
+        # while tracing, the operands are built afresh so the graph does not depend on the Python-side cache
+        tracing = torch.jit.is_tracing()
+        operands = None if tracing else self._wav2img_cache.get(key)
+        if operands is None:
+            fold_operands = bicubic_fold_operands(T, target_F, target_T, self.freq_ratio)
+            freq_weights = bicubic_weights(F, target_F).t() if F < target_F else None
+            operands = tuple(
+                w.to(device=x.device, dtype=x.dtype if w.is_floating_point() else w.dtype) if w is not None else None
+                for w in fold_operands + (freq_weights,)
+            )
+            if not tracing:
+                self._wav2img_cache[key] = operands
+        frame_index, freq_index, band_weights, freq_weights = operands
+        if freq_weights is not None:
+            x = torch.matmul(x, freq_weights)
+        # a single gather, also valid for the non-contiguous output of bn0
+        x = x[:, :, frame_index, freq_index]  # B, C, freq_ratio, F, band
+        if band_weights is not None:
+            x = torch.matmul(x, band_weights)  # B, C, freq_ratio, F, target_T // freq_ratio
+        x = x.reshape(B, C, self.freq_ratio * target_F, target_T // self.freq_ratio)
         return x
     
     # Repeat the wavform to a img size, if you want to use the pretrained swin transformer model
@@ -863,7 +975,7 @@ class HTSAT_Swin_Transformer(nn.Module):
         x = x.repeat(repeats = (1,1,4,1))
         return x
 
-    def forward(self, x: torch.Tensor, mixup_lambda = None, infer_mode = False, device=None):# out_feat_keys: List[str] = None):
+    def forward(self, x: torch.Tensor, mixup_lambda = None, infer_mode = False, device=None, outputs = None):# out_feat_keys: List[str] = None):
 
         if self.enable_fusion and x["longer"].sum() == 0:
             # if no audio is longer than 10s, then randomly select one audio to be longer
@@ -875,7 +987,7 @@ class HTSAT_Swin_Transformer(nn.Module):
                 x = self.bn0(x)
                 x = x.transpose(1, 3)
                 x = self.reshape_wav2img(x)
-                output_dict = self.forward_features(x, longer_idx=[])
+                output_dict = self.forward_features(x, longer_idx=[], outputs=outputs)
                 return output_dict
                 
         if not self.enable_fusion:
@@ -892,7 +1004,7 @@ class HTSAT_Swin_Transformer(nn.Module):
                 x = do_mixup(x, mixup_lambda)
                 
             x = self.reshape_wav2img(x)
-            output_dict = self.forward_features(x)
+            output_dict = self.forward_features(x, outputs=outputs)
         else:
             longer_list = x["longer"].to(device=device, non_blocking=True)
             x = x["mel_fusion"].to(device=device, non_blocking=True)
@@ -931,7 +1043,7 @@ class HTSAT_Swin_Transformer(nn.Module):
                 x = do_mixup(x, mixup_lambda)
 
             x = self.reshape_wav2img(x)
-            output_dict = self.forward_features(x, longer_idx = longer_list_idx)
+            output_dict = self.forward_features(x, longer_idx = longer_list_idx, outputs = outputs)
        
         # if infer_mode:
         #     # in infer mode. we need to handle different length audio input
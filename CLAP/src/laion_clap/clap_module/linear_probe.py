@@ -8,7 +8,7 @@ class LinearProbe(nn.Module):
     def __init__(self, model, mlp, freeze, in_ch, out_ch, act=None):
         """
         Args:
-            model: nn.Module
+            model: nn.Module, the CLAP model, built with modalities={"audio"} as the text branch is not used
             mlp: bool, if True, then use the MLP layer as the linear probe module
             freeze: bool, if Ture, then freeze all the CLAP model's layers when training the linear probe
             in_ch: int, the output channel from CLAP model
@@ -18,7 +18,6 @@ class LinearProbe(nn.Module):
         super().__init__()
         in_ch = 512
         self.clap_model = model
-        self.clap_model.text_branch = None  # to save memory
         self.freeze = freeze
         if mlp:
             self.lp_layer = MLPLayers(units=[in_ch, in_ch * 2, out_ch])
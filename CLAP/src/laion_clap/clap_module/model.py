@@ -419,6 +419,14 @@ class CLAPTextCfg:
     model_type: str
 
 
+# state dict key prefixes of the modules built for each modality, see CLAP(modalities=...)
+MODALITY_PREFIXES = {
+    "audio": ("audio_branch.", "audio_transform.", "audio_projection."),
+    "text": ("text_branch.", "text_transform.", "text_projection.", "token_embedding.", "positional_embedding",
+             "ln_final."),
+}
+
+
 class CLAP(nn.Module):
     def __init__(
         self,
@@ -430,7 +438,12 @@ class CLAP(nn.Module):
         fusion_type: str = 'None',
         joint_embed_shape: int = 512,
         mlp_act: str = 'relu',
+        modalities=("audio", "text"),
     ):
+        """
+        modalities: the branches to build, "audio" and/or "text". The modules of a missing branch are None,
+            see MODALITY_PREFIXES for the state dict keys they own.
+        """
         super().__init__()
         if isinstance(audio_cfg, dict):
             audio_cfg = CLAPAudioCfp(**audio_cfg)
@@ -443,6 +456,9 @@ class CLAP(nn.Module):
         self.fusion_type = fusion_type
         self.joint_embed_shape = joint_embed_shape
         self.mlp_act = mlp_act
+        self.modalities = set(modalities)
+        if not self.modalities or not self.modalities <= {"audio", "text"}:
+            raise ValueError(f"modalities should be a non-empty subset of {{'audio', 'text'}}, got {modalities}")
 
 
         self.context_length = text_cfg.context_length
@@ -461,77 +477,84 @@ class CLAP(nn.Module):
 
         # audio branch
         # audio branch parameters
-        if audio_cfg.model_type == "PANN":
-            self.audio_branch = create_pann_model(audio_cfg, enable_fusion, fusion_type)
-        elif audio_cfg.model_type == "HTSAT":
-            self.audio_branch = create_htsat_model(audio_cfg, enable_fusion, fusion_type)
-        else:
-            logging.error(f"Model config for {audio_cfg.model_type} not found")
-            raise RuntimeError(f"Model config for {audio_cfg.model_type} not found.")
+        self.audio_branch = None
+        if "audio" in self.modalities:
+            if audio_cfg.model_type == "PANN":
+                self.audio_branch = create_pann_model(audio_cfg, enable_fusion, fusion_type)
+            elif audio_cfg.model_type == "HTSAT":
+                self.audio_branch = create_htsat_model(audio_cfg, enable_fusion, fusion_type)
+            else:
+                logging.error(f"Model config for {audio_cfg.model_type} not found")
+                raise RuntimeError(f"Model config for {audio_cfg.model_type} not found.")
 
         # text branch
         # text branch parameters
-        if text_cfg.model_type == "transformer":
-            self.text_branch = Transformer(
-                width=text_cfg.width,
-                layers=text_cfg.layers,
-                heads=text_cfg.heads,
-                act_layer=act_layer,
-            )
-            self.vocab_size = text_cfg.vocab_size
-            self.token_embedding = nn.Embedding(text_cfg.vocab_size, text_cfg.width)
-            self.positional_embedding = nn.Parameter(
-                torch.empty(self.context_length, text_cfg.width)
-            )
-            self.ln_final = LayerNorm(text_cfg.width)
-            self.text_transform = MLPLayers(units=[self.joint_embed_shape,
-                                                   self.joint_embed_shape,
-                                                   self.joint_embed_shape], dropout=0.1)
-            self.text_projection = nn.Sequential(
-                nn.Linear(text_cfg.width, self.joint_embed_shape),
-                mlp_act_layer,
-                nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
-            )
-        elif text_cfg.model_type == "bert":
-            self.text_branch = BertModel.from_pretrained("bert-base-uncased")
-            self.text_transform = MLPLayers(units=[self.joint_embed_shape,
-                                                   self.joint_embed_shape,
-                                                   self.joint_embed_shape], dropout=0.1)
-            self.text_projection = nn.Sequential(
-                nn.Linear(768, self.joint_embed_shape),
-                mlp_act_layer,
-                nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
-            )
-        elif text_cfg.model_type == "roberta":
-            self.text_branch = RobertaModel.from_pretrained('roberta-base')
-            self.text_transform = MLPLayers(units=[self.joint_embed_shape,
-                                                   self.joint_embed_shape,
-                                                   self.joint_embed_shape], dropout=0.1)
-            self.text_projection = nn.Sequential(
-                nn.Linear(768, self.joint_embed_shape),
-                mlp_act_layer,
-                nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
-            )
-        elif text_cfg.model_type == "bart":
-            self.text_branch = BartModel.from_pretrained('facebook/bart-base')
-            self.text_transform = MLPLayers(units=[self.joint_embed_shape,
-                                                   self.joint_embed_shape,
-                                                   self.joint_embed_shape], dropout=0.1)
-            self.text_projection = nn.Sequential(
-                nn.Linear(768, self.joint_embed_shape),
-                mlp_act_layer,
-                nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
-            )
-        else:
-            logging.error(f"Model config for {text_cfg.model_type} not found")
-            raise RuntimeError(f"Model config for {text_cfg.model_type} not found.")
+        self.text_branch = None
+        self.text_transform = None
+        self.text_projection = None
+        if "text" in self.modalities:
+            if text_cfg.model_type == "transformer":
+                self.text_branch = Transformer(
+                    width=text_cfg.width,
+                    layers=text_cfg.layers,
+                    heads=text_cfg.heads,
+                    act_layer=act_layer,
+                )
+                self.vocab_size = text_cfg.vocab_size
+                self.token_embedding = nn.Embedding(text_cfg.vocab_size, text_cfg.width)
+                self.positional_embedding = nn.Parameter(
+                    torch.empty(self.context_length, text_cfg.width)
+                )
+                self.ln_final = LayerNorm(text_cfg.width)
+                self.text_transform = MLPLayers(units=[self.joint_embed_shape,
+                                                       self.joint_embed_shape,
+                                                       self.joint_embed_shape], dropout=0.1)
+                self.text_projection = nn.Sequential(
+                    nn.Linear(text_cfg.width, self.joint_embed_shape),
+                    mlp_act_layer,
+                    nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
+                )
+            elif text_cfg.model_type == "bert":
+                self.text_branch = BertModel.from_pretrained("bert-base-uncased")
+                self.text_transform = MLPLayers(units=[self.joint_embed_shape,
+                                                       self.joint_embed_shape,
+                                                       self.joint_embed_shape], dropout=0.1)
+                self.text_projection = nn.Sequential(
+                    nn.Linear(768, self.joint_embed_shape),
+                    mlp_act_layer,
+                    nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
+                )
+            elif text_cfg.model_type == "roberta":
+                self.text_branch = RobertaModel.from_pretrained('roberta-base')
+                self.text_transform = MLPLayers(units=[self.joint_embed_shape,
+                                                       self.joint_embed_shape,
+                                                       self.joint_embed_shape], dropout=0.1)
+                self.text_projection = nn.Sequential(
+                    nn.Linear(768, self.joint_embed_shape),
+                    mlp_act_layer,
+                    nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
+                )
+            elif text_cfg.model_type == "bart":
+                self.text_branch = BartModel.from_pretrained('facebook/bart-base')
+                self.text_transform = MLPLayers(units=[self.joint_embed_shape,
+                                                       self.joint_embed_shape,
+                                                       self.joint_embed_shape], dropout=0.1)
+                self.text_projection = nn.Sequential(
+                    nn.Linear(768, self.joint_embed_shape),
+                    mlp_act_layer,
+                    nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
+                )
+            else:
+                logging.error(f"Model config for {text_cfg.model_type} not found")
+                raise RuntimeError(f"Model config for {text_cfg.model_type} not found.")
         self.text_branch_type = text_cfg.model_type
         # text branch parameters
 
         # audio branch parameters
         self.audio_transform = MLPLayers(units=[self.joint_embed_shape,
                                                 self.joint_embed_shape,
-                                                self.joint_embed_shape], dropout=0.1)
+                                                self.joint_embed_shape], dropout=0.1) \
+            if "audio" in self.modalities else None
 
         # below here is text branch parameters
 
@@ -540,7 +563,7 @@ class CLAP(nn.Module):
                 nn.Linear(embed_dim, self.joint_embed_shape),
                 mlp_act_layer,
                 nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
-            )
+            ) if "audio" in self.modalities else None
 
         self.logit_scale_a = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
         self.logit_scale_t = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
@@ -549,7 +572,9 @@ class CLAP(nn.Module):
         self.init_text_branch_parameters()
 
     def init_text_branch_parameters(self):
-        if self.text_branch_type == "transformer":
+        if self.text_branch is None:
+            pass
+        elif self.text_branch_type == "transformer":
             nn.init.normal_(self.token_embedding.weight, std=0.02)
             nn.init.normal_(self.positional_embedding, std=0.01)
             proj_std = (self.text_branch.width**-0.5) * (
@@ -562,12 +587,6 @@ class CLAP(nn.Module):
                 nn.init.normal_(block.attn.out_proj.weight, std=proj_std)
                 nn.init.normal_(block.mlp.c_fc.weight, std=fc_std)
                 nn.init.normal_(block.mlp.c_proj.weight, std=proj_std)
-        if self.text_branch_type == "bert" or self.text_branch_type == "roberta":
-            width = self.text_branch.embeddings.word_embeddings.weight.shape[-1]
-        elif self.text_branch_type == "bart":
-            width = self.text_branch.shared.weight.shape[-1]
-        else:
-            width = self.text_branch.width
         nn.init.constant_(self.logit_scale_a, np.log(1 / 0.07))
         nn.init.constant_(self.logit_scale_t, np.log(1 / 0.07))
 
@@ -586,7 +605,12 @@ class CLAP(nn.Module):
         mask.triu_(1)  # zero out the lower diagonal
         return mask
 
-    def encode_audio(self, audio, device):
+    def encode_audio(self, audio, device, outputs=None):
+        if self.audio_branch is None:
+            raise RuntimeError("This model was built without the audio branch, see CLAP(modalities=...).")
+        # outputs: the keys of the audio branch output to compute, only supported by HTSAT (PANN computes all)
+        if outputs is not None and self.audio_cfg.model_type == "HTSAT":
+            return self.audio_branch(audio, mixup_lambda=None, device=device, outputs=outputs)
         return self.audio_branch(audio, mixup_lambda=None, device=device)  # mix lambda needs to add
 
     # def list_of_dict_of_tensor2dict_of_tensor(self, x, device):
@@ -600,6 +624,8 @@ class CLAP(nn.Module):
     #     return tmp
 
     def encode_text(self, text, device):
+        if self.text_branch is None:
+            raise RuntimeError("This model was built without the text branch, see CLAP(modalities=...).")
         if self.text_branch_type == "transformer":
             text = text.to(device=device, non_blocking=True)
             x = self.token_embedding(text)  # [batch_size, n_ctx, d_model]
@@ -668,8 +694,10 @@ class CLAP(nn.Module):
         elif audio is None:
             return self.encode_text(text, device=device)
         elif text is None:
-            return self.audio_projection(self.encode_audio(audio, device=device)["embedding"])
-        audio_features = self.audio_projection(self.encode_audio(audio, device=device)["embedding"])
+            return self.audio_projection(self.encode_audio(audio, device=device, outputs=("embedding",))["embedding"])
+        audio_features = self.audio_projection(
+            self.encode_audio(audio, device=device, outputs=("embedding",))["embedding"]
+        )
         audio_features = F.normalize(audio_features, dim=-1)
 
         text_features = self.encode_text(
@@ -736,7 +764,7 @@ class CLAP(nn.Module):
         keys = data[0].keys()
         for k in keys:
             input_dict[k] = torch.cat([d[k].unsqueeze(0) for d in data], dim=0).to(device)
-        audio_embeds = self.encode_audio(input_dict, device=device)["embedding"]
+        audio_embeds = self.encode_audio(input_dict, device=device, outputs=("embedding",))["embedding"]
         audio_embeds = self.audio_projection(audio_embeds)
         audio_embeds = F.normalize(audio_embeds, dim=-1)
         return audio_embeds
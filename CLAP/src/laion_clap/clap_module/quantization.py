@@ -0,0 +1,30 @@
+""" Dynamic int8 quantization of CLAP for CPU inference
+
+Only the Linear layers of the transformer blocks and of the projections are quantized, they hold most of
+the weights and the FLOPs. The mel frontend, the patch embedding convolutions and the norms stay in float.
+"""
+import torch
+
+# submodules whose nn.Linear layers are quantized, the ones missing from a model are skipped
+QUANTIZED_MODULES = [
+    "audio_branch.layers",  # HTSAT Swin blocks
+    "audio_projection",
+    "text_branch.encoder",  # RoBERTa / BERT / BART encoder layers
+    "text_projection",
+]
+
+
+def quantize_dynamic_int8(model):
+    """Quantize the Linear layers of QUANTIZED_MODULES in place, with int8 weights and dynamic activation scales."""
+    names = dict(model.named_modules())
+    qconfig_spec = {
+        name: torch.ao.quantization.default_dynamic_qconfig for name in QUANTIZED_MODULES if name in names
+    }
+    model.eval()
+    torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def is_quantized_state_dict(state_dict):
+    """Whether the state dict was saved from a model quantized by quantize_dynamic_int8."""
+    return any(k.endswith("_packed_params._packed_params") for k in state_dict)
@@ -0,0 +1,111 @@
+""" Exact top-k retrieval streamed over the corpus
+
+Ranking Q queries against N corpus embeddings with an argsort of the dense (Q, N) similarity matrix costs
+O(Q * N) memory and a full sort per query. topk_search instead scores the corpus chunk by chunk, keeps a
+running top-k per query, and counts per query the corpus items scoring above a designated target, which is the
+rank of that target: memory is O(Q * k + Q * chunk_size). The matmuls and top-k run on the intra-op threads of
+torch, all physical cores by default.
+
+Example:
+    result = topk_search(audio_features, text_features, k=10, targets=class_labels)
+    mean_rank = result.ranks.float().mean() + 1
+    ranks = topk_search(audio_features, text_features, k=0, targets=class_labels).ranks  # ranks only
+"""
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+TopKResult = namedtuple("TopKResult", ["scores", "indices", "ranks"])
+
+
+class RunningTopK:
+    """Top-k scores and corpus indices of each query, merged chunk by chunk."""
+
+    def __init__(self, num_queries, k, device=None):
+        self.k = k
+        self.scores = torch.empty(num_queries, 0, device=device)
+        self.indices = torch.empty(num_queries, 0, dtype=torch.int64, device=device)
+
+    def update(self, scores, indices):
+        """Merge (Q, n) scores of the corpus items `indices`, of shape (n,) or (Q, n)."""
+        scores = torch.cat([self.scores, scores], dim=1)
+        indices = torch.cat([self.indices, indices.expand(len(scores), -1)], dim=1)
+        self.scores, top = scores.topk(min(self.k, scores.shape[1]), dim=1)
+        self.indices = indices.gather(1, top)
+
+    def result(self):
+        """(Q, k) scores and indices, padded with -inf and -1 when fewer than k items were merged."""
+        scores = torch.full((len(self.scores), self.k), -float("inf"), device=self.scores.device)
+        indices = torch.full((len(self.indices), self.k), -1, dtype=torch.int64, device=self.indices.device)
+        scores[:, :self.scores.shape[1]] = self.scores
+        indices[:, :self.indices.shape[1]] = self.indices
+        return scores, indices
+
+
+def _as_tensor(x, device):
+    if isinstance(x, torch.Tensor):
+        return x.to(device=device, dtype=torch.float32)
+    return torch.from_numpy(np.asarray(x, dtype=np.float32)).to(device)
+
+
+def iter_corpus(corpus, chunk_size):
+    """Yield (first index, chunk) of a tensor, an array (e.g. np.memmap) or an EmbeddingStore."""
+    if hasattr(corpus, "chunks"):
+        yield from corpus.chunks(chunk_size)
+        return
+    for start in range(0, len(corpus), chunk_size):
+        yield start, corpus[start:start + chunk_size]
+
+
+def topk_search(queries, corpus, k=10, chunk_size=65536, targets=None):
+    """Exact top-k inner product search, streaming the corpus in chunks
+
+    Parameters
+    ----------
+    queries: torch.Tensor | np.ndarray (Q, D)
+        query embeddings, the search runs on their device if a tensor
+    corpus: torch.Tensor | np.ndarray | EmbeddingStore (N, D)
+        corpus embeddings, only one chunk at a time is copied to the device of the queries
+    k: int | None
+        number of hits per query, 0 or None to only compute the ranks of the targets
+    chunk_size: int
+        corpus rows scored at once
+    targets: torch.Tensor | np.ndarray (Q,) | None
+        corpus index of the ground truth of each query, whose rank is computed if given
+    Returns
+    ----------
+    result: TopKResult
+        scores (Q, k) and indices (Q, k) of the hits, padded with -inf and -1 if N < k, (Q, 0) if k is 0,
+        and ranks (Q,): the 0-based rank of each target (the number of corpus items scoring higher),
+        None if no targets are given
+    """
+    device = queries.device if isinstance(queries, torch.Tensor) else torch.device("cpu")
+    queries = _as_tensor(queries, device)
+    top = RunningTopK(len(queries), k or 0, device)
+    ranks = None
+    if targets is not None:
+        targets = torch.as_tensor(targets, dtype=torch.int64, device=device).view(-1)
+        if isinstance(corpus, torch.Tensor):
+            target_rows = corpus[targets.to(corpus.device)]
+        elif hasattr(corpus, "chunks"):
+            target_rows = corpus.take(targets.cpu().numpy())
+        else:
+            target_rows = corpus[targets.cpu().numpy()]
+        target_scores = (queries * _as_tensor(target_rows, device)).sum(1, keepdim=True)
+        ranks = torch.zeros(len(queries), dtype=torch.int64, device=device)
+
+    for start, chunk in iter_corpus(corpus, chunk_size):
+        scores = queries @ _as_tensor(chunk, device).t()
+        if top.k:
+            top.update(scores, torch.arange(start, start + scores.shape[1], device=device))
+        if targets is not None:
+            ranks += (scores > target_scores).sum(1)
+            # the target itself never ranks above itself, whatever the rounding of the two dot products
+            local = targets - start
+            in_chunk = ((local >= 0) & (local < scores.shape[1])).nonzero().view(-1)
+            self_scores = scores[in_chunk, local[in_chunk]]
+            ranks[in_chunk] -= (self_scores > target_scores[in_chunk, 0]).long()
+
+    scores, indices = top.result()
+    return TopKResult(scores, indices, ranks)
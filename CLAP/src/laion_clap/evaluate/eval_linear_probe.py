@@ -297,7 +297,8 @@ def lp_main(args, device, writer, pretrain_epoch, idx):
         openai_model_cache_dir=os.path.expanduser(args.openai_model_cache_dir),
         skip_params=False,
         enable_fusion=args.enable_fusion,
-        fusion_type=args.fusion_type
+        fusion_type=args.fusion_type,
+        modalities={"audio"},  # the linear probe only uses the audio branch
     )
     
     args.lp_out_ch = len(list(args.class_index_dict.keys()))
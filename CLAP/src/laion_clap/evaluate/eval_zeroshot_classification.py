@@ -9,6 +9,7 @@ import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 from clap_module import create_model
 from clap_module import tokenize
+from clap_module import topk_search
 from training.logger import setup_logging
 from training.data import get_data
 from training.train import evaluate
@@ -61,19 +62,8 @@ def evaluate_zeroshot(model, data, start_epoch, args, writer):
         all_text_features = model(None, all_texts, device)
         all_text_features = F.normalize(all_text_features, dim=-1).detach().cpu()
 
-        # compute similarity
-        logit_scale_a, logit_scale_t = model(None, None, device)
-        logit_scale_a = logit_scale_a.cpu()
-
-        logits_per_audio = (logit_scale_a * all_audio_features @ all_text_features.t()).detach().cpu()
-        logits_per_text = logits_per_audio.t().detach().cpu()
-
-        ground_truth = all_class_labels.view(-1, 1)
-        logit = logits_per_audio
-
-        ranking = torch.argsort(logit, descending=True)
-        preds = torch.where(ranking == ground_truth)[1]  # (yusong) this line is slow because it uses single thread
-        preds = preds.detach().cpu().numpy()
+        # rank of the class of each audio among all classes, the logit scale does not change the ranking
+        preds = topk_search(all_audio_features, all_text_features, k=0, targets=all_class_labels).ranks.numpy()
         metrics[f"{args.datasetnames[0]}_mean_rank"] = preds.mean() + 1
         metrics[f"{args.datasetnames[0]}_median_rank"] = np.floor(np.median(preds)) + 1
         for k in [1, 5, 10]:
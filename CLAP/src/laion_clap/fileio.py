@@ -0,0 +1,13 @@
+""" File helpers shared by the on-disk structures of EmbeddingStore, FilterIndex and IVFPQIndex """
+import json
+import os
+
+
+def write_json(path, obj):
+    """Replace the JSON file at `path` atomically, readers see either the old or the new content."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -0,0 +1,183 @@
+"""
+Metadata-filtered similarity search over an EmbeddingStore
+----------------------------------------------------------
+FilterIndex precomputes, for each indexed metadata column, the sorted row ids of every value of a string column
+(deployment, region, species, ...) and the rows of a numeric column (timestamp, duration, ...) sorted by value.
+A filter is resolved to the sorted candidate rows from these lists alone, then the corpus is streamed in
+blocks and only the candidate rows of a block are read and scored: a selective filter costs a fraction of a
+full scan instead of a full scan followed by post-filtering.
+
+Filters are a dict of column -> predicate, all of which must hold:
+    "deployment": "MARS-2019"           string equality
+    "species": ["humpback", "fin"]      any of several strings
+    "timestamp": (t0, t1)               t0 <= value <= t1, None for an open end
+    "duration": 10.0                    numeric equality
+
+Rows appended to the store after FilterIndex.build are filtered from their column values directly.
+
+Layout:
+    <store>/filters/filters.json        indexed columns and number of rows
+    <store>/filters/<column>.rows.npy   row ids sorted by (value, row)
+    <store>/filters/<column>.offsets.npy  (string columns) code c is rows[offsets[c]:offsets[c + 1]]
+    <store>/filters/<column>.values.npy   (numeric columns) the sorted values
+
+Example:
+    filter_index = FilterIndex.build(store, ["deployment", "region", "timestamp"])
+    scores, rows = filter_index.search_text(model, ["humpback whale song"], {"deployment": "MARS-2019"}, k=20)
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+from .clap_module.retrieval import RunningTopK
+from .fileio import write_json
+from .store import COLUMN_DTYPES
+
+
+class FilterIndex:
+    def __init__(self, store):
+        """Open the filter lists of a store written by FilterIndex.build
+
+        Parameters
+        ----------
+        store: EmbeddingStore
+        """
+        self.store = store
+        self.path = os.path.join(store.path, "filters")
+        with open(os.path.join(self.path, "filters.json")) as f:
+            self.meta = json.load(f)
+        self.indexed_rows = self.meta["rows"]
+        self.lists = {}
+        for name in self.meta["columns"]:
+            keys = ("rows", "offsets") if store.columns[name] == "str" else ("rows", "values")
+            self.lists[name] = {
+                key: np.load(os.path.join(self.path, f"{name}.{key}.npy"), mmap_mode="r") for key in keys
+            }
+
+    @classmethod
+    def build(cls, store, columns):
+        """Precompute the sorted row lists of some metadata columns of `store`, replacing previous ones."""
+        store.refresh()
+        path = os.path.join(store.path, "filters")
+        os.makedirs(path, exist_ok=True)
+        for name in columns:
+            values = np.asarray(store.column(name, decode=False))
+            rows = np.argsort(values, kind="stable")
+            np.save(os.path.join(path, f"{name}.rows.npy"), rows)
+            if store.columns[name] == "str":
+                offsets = np.zeros(len(store.vocabulary(name)) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum(np.bincount(values, minlength=len(offsets) - 1))
+                np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+            else:
+                np.save(os.path.join(path, f"{name}.values.npy"), values[rows])
+        write_json(os.path.join(path, "filters.json"), {"columns": list(columns), "rows": store.rows})
+        return cls(store)
+
+    def _bounds(self, name, predicate):
+        dtype = np.dtype(COLUMN_DTYPES[self.store.columns[name]])
+        low, high = predicate if isinstance(predicate, tuple) else (predicate, predicate)
+        if dtype.kind == "f":
+            return (-np.inf if low is None else low), (np.inf if high is None else high)
+        info = np.iinfo(dtype)
+        return (info.min if low is None else low), (info.max if high is None else high)
+
+    def _indexed_rows(self, name, predicate):
+        """Sorted rows among the indexed ones matching a predicate on one column."""
+        lists = self.lists[name]
+        if self.store.columns[name] == "str":
+            values = [predicate] if isinstance(predicate, str) else predicate
+            offsets = lists["offsets"]
+            # values new since the build (or unknown) have no indexed rows
+            codes = [c for c in self.store.codes(name, values) if 0 <= c < len(offsets) - 1]
+            parts = [lists["rows"][offsets[c]:offsets[c + 1]] for c in codes]
+            if len(parts) == 1:
+                return np.asarray(parts[0])
+            return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        low, high = self._bounds(name, predicate)
+        begin = np.searchsorted(lists["values"], low, side="left")
+        end = np.searchsorted(lists["values"], high, side="right")
+        return np.sort(lists["rows"][begin:end])
+
+    def _scan_rows(self, name, predicate, start):
+        """Sorted rows from `start` on matching a predicate, from the column values."""
+        values = self.store.column(name, decode=False)[start:]
+        if self.store.columns[name] == "str":
+            codes = self.store.codes(name, [predicate] if isinstance(predicate, str) else predicate)
+            mask = np.isin(values, codes[codes >= 0])
+        else:
+            low, high = self._bounds(name, predicate)
+            mask = (values >= low) & (values <= high)
+        return start + np.flatnonzero(mask)
+
+    def rows(self, filters):
+        """Sorted rows of the store matching all filters."""
+        self.store.refresh()
+        unknown = set(filters) - set(self.store.columns)
+        if unknown:
+            raise ValueError(f"Unknown metadata columns {sorted(unknown)}, the store has {list(self.store.columns)}.")
+        matches = []
+        for name, predicate in filters.items():
+            if name in self.lists:
+                rows = self._indexed_rows(name, predicate)
+                if self.store.rows > self.indexed_rows:
+                    rows = np.concatenate([rows, self._scan_rows(name, predicate, self.indexed_rows)])
+            else:
+                rows = self._scan_rows(name, predicate, 0)
+            matches.append(rows)
+        matches.sort(key=len)
+        rows = matches[0]
+        for other in matches[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows.astype(np.int64)
+
+    def search(self, queries, filters=None, k=10, chunk_rows=65536, dense_ratio=0.25):
+        """Top-k inner product search over the rows matching `filters`
+
+        Parameters
+        ----------
+        queries: np.ndarray | torch.Tensor (Q, D)
+            query embeddings, e.g. from CLAP_Module.get_text_embedding
+        filters: dict | None
+            column -> predicate, all rows if None
+        k: int
+            number of hits per query
+        chunk_rows: int
+            rows of a block of the corpus
+        dense_ratio: float
+            a block holding at least this fraction of candidates is scored whole and the candidate scores
+            selected, fewer candidates are gathered and only they are scored
+        Returns
+        ----------
+        scores: np.ndarray (Q, k) float32
+            inner products, -inf where fewer than k rows match
+        rows: np.ndarray (Q, k) int64
+            store rows of the hits, -1 where fewer than k rows match
+        """
+        queries = torch.from_numpy(np.ascontiguousarray(queries, dtype=np.float32)).view(-1, self.store.dim)
+        candidates = self.rows(filters) if filters else None
+        top = RunningTopK(len(queries), k)
+        for start, block in self.store.chunks(chunk_rows):
+            block_rows = np.arange(start, start + len(block))
+            local = None
+            if candidates is not None:
+                begin, end = np.searchsorted(candidates, [start, start + len(block)])
+                if begin == end:
+                    continue
+                block_rows = candidates[begin:end]
+                local = block_rows - start
+                if len(local) < dense_ratio * len(block):
+                    block, local = block[local], None
+            scores = queries @ torch.from_numpy(np.asarray(block, dtype=np.float32)).t()
+            if local is not None:
+                scores = scores[:, torch.from_numpy(local)]
+            top.update(scores, torch.from_numpy(block_rows))
+        scores, rows = top.result()
+        return scores.numpy(), rows.numpy()
+
+    def search_text(self, model, texts, filters=None, k=10, **kwargs):
+        """Filtered text-to-audio search, the queries are embedded with CLAP_Module.get_text_embedding."""
+        with torch.no_grad():
+            queries = model.get_text_embedding(list(texts), use_tensor=False)
+        return self.search(queries, filters, k, **kwargs)
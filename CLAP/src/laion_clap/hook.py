@@ -15,10 +15,13 @@ from training.data import int16_to_float32, float32_to_int16
 from transformers import RobertaTokenizer
 import wget
 from clap_module.factory import load_state_dict
+from clap_module.checkpoint import assign_state_dict
+from clap_module.quantization import quantize_dynamic_int8, is_quantized_state_dict
 
 
 class CLAP_Module(torch.nn.Module):
-    def __init__(self, enable_fusion=False, device=None, amodel= 'HTSAT-tiny', tmodel='roberta') -> None:
+    def __init__(self, enable_fusion=False, device=None, amodel= 'HTSAT-tiny', tmodel='roberta', quantize=None,
+                 modalities=None) -> None:
         """Initialize CLAP Model
 
         Parameters
@@ -31,8 +34,20 @@ class CLAP_Module(torch.nn.Module):
             audio encoder architecture, default: HTSAT-tiny
         tmodel: str
             text encoder architecture, default: roberta
+        quantize: str
+            if "int8", the Linear layers of the audio encoder blocks, the text encoder and the projections
+            are dynamically quantized to int8 for CPU inference when the checkpoint is loaded (default: None)
+        modalities: set[str]
+            if specified, only build and load these branches, e.g. {"audio"} to only embed audio or {"text"}
+            to only embed texts, which about halves the memory and load time (default: None, both branches)
         """
         super(CLAP_Module, self).__init__()
+        if quantize not in (None, 'int8'):
+            raise ValueError(f'quantize should be None or "int8", got {quantize}')
+        if quantize is not None:
+            if device is not None and torch.device(device).type != 'cpu':
+                raise ValueError('Quantized inference only runs on cpu.')
+            device = 'cpu'
         if device is None:
             device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
 
@@ -46,7 +61,8 @@ class CLAP_Module(torch.nn.Module):
                 precision=precision,
                 device=device,
                 enable_fusion=enable_fusion,
-                fusion_type=fusion_type
+                fusion_type=fusion_type,
+                modalities=modalities
             )
         else:
             model, model_cfg = create_model(
@@ -54,12 +70,23 @@ class CLAP_Module(torch.nn.Module):
                 tmodel,
                 precision=precision,
                 device=device,
-                enable_fusion=enable_fusion
+                enable_fusion=enable_fusion,
+                modalities=modalities
             )
         self.enable_fusion = enable_fusion
+        self.quantize = quantize
+        self.modalities = modalities
         self.model = model
         self.model_cfg = model_cfg
-        self.tokenize = RobertaTokenizer.from_pretrained('roberta-base')
+        self.tokenize = RobertaTokenizer.from_pretrained('roberta-base') \
+            if modalities is None or 'text' in modalities else None
+
+    def _check_modality(self, modality):
+        if self.modalities is not None and modality not in self.modalities:
+            raise ValueError(
+                f'This model was built without the {modality} branch (modalities={sorted(self.modalities)}), '
+                f'create it with modalities including "{modality}" to get {modality} embeddings.'
+            )
 
     def tokenizer(self, text):
         result = self.tokenize(
@@ -71,7 +98,7 @@ class CLAP_Module(torch.nn.Module):
         )
         return {k: v.squeeze(0) for k, v in result.items()}
 
-    def load_ckpt(self, ckpt = None, model_id = -1, verbose = True):
+    def load_ckpt(self, ckpt = None, model_id = -1, verbose = True, mmap_weights = False):
         """Load the pretrained checkpoint of CLAP model
 
         Parameters
@@ -86,6 +113,12 @@ class CLAP_Module(torch.nn.Module):
                 id = 2 --> 630k fusion ckpt \n
                 id = 3 --> 630k+audioset fusion ckpt \n
             Note that if your model is specied as non-fusion model but you download a fusion model ckpt, you will face an error.
+        verbose: bool
+            if true, print the number of loaded parameters and the names of the parameters missing from the ckpt
+        mmap_weights: bool
+            only for a .safetensors ckpt (see clap_module.checkpoint): keep the weights in the memory-mapped file
+            instead of copying them into the model, so processes loading the same file share one copy of the weights
+            in the page cache. The weights are read-only and do not require grad, for inference only.
         """
         download_link = 'https://huggingface.co/lukewys/laion_clap/resolve/main/'
         download_names = [
@@ -110,13 +143,42 @@ class CLAP_Module(torch.nn.Module):
                 ckpt = wget.download(download_link + weight_file_name, os.path.dirname(ckpt))
                 print('Download completed!')
         print('Load Checkpoint...')
-        ckpt = load_state_dict(ckpt, skip_params=True)
-        self.model.load_state_dict(ckpt)
+        if mmap_weights and not ckpt.endswith('.safetensors'):
+            raise ValueError('mmap_weights needs a .safetensors ckpt, see clap_module.checkpoint to convert one.')
+        if mmap_weights and next(self.model.parameters()).device.type != 'cpu':
+            raise ValueError('mmap_weights is only supported on cpu.')
+        ckpt = load_state_dict(ckpt, skip_params=True, modalities=self.modalities)
+        if mmap_weights:
+            assign_state_dict(self.model, ckpt)
+            if self.quantize is not None:
+                quantize_dynamic_int8(self.model)
+        elif is_quantized_state_dict(ckpt):
+            if self.quantize is None:
+                raise ValueError('This checkpoint is quantized, create the model with quantize="int8" to load it.')
+            # a checkpoint saved by save_ckpt from a quantized model, swap the layers before loading
+            quantize_dynamic_int8(self.model)
+            self.model.load_state_dict(ckpt)
+        else:
+            self.model.load_state_dict(ckpt)
+            if self.quantize is not None:
+                quantize_dynamic_int8(self.model)
         if verbose:
             param_names = [n for n, p in self.model.named_parameters()]
-            for n in param_names:
-                print(n, "\t", "Loaded" if n in ckpt else "Unloaded")
+            unloaded = [n for n in param_names if n not in ckpt]
+            print(f'Loaded {len(param_names) - len(unloaded)} of {len(param_names)} parameters.')
+            for n in unloaded:
+                print(n, "\t", "Unloaded")
     
+    def save_ckpt(self, path):
+        """Save the model weights, which load_ckpt loads back. A quantized model is saved with its int8 weights.
+
+        Parameters
+        ----------
+        path: str
+            the path of the checkpoint file
+        """
+        torch.save({"state_dict": self.model.state_dict()}, path)
+
     def get_audio_embedding_from_filelist(self, x, use_tensor=False):
         """get audio embeddings from the audio file list
 
@@ -131,6 +193,7 @@ class CLAP_Module(torch.nn.Module):
         audio_embed : numpy.darray | torch.Tensor (N,D):
             audio embeddings that extracted from audio files
         """ 
+        self._check_modality('audio')
         self.model.eval()
         audio_input = []
         for f in x:
@@ -169,6 +232,7 @@ class CLAP_Module(torch.nn.Module):
         audio embed: numpy.darray | torch.Tensor (N,D):
             audio embeddings that extracted from audio files
         """ 
+        self._check_modality('audio')
         self.model.eval()
         audio_input = []
         for audio_waveform in x:          
@@ -206,6 +270,7 @@ class CLAP_Module(torch.nn.Module):
         text_embed : numpy.darray | torch.Tensor (N,D):
             text embeddings that extracted from texts
         """ 
+        self._check_modality('text')
         self.model.eval()
         if tokenizer is not None:
             text_input = tokenizer(x)
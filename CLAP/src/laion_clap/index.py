@@ -0,0 +1,287 @@
+"""
+Approximate nearest-neighbor index over CLAP audio embeddings
+-------------------------------------------------------------
+An inverted file (IVF) index: a k-means coarse quantizer splits the embeddings into `nlist` lists and a query
+only scores the rows of its `nprobe` nearest lists. With product quantization (PQ) each row is stored as the
+codes of its residual to the list centroid, `pq_m` bytes instead of 512 floats, and scored against the query
+with per-query lookup tables. Without PQ the rows are stored as float16 and scored exactly.
+
+Appends are written as new segments, each holding its rows sorted by list, so a list is a contiguous slice of
+every segment. All arrays are .npy files opened memory-mapped, the index does not have to fit in memory.
+
+Layout:
+    <path>/index.json                   dim, nlist, pq_m, ntotal and the segment names
+    <path>/centroids.npy                (nlist, dim) coarse centroids
+    <path>/codebooks.npy                (pq_m, 256, dim // pq_m) PQ codebooks (PQ only)
+    <path>/segments/<name>/codes.npy    (n, pq_m) uint8 codes, or (n, dim) float16 vectors without PQ
+    <path>/segments/<name>/ids.npy      (n,) int64 ids
+    <path>/segments/<name>/offsets.npy  (nlist + 1,) int64, list l is rows offsets[l]:offsets[l + 1]
+
+Example:
+    index = IVFPQIndex.build("bird_index", audio_embeddings, nlist=4096, pq_m=64)
+    scores, ids = index.search_text(model, ["a humpback whale singing"], k=10, nprobe=32)
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from .fileio import write_json
+
+PQ_CENTROIDS = 256
+
+
+def assign_nearest(x, centroids, chunk_size=65536):
+    """Index of the nearest centroid (L2) of every row of x."""
+    half_norms = 0.5 * (centroids ** 2).sum(1)
+    return torch.cat([
+        (x[i:i + chunk_size] @ centroids.t() - half_norms).argmax(1) for i in range(0, len(x), chunk_size)
+    ])
+
+
+def kmeans(x, k, niter=20, seed=0):
+    """Lloyd's k-means on the rows of a float32 tensor, empty clusters are reseeded with random rows."""
+    if len(x) < k:
+        raise ValueError(f"At least {k} training vectors are needed, got {len(x)}.")
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:k]].clone()
+    for _ in range(niter):
+        assign = assign_nearest(x, centroids)
+        counts = torch.bincount(assign, minlength=k)
+        centroids = torch.zeros_like(centroids).index_add_(0, assign, x) / counts.clamp(min=1)[:, None].to(x.dtype)
+        empty = counts == 0
+        if empty.any():
+            centroids[empty] = x[torch.randint(len(x), (int(empty.sum()),), generator=generator)]
+    return centroids
+
+
+def recall_at_k(approx_ids, exact_ids):
+    """Fraction of the exact top-k ids found in the approximate top-k, averaged over queries."""
+    k = exact_ids.shape[1]
+    hits = [len(np.intersect1d(a[:k], e)) for a, e in zip(approx_ids, exact_ids)]
+    return float(np.mean(hits)) / k
+
+
+def _group_starts(groups, num_groups):
+    """Index of the first element of each group in a tensor sorted by group."""
+    counts = torch.bincount(groups, minlength=num_groups)
+    return torch.cumsum(counts, 0) - counts
+
+
+def _merge_topk(parts, num_queries, k):
+    """
+    Top-k of each query over flat (scores, ids, queries) parts, as flat (scores, ids, queries)
+    sorted by query, then by descending score.
+    """
+    scores, ids, queries = (torch.cat(x) for x in zip(*parts))
+    order = torch.argsort(scores, descending=True)
+    order = order[torch.argsort(queries[order], stable=True)]
+    scores, ids, queries = scores[order], ids[order], queries[order]
+    keep = torch.arange(len(queries)) - _group_starts(queries, num_queries)[queries] < k
+    return scores[keep], ids[keep], queries[keep]
+
+
+class IVFPQIndex:
+    def __init__(self, path):
+        """Open an index written by IVFPQIndex.build, its arrays are memory-mapped
+
+        Parameters
+        ----------
+        path: str
+            directory of the index
+        """
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        self.nlist = self.meta["nlist"]
+        self.pq_m = self.meta["pq_m"]
+        self.centroids = torch.from_numpy(np.load(os.path.join(path, "centroids.npy")))
+        self.codebooks = torch.from_numpy(np.load(os.path.join(path, "codebooks.npy"))) if self.pq_m else None
+        self.segments = [self._load_segment(name) for name in self.meta["segments"]]
+
+    @property
+    def ntotal(self):
+        return self.meta["ntotal"]
+
+    def __len__(self):
+        return self.ntotal
+
+    def _load_segment(self, name):
+        segment_dir = os.path.join(self.path, "segments", name)
+        return {
+            key: np.load(os.path.join(segment_dir, f"{key}.npy"), mmap_mode="r")
+            for key in ("codes", "ids", "offsets")
+        }
+
+    @classmethod
+    def build(cls, path, embeddings, ids=None, nlist=1024, pq_m=64, train_size=262144, niter=20, seed=0):
+        """Train the coarse quantizer (and PQ codebooks) on a sample of `embeddings`, then add all of them
+
+        Parameters
+        ----------
+        path: str
+            directory to write the index to, it must not exist yet
+        embeddings: np.ndarray (N, D)
+            L2-normalized audio embeddings, e.g. from CLAP_Module.get_audio_embedding_from_filelist
+        ids: np.ndarray (N,) | None
+            int64 ids returned by search, the row numbers if None
+        nlist: int
+            number of inverted lists, about sqrt(N) to 16 * sqrt(N)
+        pq_m: int | None
+            bytes per row, D must be divisible by it. If None, rows are stored as float16 and scored exactly.
+        train_size: int
+            number of rows sampled to train the quantizers
+        Returns
+        ----------
+        index: IVFPQIndex
+        """
+        embeddings = np.asarray(embeddings)
+        dim = embeddings.shape[1]
+        if pq_m is not None and dim % pq_m != 0:
+            raise ValueError(f"The embedding dimension {dim} is not divisible by pq_m={pq_m}.")
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(embeddings), min(train_size, len(embeddings)), replace=False))
+        train = torch.from_numpy(np.ascontiguousarray(embeddings[sample], dtype=np.float32))
+        centroids = kmeans(train, nlist, niter, seed)
+
+        os.makedirs(os.path.join(path, "segments"))
+        np.save(os.path.join(path, "centroids.npy"), centroids.numpy())
+        if pq_m is not None:
+            residuals = train - centroids[assign_nearest(train, centroids)]
+            sub_dim = dim // pq_m
+            codebooks = torch.stack([
+                kmeans(residuals[:, j * sub_dim:(j + 1) * sub_dim].contiguous(), PQ_CENTROIDS, niter, seed + j)
+                for j in range(pq_m)
+            ])
+            np.save(os.path.join(path, "codebooks.npy"), codebooks.numpy())
+        write_json(
+            os.path.join(path, "index.json"),
+            {"dim": dim, "nlist": nlist, "pq_m": pq_m, "ntotal": 0, "segments": []},
+        )
+        index = cls(path)
+        index.add(embeddings, ids)
+        return index
+
+    def encode(self, x):
+        """List assignments and codes (uint8 PQ codes, or float16 vectors without PQ) of float32 rows."""
+        assign = assign_nearest(x, self.centroids)
+        if self.pq_m is None:
+            return assign, x.half()
+        residuals = (x - self.centroids[assign]).view(len(x), self.pq_m, -1)
+        codes = torch.stack([assign_nearest(residuals[:, j], self.codebooks[j]) for j in range(self.pq_m)], dim=1)
+        return assign, codes.to(torch.uint8)
+
+    def add(self, embeddings, ids=None, chunk_size=65536):
+        """Append embeddings as a new segment, ids continue the row numbers if None. Only one process may write."""
+        embeddings = np.asarray(embeddings)
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-d embeddings, got {embeddings.shape[1]}.")
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(embeddings), dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        assign, codes = [], []
+        for i in range(0, len(embeddings), chunk_size):
+            a, c = self.encode(torch.from_numpy(np.ascontiguousarray(embeddings[i:i + chunk_size], dtype=np.float32)))
+            assign.append(a)
+            codes.append(c)
+        assign, codes = torch.cat(assign), torch.cat(codes)
+        order = torch.argsort(assign, stable=True)
+        offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(torch.bincount(assign, minlength=self.nlist).numpy())
+
+        name = f"{len(self.meta['segments']):05d}"
+        segment_dir = os.path.join(self.path, "segments", name)
+        # written under a temporary name, a reader never sees a partial segment
+        tmp_dir = segment_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "codes.npy"), codes[order].numpy())
+        np.save(os.path.join(tmp_dir, "ids.npy"), ids[order.numpy()])
+        np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+        os.replace(tmp_dir, segment_dir)
+
+        self.meta["segments"].append(name)
+        self.meta["ntotal"] += len(embeddings)
+        write_json(os.path.join(self.path, "index.json"), self.meta)
+        self.segments.append(self._load_segment(name))
+
+    def search(self, queries, k=10, nprobe=16, batch_pairs=1 << 22):
+        """Approximate top-k inner product search
+
+        Parameters
+        ----------
+        queries: np.ndarray | torch.Tensor (Q, D)
+            query embeddings, e.g. from CLAP_Module.get_text_embedding
+        k: int
+            number of hits per query
+        nprobe: int
+            number of lists scanned per query, higher is slower and more exact
+        batch_pairs: int
+            (query, row) scores held before they are merged into the running top-k
+        Returns
+        ----------
+        scores: np.ndarray (Q, k) float32
+            (approximate) inner products, -inf where fewer than k rows were scanned
+        ids: np.ndarray (Q, k) int64
+            ids of the hits, -1 where fewer than k rows were scanned
+        """
+        queries = torch.from_numpy(np.ascontiguousarray(queries, dtype=np.float32)).view(-1, self.dim)
+        num_queries = len(queries)
+        coarse = queries @ self.centroids.t()
+        # lists nearest (L2) to the query, as rows were assigned
+        probes = (coarse - 0.5 * (self.centroids ** 2).sum(1)).topk(min(nprobe, self.nlist), dim=1).indices
+        if self.pq_m is not None:
+            # the inner product of the query with every sub-centroid, one flat (pq_m * 256) table per query
+            luts = torch.einsum("qmd,mkd->qmk", queries.view(num_queries, self.pq_m, -1), self.codebooks).flatten(1)
+            code_offsets = torch.arange(self.pq_m) * PQ_CENTROIDS
+
+        # the (query, list) pairs grouped by list: every probed list is read once and scored for all its queries
+        pair_lists, order = probes.flatten().sort(stable=True)
+        pair_queries = order // probes.shape[1]
+        lists, counts = torch.unique_consecutive(pair_lists, return_counts=True)
+
+        top = (torch.empty(0), torch.empty(0, dtype=torch.int64), torch.empty(0, dtype=torch.int64))
+        pending, pending_pairs = [], 0
+        for l, list_queries in zip(lists.tolist(), pair_queries.split(counts.tolist())):
+            codes, hit_ids = [], []
+            for segment in self.segments:
+                begin, end = segment["offsets"][l], segment["offsets"][l + 1]
+                if begin < end:
+                    codes.append(segment["codes"][begin:end])
+                    hit_ids.append(segment["ids"][begin:end])
+            if not codes:
+                continue
+            codes = torch.from_numpy(np.concatenate(codes))
+            if self.pq_m is None:
+                list_scores = queries[list_queries] @ codes.float().t()
+            else:
+                gathered = luts[list_queries][:, (codes.long() + code_offsets).view(-1)]
+                list_scores = gathered.view(len(list_queries), len(codes), self.pq_m).sum(2)
+                list_scores += coarse[list_queries, l][:, None]
+            pending.append((
+                list_scores.flatten(),
+                torch.from_numpy(np.concatenate(hit_ids)).repeat(len(list_queries)),
+                list_queries.repeat_interleave(len(codes)),
+            ))
+            pending_pairs += list_scores.numel()
+            if pending_pairs >= batch_pairs:
+                top = _merge_topk([top] + pending, num_queries, k)
+                pending, pending_pairs = [], 0
+        top_scores, top_ids, top_queries = _merge_topk([top] + pending, num_queries, k)
+
+        # scatter the flat top-k of each query into the (Q, k) padded result
+        scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        ids = np.full((num_queries, k), -1, dtype=np.int64)
+        rank = torch.arange(len(top_queries)) - _group_starts(top_queries, num_queries)[top_queries]
+        scores[top_queries.numpy(), rank.numpy()] = top_scores.numpy()
+        ids[top_queries.numpy(), rank.numpy()] = top_ids.numpy()
+        return scores, ids
+
+    def search_text(self, model, texts, k=10, nprobe=16):
+        """Text-to-audio search, the queries are embedded with CLAP_Module.get_text_embedding."""
+        with torch.no_grad():
+            queries = model.get_text_embedding(list(texts), use_tensor=False)
+        return self.search(queries, k, nprobe)
@@ -0,0 +1,176 @@
+"""
+Multi-process CPU inference with one copy of the CLAP weights
+--------------------------------------------------------------
+The weights of a loaded CLAP_Module are moved to shared memory once and handed to spawned worker processes,
+which map the same pages instead of loading their own copy. Each worker runs a few intra-op threads pinned
+to its own cores, and takes batches of file paths, waveforms or texts from a common queue.
+"""
+import itertools
+import logging
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def physical_cores():
+    """Number of physical cores, hyper-threads do not speed up the GEMMs of the encoders."""
+    cores = psutil.cpu_count(logical=False) if psutil is not None else None
+    return cores or os.cpu_count()
+
+
+def available_cores():
+    """The cores this process may run on, its affinity set under a cpuset or taskset (Linux only)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _worker(model, tasks, results, num_threads, cores):
+    if cores is not None:
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            logging.warning(f"CLAP inference worker not pinned to cores {sorted(cores)}, running unpinned: {e}")
+    torch.set_num_threads(num_threads)
+    model.eval()
+    with torch.no_grad():
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            task_id, method, payload = task
+            try:
+                results.put((task_id, getattr(model, method)(payload, use_tensor=False), None))
+            except Exception:
+                results.put((task_id, None, traceback.format_exc()))
+
+
+class CLAPInferencePool:
+    def __init__(self, model, num_workers=None, threads_per_worker=1, pin_cores=True):
+        """Start worker processes sharing the weights of a loaded CLAP_Module
+
+        Parameters
+        ----------
+        model: CLAP_Module
+            a cpu model with its checkpoint loaded. Its weights are moved to shared memory.
+            The int8 weights of a quantize="int8" model are packed outside of tensors and copied to each worker.
+        num_workers: int
+            number of worker processes, if None, one per threads_per_worker cores this process may run on
+            (at most one per physical core)
+        threads_per_worker: int
+            intra-op threads of each worker (default: 1)
+        pin_cores: bool
+            if true, worker i only runs on its own threads_per_worker cores of the affinity set of this process
+            (Linux only)
+        """
+        cores = available_cores()
+        if num_workers is None:
+            num_workers = max(1, min(physical_cores(), len(cores)) // threads_per_worker)
+        model.eval()
+        model.share_memory()
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = []
+        pin_cores = pin_cores and hasattr(os, "sched_setaffinity")
+        for i in range(num_workers):
+            worker_cores = None
+            if pin_cores:
+                first = i * threads_per_worker
+                worker_cores = {cores[c % len(cores)] for c in range(first, first + threads_per_worker)}
+            worker = ctx.Process(
+                target=_worker, args=(model, self.tasks, self.results, threads_per_worker, worker_cores), daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+        self.futures = {}
+        self.task_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.closing = False
+        self.broken = None
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _collect(self):
+        while True:
+            try:
+                task_id, result, error = self.results.get(timeout=1.0)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if task_id is None:
+                break
+            with self.lock:
+                future = self.futures.pop(task_id, None)
+            if future is None:
+                # already failed by _check_workers
+                continue
+            if error is not None:
+                future.set_exception(RuntimeError(f"CLAP inference worker failed:\n{error}"))
+            else:
+                future.set_result(result)
+
+    def _check_workers(self):
+        """A worker that died (killed, out of memory, failed to start) takes its task with it: fail every pending
+        future instead of leaving the callers waiting, and refuse new tasks."""
+        if self.closing or self.broken is not None:
+            return
+        dead = [worker for worker in self.workers if not worker.is_alive()]
+        if not dead:
+            return
+        with self.lock:
+            self.broken = f"CLAP inference worker {dead[0].pid} exited with code {dead[0].exitcode}"
+            futures, self.futures = self.futures, {}
+        for future in futures.values():
+            future.set_exception(RuntimeError(self.broken))
+
+    def submit(self, method, payload):
+        """Run `CLAP_Module.<method>(payload, use_tensor=False)` in a worker, returns a Future of its numpy result."""
+        future = Future()
+        task_id = next(self.task_ids)
+        with self.lock:
+            if self.broken is not None:
+                raise RuntimeError(self.broken)
+            self.futures[task_id] = future
+        self.tasks.put((task_id, method, payload))
+        return future
+
+    def map(self, method, items, batch_size):
+        """Split `items` into batches, run them on all workers and concatenate the results in order."""
+        futures = [self.submit(method, items[i:i + batch_size]) for i in range(0, len(items), batch_size)]
+        return np.concatenate([future.result() for future in futures])
+
+    def get_audio_embedding_from_filelist(self, x, batch_size=8):
+        return self.map("get_audio_embedding_from_filelist", list(x), batch_size)
+
+    def get_audio_embedding_from_data(self, x, batch_size=8):
+        return self.map("get_audio_embedding_from_data", np.asarray(x), batch_size)
+
+    def get_text_embedding(self, x, batch_size=64):
+        return self.map("get_text_embedding", list(x), batch_size)
+
+    def close(self):
+        self.closing = True
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put((None, None, None))
+        self.collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
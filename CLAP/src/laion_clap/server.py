@@ -0,0 +1,198 @@
+"""
+Micro-batching HTTP embedding service around CLAP_Module
+--------------------------------------------------------
+Concurrent requests are queued in asyncio and grouped into micro-batches, a batch runs as soon as it is full
+or its oldest request has waited max_wait_ms. Forward passes run one at a time on a dedicated thread, so the
+event loop keeps accepting requests meanwhile.
+
+Endpoints:
+    POST /embed/text        {"texts": [str, ...]} -> {"embeddings": [[float, ...], ...]}
+    POST /embed/audio       one 48 kHz mono clip, as raw float32 samples (application/octet-stream)
+                            or {"waveform": [float, ...]} -> {"embedding": [float, ...]}
+    GET  /metrics           p50/p95 latency, batch sizes and batch fill of each queue
+    POST /admin/checkpoint  {"ckpt": path} loads a checkpoint and swaps it in between two batches
+
+Example:
+    python -m laion_clap.server --ckpt 630k-audioset-best.pt --port 8080
+"""
+import argparse
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+try:
+    from aiohttp import web
+except ImportError as e:
+    raise ImportError("The embedding server needs aiohttp, install it with `pip install laion_clap[server]`.") from e
+
+from .hook import CLAP_Module
+
+
+class MicroBatcher:
+    """Group the items submitted from concurrent requests into batches for one CLAP_Module embedding method."""
+
+    def __init__(self, service, method, max_batch_size, max_wait_ms, window=1000):
+        self.service = service
+        self.method = method
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # created in start(), on the loop of the app (before Python 3.10 a queue binds to the loop current at creation)
+        self.queue = None
+        # latencies and batch sizes of the last `window` requests / batches
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.monotonic()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            items = [item for item, _, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(self.service.executor, self.service.embed, self.method, items)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.monotonic()
+            self.batch_sizes.append(len(batch))
+            for (_, future, start), embedding in zip(batch, embeddings):
+                self.latencies.append(now - start)
+                if not future.done():
+                    future.set_result(embedding)
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        batch_sizes = np.array(self.batch_sizes)
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "latency_p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            "mean_batch_size": float(batch_sizes.mean()) if len(batch_sizes) else None,
+            "batch_fill": float(batch_sizes.mean() / self.max_batch_size) if len(batch_sizes) else None,
+        }
+
+
+class EmbeddingService:
+    def __init__(self, model_kwargs, ckpt=None, max_batch_size=32, max_wait_ms=10):
+        self.model_kwargs = model_kwargs
+        self.model = self.load_model(ckpt)
+        self.ckpt = ckpt
+        # one forward at a time, checkpoints are loaded on a separate thread to keep serving meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clap-inference")
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clap-loader")
+        self.swap_lock = None  # created in on_startup, on the loop of the app
+        self.batchers = {
+            "text": MicroBatcher(self, "get_text_embedding", max_batch_size, max_wait_ms),
+            "audio": MicroBatcher(self, "get_audio_embedding_from_data", max_batch_size, max_wait_ms),
+        }
+
+    def load_model(self, ckpt):
+        model = CLAP_Module(**self.model_kwargs)
+        model.load_ckpt(ckpt, verbose=False)
+        model.eval()
+        return model
+
+    def embed(self, method, items):
+        # the model is read once per batch, a swap takes effect from the next batch on
+        model = self.model
+        with torch.no_grad():
+            return getattr(model, method)(items, use_tensor=False)
+
+    async def on_startup(self, app):
+        self.swap_lock = asyncio.Lock()
+        for batcher in self.batchers.values():
+            batcher.start()
+
+    async def embed_text(self, request):
+        texts = (await request.json())["texts"]
+        if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+            raise web.HTTPBadRequest(text='"texts" should be a list of strings.')
+        embeddings = await asyncio.gather(*[self.batchers["text"].submit(t) for t in texts])
+        return web.json_response({"embeddings": [e.tolist() for e in embeddings]})
+
+    async def embed_audio(self, request):
+        if request.content_type == "application/octet-stream":
+            waveform = np.frombuffer(await request.read(), dtype=np.float32)
+        else:
+            waveform = np.asarray((await request.json())["waveform"], dtype=np.float32)
+        if waveform.ndim != 1 or len(waveform) == 0:
+            raise web.HTTPBadRequest(text="Expected one non-empty mono clip.")
+        embedding = await self.batchers["audio"].submit(waveform)
+        return web.json_response({"embedding": embedding.tolist()})
+
+    async def metrics(self, request):
+        metrics = {name: batcher.metrics() for name, batcher in self.batchers.items()}
+        metrics["ckpt"] = self.ckpt
+        return web.json_response(metrics)
+
+    async def swap_checkpoint(self, request):
+        ckpt = (await request.json())["ckpt"]
+        async with self.swap_lock:
+            start = time.time()
+            model = await asyncio.get_running_loop().run_in_executor(self.loader, self.load_model, ckpt)
+            self.model, self.ckpt = model, ckpt
+        logging.info(f"Swapped in checkpoint {ckpt} in {time.time() - start:.1f} s")
+        return web.json_response({"ckpt": ckpt, "load_sec": time.time() - start})
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.on_startup.append(self.on_startup)
+        app.add_routes([
+            web.post("/embed/text", self.embed_text),
+            web.post("/embed/audio", self.embed_audio),
+            web.get("/metrics", self.metrics),
+            web.post("/admin/checkpoint", self.swap_checkpoint),
+        ])
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching CLAP embedding server.")
+    parser.add_argument("--ckpt", type=str, default=None, help="Checkpoint to serve, the best paper ckpt if not set.")
+    parser.add_argument("--amodel", type=str, default="HTSAT-tiny")
+    parser.add_argument("--enable-fusion", default=False, action="store_true")
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"])
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=10,
+                        help="Latency budget a request may wait for its micro-batch to fill.")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads of the forward passes.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model_kwargs = dict(enable_fusion=args.enable_fusion, device=args.device, amodel=args.amodel, quantize=args.quantize)
+    service = EmbeddingService(model_kwargs, args.ckpt, args.max_batch_size, args.max_wait_ms)
+    web.run_app(service.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
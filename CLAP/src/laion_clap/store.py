@@ -0,0 +1,324 @@
+"""
+Append-only store of CLAP embeddings with a columnar metadata sidecar
+---------------------------------------------------------------------
+Embeddings are fixed-size float16/float32 rows in .npy shard files of `shard_rows` rows each, preallocated and
+memory-mapped, so row i is a view into shard i // shard_rows: random access is O(1) and contiguous ranges are
+read without copies. Each metadata column is a flat binary file next to them, string columns (paths, species,
+...) are dictionary-encoded as int32 codes plus a vocabulary of JSON lines.
+
+Writers in any number of processes append under an exclusive file lock. Rows, codes and new vocabulary
+entries are written first and store.json, which holds the number of rows, is replaced last: readers only
+ever see committed rows, and the leftovers of a crashed writer are overwritten by the next append.
+
+Layout:
+    <path>/store.json               dim, dtype, shard_rows, columns, committed rows and vocabulary sizes
+    <path>/shards/<i>.npy           (shard_rows, dim) embeddings of rows [i * shard_rows, (i + 1) * shard_rows)
+    <path>/columns/<name>.bin       one int32 code / float / int64 per row
+    <path>/columns/<name>.vocab     values of a string column, one JSON string per line
+
+Example:
+    store = EmbeddingStore.create("bird_embeddings", dim=512)
+    store.append(model.get_audio_embedding_from_filelist(files), {"path": files, "checkpoint": ckpt})
+"""
+import json
+import os
+
+import numpy as np
+
+from .fileio import write_json
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+COLUMN_DTYPES = {"str": np.int32, "float32": np.float32, "float64": np.float64, "int64": np.int64}
+MISSING_VALUES = {"str": "", "float32": np.nan, "float64": np.nan, "int64": -1}
+DEFAULT_COLUMNS = {
+    "path": "str",
+    "offset": "float32",
+    "duration": "float32",
+    "species": "str",
+    "source": "str",
+    "checkpoint": "str",
+}
+
+
+class EmbeddingStore:
+    def __init__(self, path):
+        """Open a store written by EmbeddingStore.create, call refresh() to see rows appended since
+
+        Parameters
+        ----------
+        path: str
+            directory of the store
+        """
+        self.path = path
+        self._shards = {}
+        self._vocab = {}
+        self._vocab_index = {}
+        self._vocab_bytes = {}
+        self.refresh()
+
+    @classmethod
+    def create(cls, path, dim=512, dtype="float16", shard_rows=1 << 20, columns=None):
+        """Create an empty store
+
+        Parameters
+        ----------
+        path: str
+            directory of the store, it must not exist yet
+        dim: int
+            embedding dimension
+        dtype: str
+            "float16" or "float32"
+        shard_rows: int
+            rows per shard file
+        columns: dict | None
+            metadata column name -> "str", "float32", "float64" or "int64", DEFAULT_COLUMNS if None
+        Returns
+        ----------
+        store: EmbeddingStore
+        """
+        if dtype not in ("float16", "float32"):
+            raise ValueError(f"dtype should be float16 or float32, got {dtype}.")
+        columns = dict(DEFAULT_COLUMNS if columns is None else columns)
+        for name, kind in columns.items():
+            if kind not in COLUMN_DTYPES:
+                raise ValueError(f"Unknown type {kind} of column {name}, expected one of {list(COLUMN_DTYPES)}.")
+        os.makedirs(os.path.join(path, "shards"))
+        os.makedirs(os.path.join(path, "columns"))
+        for name, kind in columns.items():
+            open(os.path.join(path, "columns", f"{name}.bin"), "wb").close()
+            if kind == "str":
+                open(os.path.join(path, "columns", f"{name}.vocab"), "wb").close()
+        open(os.path.join(path, "lock"), "wb").close()
+        write_json(os.path.join(path, "store.json"), {
+            "dim": dim,
+            "dtype": dtype,
+            "shard_rows": shard_rows,
+            "columns": columns,
+            "rows": 0,
+            "vocab_bytes": {name: 0 for name, kind in columns.items() if kind == "str"},
+        })
+        return cls(path)
+
+    def refresh(self):
+        """Re-read the number of committed rows and the new vocabulary entries."""
+        with open(os.path.join(self.path, "store.json")) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.shard_rows = self.meta["shard_rows"]
+        self.columns = self.meta["columns"]
+        self.rows = self.meta["rows"]
+        for name, nbytes in self.meta["vocab_bytes"].items():
+            self._read_vocab(name, nbytes)
+
+    def _read_vocab(self, name, nbytes):
+        vocab = self._vocab.setdefault(name, [])
+        index = self._vocab_index.setdefault(name, {})
+        start = self._vocab_bytes.get(name, 0)
+        if nbytes <= start:
+            return
+        with open(self._column_path(name, "vocab"), "rb") as f:
+            f.seek(start)
+            lines = f.read(nbytes - start).decode("utf-8").splitlines()
+        for value in map(json.loads, lines):
+            index[value] = len(vocab)
+            vocab.append(value)
+        self._vocab_bytes[name] = nbytes
+
+    def _column_path(self, name, ext="bin"):
+        return os.path.join(self.path, "columns", f"{name}.{ext}")
+
+    def _shard_path(self, i):
+        return os.path.join(self.path, "shards", f"{i:05d}.npy")
+
+    def _shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = np.load(self._shard_path(i), mmap_mode="r")
+        return self._shards[i]
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        """Embedding of row i, a view of its shard."""
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError(f"Row {i} out of range for a store of {self.rows} rows.")
+        return self._shard(i // self.shard_rows)[i % self.shard_rows]
+
+    def read(self, start=0, stop=None):
+        """Embeddings of rows [start, stop), a view if they lie in one shard, else a copy."""
+        stop = self.rows if stop is None else min(stop, self.rows)
+        parts = [part for _, part in self.chunks(start=start, stop=stop)]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.empty((0, self.dim), dtype=self.dtype)
+
+    def chunks(self, chunk_rows=None, start=0, stop=None):
+        """Yield (first row, view) over rows [start, stop) in chunks of at most `chunk_rows` within a shard."""
+        stop = self.rows if stop is None else min(stop, self.rows)
+        chunk_rows = chunk_rows or self.shard_rows
+        row = start
+        while row < stop:
+            shard, local = divmod(row, self.shard_rows)
+            size = min(chunk_rows, self.shard_rows - local, stop - row)
+            yield row, self._shard(shard)[local:local + size]
+            row += size
+
+    def take(self, rows):
+        """Embeddings of arbitrary rows, gathered shard by shard."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) and (rows.min() < 0 or rows.max() >= self.rows):
+            raise IndexError(f"Rows out of range for a store of {self.rows} rows.")
+        out = np.empty((len(rows), self.dim), dtype=self.dtype)
+        shards = rows // self.shard_rows
+        for shard in np.unique(shards):
+            mask = shards == shard
+            out[mask] = self._shard(shard)[rows[mask] % self.shard_rows]
+        return out
+
+    def column(self, name, decode=True):
+        """
+        Values of a metadata column for all rows, memory-mapped. String columns are decoded to an object
+        array, or returned as int32 codes into vocabulary(name) if decode is False.
+        """
+        kind = self.columns[name]
+        if self.rows == 0:
+            values = np.empty(0, dtype=COLUMN_DTYPES[kind])
+        else:
+            values = np.memmap(self._column_path(name), dtype=COLUMN_DTYPES[kind], mode="r", shape=(self.rows,))
+        return self._decode(name, values) if decode else values
+
+    def vocabulary(self, name):
+        """Distinct values of a string column, code i is vocabulary(name)[i]."""
+        return list(self._vocab[name])
+
+    def codes(self, name, values):
+        """Codes of values of a string column, -1 for values no row has."""
+        index = self._vocab_index[name]
+        return np.array([index.get(str(value), -1) for value in values], dtype=np.int64)
+
+    def metadata(self, rows):
+        """Metadata of some rows as a dict of column name -> array."""
+        rows = np.asarray(rows, dtype=np.int64)
+        return {name: self._decode(name, self.column(name, decode=False)[rows]) for name in self.columns}
+
+    def _decode(self, name, values):
+        if self.columns[name] != "str":
+            return np.asarray(values)
+        return np.asarray(self._vocab[name], dtype=object)[values]
+
+    def append(self, embeddings, metadata=None):
+        """Append rows, safe to call from several processes at once
+
+        Parameters
+        ----------
+        embeddings: np.ndarray (N, D)
+            embeddings, cast to the dtype of the store
+        metadata: dict | None
+            column name -> N values, or one value for all rows. Missing columns are "" for strings,
+            nan for floats and -1 for int64.
+        Returns
+        ----------
+        rows: np.ndarray (N,)
+            row numbers of the appended embeddings
+        """
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dim:
+            raise ValueError(f"Expected (N, {self.dim}) embeddings, got {embeddings.shape}.")
+        metadata = metadata or {}
+        unknown = set(metadata) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Unknown metadata columns {sorted(unknown)}, the store has {list(self.columns)}.")
+        n = len(embeddings)
+        if fcntl is None:
+            raise RuntimeError("Appending to an EmbeddingStore needs file locks (fcntl), which this platform lacks.")
+        # all the columns are checked before anything is written
+        columns = {name: self._check_column(name, kind, metadata.get(name, MISSING_VALUES[kind]), n)
+                   for name, kind in self.columns.items()}
+
+        with open(os.path.join(self.path, "lock"), "rb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # other processes may have appended since our last refresh
+                self.refresh()
+                start = self.rows
+                vocab_bytes = dict(self.meta["vocab_bytes"])
+                for name, values in columns.items():
+                    if self.columns[name] == "str":
+                        codes, vocab_bytes[name] = self._encode(name, values)
+                        values = np.asarray(codes, dtype=COLUMN_DTYPES["str"])
+                    self._write_column(name, values, start)
+                self._write_rows(embeddings, start)
+                meta = dict(self.meta, rows=start + n, vocab_bytes=vocab_bytes)
+                write_json(os.path.join(self.path, "store.json"), meta)
+                self.refresh()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return np.arange(start, start + n)
+
+    def _check_column(self, name, kind, values, n):
+        """The n values of a column: strings as a list of str, numbers as an array of the column dtype."""
+        if values is None:
+            raise ValueError(f"Column {name} is None, leave it out of the metadata to store missing values.")
+        if isinstance(values, str) or np.isscalar(values):
+            values = [values] * n
+        if not hasattr(values, "__len__"):
+            values = list(values)
+        if len(values) != n:
+            raise ValueError(f"Column {name} has {len(values)} values for {n} embeddings.")
+        if kind == "str":
+            return [str(value) for value in values]
+        try:
+            return np.asarray(values, dtype=COLUMN_DTYPES[kind])
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Column {name} of type {kind} has values that are not numbers.") from e
+
+    def _encode(self, name, values):
+        """Codes of string values, new values are written to the vocabulary (not yet committed)."""
+        index = self._vocab_index[name]
+        new = {}
+        codes = []
+        for value in values:
+            code = index.get(value)
+            if code is None:
+                code = new.setdefault(value, len(index) + len(new))
+            codes.append(code)
+        nbytes = self._vocab_bytes.get(name, 0)
+        with open(self._column_path(name, "vocab"), "r+b") as f:
+            f.truncate(nbytes)
+            f.seek(nbytes)
+            f.write("".join(json.dumps(value) + "\n" for value in new).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+            nbytes = f.tell()
+        return codes, nbytes
+
+    def _write_column(self, name, values, start):
+        with open(self._column_path(name), "r+b") as f:
+            f.truncate(start * values.itemsize)
+            f.seek(start * values.itemsize)
+            f.write(values.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_rows(self, embeddings, start):
+        done = 0
+        while done < len(embeddings):
+            shard, local = divmod(start + done, self.shard_rows)
+            size = min(len(embeddings) - done, self.shard_rows - local)
+            path = self._shard_path(shard)
+            if os.path.exists(path):
+                rows = np.lib.format.open_memmap(path, mode="r+")
+            else:
+                # preallocated (sparse) so the rows of a shard never move
+                rows = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(self.shard_rows, self.dim))
+            rows[local:local + size] = embeddings[done:done + size]
+            rows.flush()
+            del rows
+            done += size
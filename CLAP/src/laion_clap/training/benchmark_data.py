@@ -0,0 +1,217 @@
+"""
+Benchmark the webdataset loading pipeline of get_data, to size the CPUs needed per GPU.
+
+Measures the single-process cost of each stage (tar read, decode, get_audio_features, tokenize, collate),
+then the throughput of the real multi-worker dataloader for every --workers-sweep x --prefetch-sweep setting,
+with worker CPU utilization and peak RSS.
+
+Examples:
+    # the exact pipeline of a previous run
+    python -m training.benchmark_data --params-file logs/<name>/params.txt --workers-sweep 4 8 16
+    # synthetic shards generated locally, with any training arguments after the benchmark ones
+    python -m training.benchmark_data --synthetic-shards 8 --clip-seconds 60 --amodel HTSAT-tiny --batch-size 32
+"""
+import argparse
+import ast
+import io
+import json
+import logging
+import os
+import resource
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+import webdataset as wds
+
+from clap_module.factory import get_model_config
+from training.data import get_data, get_wds_dataset, decode_audio_crops, get_audio_features, select_text, \
+    tokenizer, collate_fn_with_preprocess, int16_to_float32_torch, float32_to_int16_torch
+from training.params import parse_args
+
+
+def parse_benchmark_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the CLAP webdataset pipeline. Unknown arguments are passed to the training parser."
+    )
+    parser.add_argument("--params-file", type=str, default=None,
+                        help="params.txt written by training/main.py, to rebuild the pipeline of that run.")
+    parser.add_argument("--synthetic-shards", type=int, default=0,
+                        help="Generate this many local shards of random audio instead of reading real data.")
+    parser.add_argument("--samples-per-shard", type=int, default=64)
+    parser.add_argument("--clip-seconds", type=float, default=30.0,
+                        help="Duration of the synthetic clips.")
+    parser.add_argument("--workers-sweep", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--prefetch-sweep", type=int, nargs="+", default=[2])
+    parser.add_argument("--num-batches", type=int, default=50,
+                        help="Number of batches to time for every dataloader setting.")
+    parser.add_argument("--stage-samples", type=int, default=64,
+                        help="Number of samples used to time the individual stages.")
+    return parser.parse_known_args()
+
+
+def load_params_file(args, path):
+    """Override `args` with the `name: value` lines of a params.txt."""
+    with open(path) as f:
+        for line in f:
+            name, _, val = line.rstrip("\n").partition(": ")
+            try:
+                val = ast.literal_eval(val)
+            except (ValueError, SyntaxError):
+                pass
+            setattr(args, name, val)
+    return args
+
+
+def make_synthetic_shards(root, num_shards, samples_per_shard, clip_seconds, sample_rate):
+    """Write shards of random flac clips and captions in the layout get_tar_path_from_dataset_name expects."""
+    split_dir = os.path.join(root, "synthetic", "train")
+    os.makedirs(split_dir, exist_ok=True)
+    sizes, durations = {}, {}
+    rng = np.random.default_rng(0)
+    for i in range(num_shards):
+        name = f"{i}.tar"
+        with tarfile.open(os.path.join(split_dir, name), "w") as tar:
+            for j in range(samples_per_shard):
+                key = f"{i:04d}{j:04d}"
+                audio = io.BytesIO()
+                sf.write(audio, rng.uniform(-0.5, 0.5, int(clip_seconds * sample_rate)), sample_rate, format="FLAC")
+                text = json.dumps({"text": [f"synthetic clip {key}"], "tag": ["synthetic"]}).encode("utf-8")
+                for ext, data in [("flac", audio.getvalue()), ("json", text)]:
+                    info = tarfile.TarInfo(f"{key}.{ext}")
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+        sizes[name] = samples_per_shard
+        durations[name] = [clip_seconds] * samples_per_shard
+    with open(os.path.join(split_dir, "sizes.json"), "w") as f:
+        json.dump(sizes, f)
+    with open(os.path.join(split_dir, "durations.json"), "w") as f:
+        json.dump(durations, f)
+
+
+def time_stages(args, model_cfg, shards, num_samples, max_len=480000):
+    """Single-process seconds per sample spent in each stage of the pipeline."""
+    audio_cfg = model_cfg["audio_cfg"]
+    stage_time = {}
+
+    start = time.time()
+    samples = []
+    for sample in wds.DataPipeline(wds.SimpleShardList(shards), wds.tarfile_to_samples()):
+        samples.append(sample)
+        if len(samples) == num_samples:
+            break
+    stage_time["tar read"] = time.time() - start
+
+    start = time.time()
+    decoded = list(wds.decode(wds.torch_audio, partial=True)(
+        decode_audio_crops(iter(samples), max_len, args.data_truncating)
+    ))
+    stage_time["decode"] = time.time() - start
+
+    start = time.time()
+    for sample in decoded:
+        audio_index = [key for key in sample if "flac" in key][0]
+        audio_data = int16_to_float32_torch(float32_to_int16_torch(sample[audio_index][0][0]))
+        get_audio_features({}, audio_data, max_len, args.data_truncating, args.data_filling, audio_cfg)
+    stage_time["get_audio_features"] = time.time() - start
+
+    start = time.time()
+    for sample in decoded:
+        json_index = [key for key in sample if "json" in key][0]
+        texts = select_text(sample[json_index], args.text_augment_selection)
+        tokenizer(texts[0] if isinstance(texts, list) else texts, tmodel=args.tmodel)
+    stage_time["tokenize"] = time.time() - start
+
+    # collate_fn_with_preprocess runs get_audio_features and the tokenizer again, count only the rest
+    start = time.time()
+    for i in range(0, len(decoded), args.batch_size):
+        collate_fn_with_preprocess([dict(sample) for sample in decoded[i:i + args.batch_size]],
+                                   "flac", "json", max_len, audio_cfg, args)
+    stage_time["collate"] = max(0.0, time.time() - start - stage_time["get_audio_features"] - stage_time["tokenize"])
+
+    return {k: v / max(1, len(decoded)) for k, v in stage_time.items()}, len(decoded)
+
+
+def time_dataloader(args, model_cfg, num_batches):
+    """Samples/sec of the training dataloader, with the CPU time and peak RSS of its workers."""
+    data = get_wds_dataset(args, model_cfg, is_train=True)
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    iterator = iter(data.dataloader)
+    next(iterator)  # exclude worker start-up
+    start = time.time()
+    num_samples = 0
+    for i, batch in enumerate(iterator):
+        num_samples += len(batch["waveform"])
+        if i + 1 == num_batches:
+            break
+    elapsed = time.time() - start
+    # shut the workers down, so their resource usage is accounted
+    del iterator
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = (usage.ru_utime + usage.ru_stime) - (usage_before.ru_utime + usage_before.ru_stime)
+    return {
+        "samples_per_sec": num_samples / elapsed,
+        "worker_utilization": cpu_time / (elapsed * max(1, args.workers)),
+        # ru_maxrss is in KB on Linux, and is the maximum over all workers started so far
+        "peak_worker_rss_mb": usage.ru_maxrss / 1024,
+        "peak_main_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    bench_args, train_argv = parse_benchmark_args()
+    args = parse_args(train_argv)
+    if bench_args.params_file is not None:
+        args = load_params_file(args, bench_args.params_file)
+    logging.basicConfig(level=logging.INFO)
+
+    args.distributed = False
+    args.horovod = False
+    args.rank, args.local_rank, args.world_size = 0, 0, 1
+    args.dataset_type = "webdataset"
+
+    model_cfg = get_model_config(args.amodel.replace("/", "-"))
+    assert model_cfg is not None, f"Unknown model config {args.amodel}"
+
+    tmp_dir = None
+    if bench_args.synthetic_shards:
+        tmp_dir = tempfile.TemporaryDirectory()
+        make_synthetic_shards(tmp_dir.name, bench_args.synthetic_shards, bench_args.samples_per_shard,
+                              bench_args.clip_seconds, model_cfg["audio_cfg"]["sample_rate"])
+        args.datasetpath = tmp_dir.name
+        args.datasetnames = ["synthetic"]
+        args.datasetinfos = ["train"]
+        args.remotedata = False
+        args.dataset_weights = None
+
+    # resolves the shard lists exactly as training does
+    get_data(args, model_cfg)
+
+    stage_time, n = time_stages(args, model_cfg, args.train_data, bench_args.stage_samples)
+    total = sum(stage_time.values())
+    print(f"Per-sample stage time on one core ({n} samples):")
+    for name, t in stage_time.items():
+        print(f"  {name:>20}: {t * 1000:8.2f} ms ({100 * t / total:5.1f}%)")
+    print(f"  {'total':>20}: {total * 1000:8.2f} ms -> {1 / total:.1f} samples/sec per core")
+
+    print("Dataloader throughput:")
+    for workers in bench_args.workers_sweep:
+        for prefetch_factor in bench_args.prefetch_sweep:
+            args.workers = workers
+            args.prefetch_factor = prefetch_factor
+            result = time_dataloader(args, model_cfg, bench_args.num_batches)
+            print(
+                f"  workers {workers:>3} prefetch {prefetch_factor:>2}: "
+                f"{result['samples_per_sec']:8.1f} samples/sec, "
+                f"worker utilization {100 * result['worker_utilization']:5.1f}%, "
+                f"peak RSS worker {result['peak_worker_rss_mb']:.0f} MB / main {result['peak_main_rss_mb']:.0f} MB"
+            )
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
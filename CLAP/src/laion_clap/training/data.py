@@ -1,7 +1,9 @@
 import ast
+import collections
 import json
 import logging
 import math
+import multiprocessing
 import os
 import random
 import h5py
@@ -22,11 +24,16 @@ from pathlib import Path
 import wget
 import tempfile
 import copy
+import heapq
+import io
 from contextlib import suppress
+import soundfile as sf
 
 from clap_module.utils import get_tar_path_from_dataset_name, dataset_split
 from clap_module.utils import load_p, load_class_label
 from clap_module import tokenize as clip_tokenizer
+from training.distributed import is_master
+from training.shard_cache import ShardCache, cached_tarfile_to_samples
 from transformers import BertTokenizer
 from transformers import RobertaTokenizer
 from transformers import BartTokenizer
@@ -109,8 +116,62 @@ def float32_to_int16_torch(x):
 
 
 # For Toy Dataset
+class H5FilePool:
+    """
+    Read-only h5py file handles cached by path, at most `max_open` at a time (least recently used closed first).
+    Handles are opened lazily in the process that reads them: a pool copied into a forked dataloader
+    worker drops the parent's handles and reopens its own, since h5py handles are not fork-safe.
+    With chunk_aligned=True, read_row reads the whole HDF5 chunk holding a row and keeps the last chunk
+    of each file, so rows stored next to each other are decoded once.
+    """
+
+    def __init__(self, max_open=16, chunk_aligned=False):
+        self.max_open = max_open
+        self.chunk_aligned = chunk_aligned
+        self.pid = None
+        self.files = collections.OrderedDict()
+        self.chunks = {}
+
+    def get(self, path):
+        if self.pid != os.getpid():
+            # inherited from the parent process, do not touch (or close) its handles
+            self.pid = os.getpid()
+            self.files = collections.OrderedDict()
+            self.chunks = {}
+        f = self.files.get(path)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                old_path, old_f = self.files.popitem(last=False)
+                self.chunks.pop(old_path, None)
+                old_f.close()
+            f = h5py.File(path, "r")
+            self.files[path] = f
+        else:
+            self.files.move_to_end(path)
+        return f
+
+    def read_row(self, path, key, idx):
+        dset = self.get(path)[key]
+        if not self.chunk_aligned or dset.chunks is None or dset.chunks[0] == 1:
+            return dset[idx]
+        rows = dset.chunks[0]
+        start = idx // rows * rows
+        cached = self.chunks.get((path, key))
+        if cached is None or cached[0] != start:
+            cached = (start, dset[start:start + rows])
+            self.chunks[(path, key)] = cached
+        return cached[1][idx - start]
+
+    def __getstate__(self):
+        # handles cannot be pickled (e.g. into spawned workers), they are reopened on use
+        state = self.__dict__.copy()
+        state.update(pid=None, files=collections.OrderedDict(), chunks={})
+        return state
+
+
 class ToyDataset(Dataset):
-    def __init__(self, index_path, ipc, config, eval_mode=False):
+    def __init__(self, index_path, ipc, config, eval_mode=False, max_open_files=16, chunk_aligned=False,
+                 mel_cache_size=1024):
         """Toy Dataset for testing the audioset input with text labels
         Parameters
         ----------
@@ -121,10 +182,22 @@ class ToyDataset(Dataset):
             config: dict
                 the audio cfg file
            eval_model (bool): to indicate if the dataset is a testing dataset
+            max_open_files: int
+                the number of hdf5 files kept open by each worker
+            chunk_aligned: bool
+                read whole hdf5 chunks and reuse them for neighbouring waveforms
+            mel_cache_size: int
+                the number of mel spectrograms cached by each worker
         """
         self.audio_cfg = config["audio_cfg"]
         self.text_cfg = config["text_cfg"]
-        self.fp = h5py.File(index_path, "r")
+        self.index_path = index_path
+        self.h5_pool = H5FilePool(max_open=max_open_files, chunk_aligned=chunk_aligned)
+        # AudioSet targets and clips repeat across epochs, cache their text and mel per worker
+        self.text_cache = {}
+        self.mel_cache = collections.OrderedDict()
+        self.mel_cache_size = mel_cache_size
+        self.fp = self.h5_pool.get(index_path)
         self.ipc = np.load(ipc, allow_pickle=True)
         self.total_size = len(self.fp["audio_name"])
         self.classes_num = self.audio_cfg["class_num"]
@@ -166,11 +239,26 @@ class ToyDataset(Dataset):
         return x[crop_pos: crop_pos + crop_size]
 
     def prompt_text(self, target):
-        events = _AUDIOSET_MAP[np.where(target > 0)]
-        event_text = "The sounds of " + ", ".join(events[:-1]) + " and " + events[-1]
-        text = tokenizer(event_text)[0]
+        event_idx = tuple(np.where(target > 0)[0])
+        text = self.text_cache.get(event_idx)
+        if text is None:
+            events = _AUDIOSET_MAP[list(event_idx)]
+            event_text = "The sounds of " + ", ".join(events[:-1]) + " and " + events[-1]
+            text = tokenizer(event_text)[0]
+            self.text_cache[event_idx] = text
         return text
 
+    def get_mel(self, s_index, waveform):
+        mel = self.mel_cache.get(s_index)
+        if mel is None:
+            mel = get_mel(torch.from_numpy(waveform), self.audio_cfg).cpu().numpy()
+            self.mel_cache[s_index] = mel
+            if len(self.mel_cache) > self.mel_cache_size:
+                self.mel_cache.popitem(last=False)
+        else:
+            self.mel_cache.move_to_end(s_index)
+        return mel
+
     def __getitem__(self, index):
         """Load waveform, text, and target of an audio clip
 
@@ -191,6 +279,8 @@ class ToyDataset(Dataset):
                 the output dictionary
         """
         s_index = self.queue[index]
+        # reopened lazily after the dataloader forks its workers
+        self.fp = self.h5_pool.get(self.index_path)
 
         audio_name = self.fp["audio_name"][s_index].decode()
         # Hardcode here CHANGE
@@ -205,10 +295,9 @@ class ToyDataset(Dataset):
         r_idx = self.fp["index_in_hdf5"][s_index]
         target = self.fp["target"][s_index].astype(np.float32)
         text = self.prompt_text(target)
-        with h5py.File(hdf5_path, "r") as f:
-            waveform = int16_to_float32(f["waveform"][r_idx])[
-                       : self.audio_cfg["clip_samples"]
-                       ]
+        waveform = int16_to_float32(self.h5_pool.read_row(hdf5_path, "waveform", r_idx))[
+                   : self.audio_cfg["clip_samples"]
+                   ]
         assert (
                 len(waveform) == self.audio_cfg["clip_samples"]
         ), "The sample length is not match"
@@ -229,8 +318,8 @@ class ToyDataset(Dataset):
         #             target[add_key] = 1.0
 
         # missing the text input
-        mel_spec = get_mel(torch.from_numpy(waveform), self.audio_cfg)[None, :, :]
-        mel_spec = torch.cat([mel_spec, mel_spec.clone(), mel_spec.clone(), mel_spec.clone()], dim=0).cpu().numpy()
+        mel_spec = self.get_mel(s_index, waveform)
+        mel_spec = np.stack([mel_spec, mel_spec, mel_spec, mel_spec], axis=0)
         longer = random.choice([True, False])
         if longer == False:
             mel_spec[1:, :, :] = 0.0
@@ -308,6 +397,115 @@ def get_dataset_size(shards, sizefilepath_=None, is_local=True):
         return total_size, num_shards
 
 
+def get_shard_sizes(shards, sizefilepath_=None, is_local=True):
+    """
+    Return a dict from each shard url in `shards` to its number of samples, read from the sizes.json files
+    in the same way as get_dataset_size.
+    """
+    loaded = {}
+    shard_sizes = {}
+    for shard in shards:
+        sizefilepath = get_sizes_file(shard, sizefilepath_, is_local)
+        if sizefilepath not in loaded:
+            loaded[sizefilepath] = json.load(open(sizefilepath, "r"))
+        shard_sizes[shard] = int(loaded[sizefilepath][os.path.basename(shard.replace(".tar -", ".tar"))])
+    return shard_sizes
+
+
+def get_sizes_file(shard, sizefilepath_=None, is_local=True):
+    """Path of the sizes.json describing `shard`, looked up as in get_dataset_size."""
+    if not is_local:
+        for n in dataset_split.keys():
+            if n in shard.split("/"):
+                break
+        for s in dataset_split[n]:
+            if s in shard.split("/"):
+                break
+        return f"./json_files/{n}/{s}/sizes.json"
+    if sizefilepath_ is not None:
+        return sizefilepath_
+    return os.path.join(os.path.dirname(shard), "sizes.json")
+
+
+def get_num_crops(shards, num_crops, max_len, sample_rate, sizefilepath_=None, is_local=True):
+    """
+    Number of samples decode_audio_crops emits over `shards`, from the per-clip durations (in seconds)
+    of the durations.json next to each sizes.json: {shard: [duration, ...]}. A clip of `frames` samples
+    yields min(num_crops, frames // max_len) crops, at least one. Return None if a durations file is missing.
+    """
+    loaded = {}
+    total = 0
+    for shard in shards:
+        durationfilepath = os.path.join(os.path.dirname(get_sizes_file(shard, sizefilepath_, is_local)), "durations.json")
+        if durationfilepath not in loaded:
+            if not os.path.exists(durationfilepath):
+                return None
+            loaded[durationfilepath] = json.load(open(durationfilepath, "r"))
+        durations = np.asarray(loaded[durationfilepath][os.path.basename(shard.replace(".tar -", ".tar"))])
+        frames = (durations * sample_rate).astype(np.int64)
+        total += int(np.clip(frames // max_len, 1, num_crops).sum())
+    return total
+
+
+def balance_shards(shards, shard_sizes, num_slots, seed):
+    """
+    Assign shards to `num_slots` slots so that the slots hold about the same number of samples.
+    Shards are shuffled with `seed`, then placed largest first on the currently lightest slot
+    (greedy bin-packing). Return a list with the shards of each slot, in shuffled order.
+    """
+    rng = random.Random(seed)
+    shards = list(shards)
+    rng.shuffle(shards)
+    order = {shard: i for i, shard in enumerate(shards)}
+    heap = [(0, slot) for slot in range(num_slots)]
+    slots = [[] for _ in range(num_slots)]
+    # stable sort, so shards of the same size keep their shuffled order
+    for shard in sorted(shards, key=lambda x: -shard_sizes[x]):
+        load, slot = heapq.heappop(heap)
+        slots[slot].append(shard)
+        heapq.heappush(heap, (load + shard_sizes[shard], slot))
+    return [sorted(slot_shards, key=order.get) for slot_shards in slots]
+
+
+class split_by_size:
+    """
+    Replacement for wds.detshuffle + wds.split_by_node + wds.split_by_worker that gives each
+    (node, worker) slot shards holding about the same number of samples, instead of dealing them
+    round-robin. The assignment is deterministic given the seed and epoch, so all processes agree on it.
+    """
+
+    def __init__(self, shard_sizes, seed=0):
+        self.shard_sizes = shard_sizes
+        self.seed = seed
+        self.epoch = -1
+
+    def __call__(self, src):
+        self.epoch += 1
+        rank, world_size, worker, num_workers = wds.utils.pytorch_worker_info()
+        shards = [sample["url"] for sample in src]
+        slots = balance_shards(shards, self.shard_sizes, world_size * num_workers, f"{self.seed}-{self.epoch}")
+        for url in slots[rank * num_workers + worker]:
+            yield dict(url=url)
+
+
+def log_shard_balance(shards, shard_sizes, world_size, num_workers, seed):
+    """Log the per-rank sample imbalance of round-robin shard splitting and of split_by_size."""
+    num_slots = world_size * num_workers
+    # what wds.split_by_node followed by wds.split_by_worker deals to each slot
+    round_robin = [
+        shards[rank::world_size][worker::num_workers] for rank in range(world_size) for worker in range(num_workers)
+    ]
+    balanced = balance_shards(shards, shard_sizes, num_slots, f"{seed}-0")
+    for name, slots in [("round-robin", round_robin), ("size-balanced", balanced)]:
+        slot_sizes = [sum(shard_sizes[shard] for shard in slot) for slot in slots]
+        rank_sizes = [sum(slot_sizes[r * num_workers:(r + 1) * num_workers]) for r in range(world_size)]
+        logging.info(
+            f"{name} shard split: samples per rank min {min(rank_sizes)} / max {max(rank_sizes)} "
+            f"(imbalance {max(rank_sizes) / max(1, np.mean(rank_sizes)):.3f}), "
+            f"per worker min {min(slot_sizes)} / max {max(slot_sizes)}"
+        )
+
+
 def count_samples(dataloader):
     os.environ["WDS_EPOCH"] = "0"
     n_elements, n_batches = 0, 0
@@ -399,7 +597,35 @@ def get_mel(audio_data, audio_cfg):
     return mel.T  # (T, n_mels)
 
 
-def get_audio_features(sample, audio_data, max_len, data_truncating, data_filling, audio_cfg, require_grad=False):
+def fusion_chunk_offsets(total_frames, chunk_frames):
+    """Random start frames of the front, middle and back chunks of a "fusion" mel."""
+    ranges = np.array_split(list(range(0, total_frames - chunk_frames + 1)), 3)
+    if len(ranges[1]) == 0:
+        # if the audio is too short, we just use the first chunk
+        ranges[1] = [0]
+    if len(ranges[2]) == 0:
+        # if the audio is too short, we just use the first chunk
+        ranges[2] = [0]
+    # randomly choose index for each part
+    return [np.random.choice(ranges[0]), np.random.choice(ranges[1]), np.random.choice(ranges[2])]
+
+
+def add_fusion_waveform(sample, audio_data, num_frames, offsets, audio_cfg):
+    """
+    Add what MelFusion needs to build the "mel_fusion" of this sample on the training device:
+    the clip reflect-padded as the centered STFT of get_mel pads it, the number of mel frames the
+    global view is shrunk from, and the start frames of the three chunks.
+    The clip is shipped as int16, which is lossless as audio_data went through float32_to_int16_torch.
+    """
+    pad = audio_cfg['window_size'] // 2
+    padded = F.pad(audio_data[None, None], (pad, pad), mode="reflect")[0, 0]
+    sample["fusion_waveform"] = torch.round(padded * 32767.).type(torch.int16)
+    sample["fusion_frames"] = torch.tensor([num_frames])
+    sample["fusion_offsets"] = torch.tensor([int(offset) for offset in offsets])
+
+
+def get_audio_features(sample, audio_data, max_len, data_truncating, data_filling, audio_cfg, require_grad=False,
+                       fusion_on_device=False):
     """
     Calculate and add audio features to sample.
     Sample: a dict containing all the data of current sample.
@@ -410,12 +636,25 @@ def get_audio_features(sample, audio_data, max_len, data_truncating, data_fillin
     audio_cfg: a dict containing audio configuration. Comes from model_cfg['audio_cfg'].
     require_grad: whether to require gradient for audio data.
         This is useful when we want to apply gradient-based classifier-guidance.
+    fusion_on_device: with "fusion", only draw the chunk offsets and add the inputs of MelFusion
+        instead of computing "mel_fusion" here.
     """
     grad_fn = suppress if require_grad else torch.no_grad
     with grad_fn():
         if len(audio_data) > max_len:
             if data_truncating == "rand_trunc":
                 longer = torch.tensor([True])
+            elif data_truncating == "fusion" and fusion_on_device:
+                chunk_frames = max_len // audio_cfg['hop_size'] + 1
+                total_frames = len(audio_data) // audio_cfg['hop_size'] + 1
+                if chunk_frames == total_frames:
+                    # same corner case as below, the four mels are the whole audio
+                    add_fusion_waveform(sample, audio_data, chunk_frames, [0, 0, 0], audio_cfg)
+                    longer = torch.tensor([False])
+                else:
+                    offsets = fusion_chunk_offsets(total_frames, chunk_frames)
+                    add_fusion_waveform(sample, audio_data, total_frames, offsets, audio_cfg)
+                    longer = torch.tensor([True])
             elif data_truncating == "fusion":
                 # fusion
                 mel = get_mel(audio_data, audio_cfg)
@@ -430,21 +669,7 @@ def get_audio_features(sample, audio_data, max_len, data_truncating, data_fillin
                     sample["mel_fusion"] = mel_fusion
                     longer = torch.tensor([False])
                 else:
-                    ranges = np.array_split(list(range(0, total_frames - chunk_frames + 1)), 3)
-                    # print('total_frames-chunk_frames:', total_frames-chunk_frames,
-                    #       'len(audio_data):', len(audio_data),
-                    #       'chunk_frames:', chunk_frames,
-                    #       'total_frames:', total_frames)
-                    if len(ranges[1]) == 0:
-                        # if the audio is too short, we just use the first chunk
-                        ranges[1] = [0]
-                    if len(ranges[2]) == 0:
-                        # if the audio is too short, we just use the first chunk
-                        ranges[2] = [0]
-                    # randomly choose index for each part
-                    idx_front = np.random.choice(ranges[0])
-                    idx_middle = np.random.choice(ranges[1])
-                    idx_back = np.random.choice(ranges[2])
+                    idx_front, idx_middle, idx_back = fusion_chunk_offsets(total_frames, chunk_frames)
                     # select mel
                     mel_chunk_front = mel[idx_front:idx_front + chunk_frames, :]
                     mel_chunk_middle = mel[idx_middle:idx_middle + chunk_frames, :]
@@ -494,7 +719,9 @@ def get_audio_features(sample, audio_data, max_len, data_truncating, data_fillin
                     raise NotImplementedError(
                         f"data_filling {data_filling} not implemented"
                     )
-            if data_truncating == 'fusion':
+            if data_truncating == 'fusion' and fusion_on_device:
+                add_fusion_waveform(sample, audio_data, max_len // audio_cfg['hop_size'] + 1, [0, 0, 0], audio_cfg)
+            elif data_truncating == 'fusion':
                 mel = get_mel(audio_data, audio_cfg)
                 mel_fusion = torch.stack([mel, mel, mel, mel], dim=0)
                 sample["mel_fusion"] = mel_fusion
@@ -506,6 +733,98 @@ def get_audio_features(sample, audio_data, max_len, data_truncating, data_fillin
     return sample
 
 
+class MelFusion:
+    """
+    Build the "mel_fusion" input of a batch collated with --fusion-on-device, on the training device.
+    The dataloader workers only ship the padded clips, frame counts and chunk offsets of add_fusion_waveform.
+    Here one STFT computes the mels of the whole batch, one gather picks the three chunks and one
+    batched bilinear resize shrinks the global views, matching the "fusion" branch of get_audio_features
+    (torchvision Resize of tensors does not antialias by default, neither does this resize).
+    """
+
+    def __init__(self, audio_cfg, max_len):
+        self.audio_cfg = audio_cfg
+        self.chunk_frames = max_len // audio_cfg['hop_size'] + 1
+        self.mel_tf = {}
+
+    def get_mel(self, waveform):
+        """Log mel of (B, T) reflect-padded clips, (B, frames, n_mels), same as get_mel frame by frame."""
+        if waveform.device not in self.mel_tf:
+            self.mel_tf[waveform.device] = torchaudio.transforms.MelSpectrogram(
+                sample_rate=self.audio_cfg['sample_rate'],
+                n_fft=self.audio_cfg['window_size'],
+                win_length=self.audio_cfg['window_size'],
+                hop_length=self.audio_cfg['hop_size'],
+                # the clips are padded by add_fusion_waveform, so the zero padding of shorter clips
+                # in the batch never leaks into their frames
+                center=False,
+                power=2.0,
+                norm=None,
+                onesided=True,
+                n_mels=self.audio_cfg['mel_bins'],
+                f_min=self.audio_cfg['fmin'],
+                f_max=self.audio_cfg['fmax']
+            ).to(waveform.device)
+        mel = self.mel_tf[waveform.device](waveform)
+        mel = torchaudio.transforms.AmplitudeToDB(top_db=None)(mel)
+        return mel.transpose(1, 2)
+
+    def __call__(self, batch, device):
+        with torch.no_grad():
+            waveform = int16_to_float32_torch(batch.pop("fusion_waveform").to(device=device, non_blocking=True))
+            num_frames = batch.pop("fusion_frames").to(device=device, non_blocking=True).view(-1, 1)
+            offsets = batch.pop("fusion_offsets").to(device=device, non_blocking=True)
+            mel = self.get_mel(waveform)
+            rows = torch.arange(mel.shape[0], device=device)[:, None]
+            frames = torch.arange(self.chunk_frames, device=device)
+            chunks = mel[rows[:, :, None], offsets[:, :, None] + frames]  # B, 3, chunk_frames, n_mels
+            # bilinear (align_corners=False) resize of the first num_frames frames to chunk_frames
+            src = ((frames + 0.5) * (num_frames / self.chunk_frames) - 0.5).clamp(min=0)
+            lo = src.long()
+            hi = torch.minimum(lo + 1, num_frames - 1)
+            weight = (src - lo)[:, :, None]
+            shrink = mel[rows, lo] * (1 - weight) + mel[rows, hi] * weight  # B, chunk_frames, n_mels
+            batch["mel_fusion"] = torch.cat([shrink[:, None], chunks], dim=1)
+        return batch
+
+
+def decode_audio_crops(data, max_len, data_truncating, num_crops=1):
+    """
+    Decode the flac of each webdataset sample, reading only the parts that get_audio_features would keep.
+    For "rand_trunc", crop offsets are drawn from the header duration and only those windows are decoded
+    by seeking in the in-memory flac. With num_crops=1 the offset is drawn exactly as get_audio_features
+    draws it. With num_crops > 1, a clip of at least k * max_len frames (k <= num_crops) yields k
+    non-overlapping crops at jittered offsets, each emitted as its own sample with the same caption.
+    "fusion" needs the whole clip for its shrunk global view, so it is decoded in full.
+    The decoded value has the same (waveform, sample_rate) format as wds.torch_audio.
+    """
+    for sample in data:
+        audio_index = [key for key in sample if "flac" in key][0]
+        with io.BytesIO(sample[audio_index]) as f:
+            info = sf.info(f)
+            if data_truncating != "rand_trunc" or info.frames <= max_len:
+                f.seek(0)
+                audio_data, orig_sr = sf.read(f, dtype="float32", always_2d=True)
+                sample[audio_index] = (torch.from_numpy(audio_data.T), orig_sr)
+                yield sample
+                continue
+
+            n_crops = max(1, min(num_crops, info.frames // max_len))
+            overflow = info.frames - n_crops * max_len
+            # spread the leftover frames randomly between the crops
+            offsets = np.sort(np.random.randint(0, overflow + 1, size=n_crops))
+            for i, offset in enumerate(offsets):
+                start = i * max_len + offset
+                f.seek(0)
+                audio_data, orig_sr = sf.read(f, start=start, stop=start + max_len, dtype="float32", always_2d=True)
+                crop = dict(sample)
+                crop[audio_index] = (torch.from_numpy(audio_data.T), orig_sr)
+                crop["audio_truncated"] = True
+                if n_crops > 1:
+                    crop["__key__"] = f"{sample['__key__']}_crop{i}"
+                yield crop
+
+
 def select_text(json_dict_raw, text_augment_selection):
     # For selecting augmented text from dataset
     if text_augment_selection is None or text_augment_selection == "none":
@@ -536,10 +855,11 @@ def preprocess_single(
         max_len,
         audio_cfg,
         tmodel,
-        class_index_dict,
+        label_encoder,
         data_filling,
         data_truncating,
         text_augment_selection,
+        fusion_on_device=False,
 ):
     """
     Preprocess a single sample for wdsdataloader.
@@ -551,8 +871,13 @@ def preprocess_single(
 
     audio_data, orig_sr = sample[audio_index]
     audio_data = int16_to_float32_torch(float32_to_int16_torch(audio_data[0]))
+    # set by decode_audio_crops when the clip was already cropped to max_len at decode time
+    audio_truncated = sample.pop("audio_truncated", False)
 
-    sample = get_audio_features(sample, audio_data, max_len, data_truncating, data_filling, audio_cfg)
+    sample = get_audio_features(sample, audio_data, max_len, data_truncating, data_filling, audio_cfg,
+                                fusion_on_device=fusion_on_device)
+    if audio_truncated:
+        sample["longer"] = torch.tensor([True])
     del sample[audio_index]
 
     json_dict_raw = sample[json_index]
@@ -565,19 +890,9 @@ def preprocess_single(
         # texts = random.choice(texts) #for train
     sample["raw_text"] = texts
     sample["text"] = tokenizer(texts, tmodel=tmodel)  # text shape: [num_token]
-    if class_index_dict is not None:
-        # https://stackoverflow.com/questions/48004243/how-to-share-large-read-only-dictionary-list-across-processes-in-multiprocessing
-        # https://stackoverflow.com/questions/45693949/storing-strings-in-a-multiprocessing-sharedctypes-array
-
-        # in case the re-written version is wrong, here is the old version:
-        # sample["class_label"] = np.zeros(len(class_index_dict.keys()))
-        # for x in json_dict_raw["tag"]:
-        #     sample["class_label"][class_index_dict[x]] = 1
-        # sample["class_label"] = torch.tensor(sample["class_label"]).float()
-
-        class_labels = np.zeros(len(class_index_dict))
-        class_labels[np.in1d(list(class_index_dict.keys()), json_dict_raw["tag"])] = 1
-        sample["class_label"] = torch.tensor(class_labels).float()
+    if label_encoder is not None:
+        # encoded for the whole batch at once in collate_fn_with_preprocess
+        sample["tag"] = json_dict_raw["tag"]
 
     del sample[json_index]
     sample["audio_name"] = sample["__key__"].split("/")[-1] + "." + audio_ext
@@ -586,36 +901,124 @@ def preprocess_single(
     return sample
 
 
+class ClassLabelEncoder:
+    """
+    Multi-hot encoder for the "tag" field of webdataset samples.
+    Built once from class_index_dict and only read afterwards, so dataloader workers share it
+    without copying. The class of a tag is the position of its key in class_index_dict.
+    """
+
+    def __init__(self, class_index_dict):
+        keys = np.array(list(class_index_dict.keys()))
+        self.order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[self.order]
+        self.order.flags.writeable = False
+        self.sorted_keys.flags.writeable = False
+
+    def __len__(self):
+        return len(self.sorted_keys)
+
+    def encode_batch(self, batch_tags, out=None):
+        """
+        batch_tags: a list with the tag list (or single tag) of each sample.
+        out: an optional float tensor of shape (len(batch_tags), num_classes) to write into.
+        Return a float tensor of shape (len(batch_tags), num_classes); unknown tags are ignored.
+        """
+        batch_tags = [[tags] if isinstance(tags, str) else tags for tags in batch_tags]
+        if out is None:
+            class_labels = torch.zeros(len(batch_tags), len(self))
+        else:
+            class_labels = out.zero_()
+        tags = np.array([tag for sample_tags in batch_tags for tag in sample_tags], dtype=str)
+        if not len(tags) or not len(self):
+            return class_labels
+        rows = np.repeat(np.arange(len(batch_tags)), [len(sample_tags) for sample_tags in batch_tags])
+        pos = np.minimum(np.searchsorted(self.sorted_keys, tags), len(self) - 1)
+        found = self.sorted_keys[pos] == tags
+        class_labels[torch.from_numpy(rows[found]), torch.from_numpy(self.order[pos[found]])] = 1
+        return class_labels
+
+
+class BatchBuffers:
+    """
+    Batch tensors reused across batches by one dataloader worker.
+    Each key gets a ring of `depth` buffers, allocated on first use from the shape of the first batch.
+    A batch is only valid until the ring wraps around, so `depth` must be larger than the number of
+    batches in flight (the prefetch_factor of the dataloader) plus the one being consumed.
+    The DataLoader moves the buffers to shared memory the first time they are sent, after which every
+    batch reuses the same shared storage instead of allocating a new one.
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.slot = 0
+        self.buffers = {}
+
+    def get(self, key, sample_shape, dtype, batch_size):
+        """Return the current buffer for `key`, as a (batch_size, *sample_shape) view."""
+        ring = self.buffers.get(key)
+        if ring is None or ring[0].shape[1:] != sample_shape or ring[0].dtype != dtype \
+                or ring[0].shape[0] < batch_size:
+            ring = [torch.empty((batch_size, *sample_shape), dtype=dtype) for _ in range(self.depth)]
+            self.buffers[key] = ring
+        return ring[self.slot][:batch_size]
+
+    def advance(self):
+        self.slot = (self.slot + 1) % self.depth
+
+
+def stack_into(tensors, batch_buffers, key):
+    """torch.stack `tensors`, into the current buffer of `key` if batch_buffers is given."""
+    if batch_buffers is None:
+        return torch.stack(tensors)
+    out = batch_buffers.get(key, tensors[0].shape, tensors[0].dtype, len(tensors))
+    return torch.stack(tensors, out=out)
+
+
 def collate_fn_with_preprocess(batch,
                                audio_ext,
                                text_ext,
                                max_len,
                                audio_cfg,
                                args,
+                               label_encoder=None,
+                               batch_buffers=None,
                                ):
     """
     Collate function for wdsdataloader.
     batch: a list of dict, each dict is a sample
+    label_encoder: a ClassLabelEncoder to build the "class_label" multi-hot targets from the sample tags.
+    batch_buffers: a BatchBuffers to collate the tensors into instead of allocating new batch tensors.
     """
 
-    class_index_dict = copy.deepcopy(args.class_index_dict)  # To avoid deadlock in multiprocessing
     data_filling = args.data_filling
     data_truncating = args.data_truncating
     text_augment_selection = args.text_augment_selection
     tmodel = args.tmodel
+    fusion_on_device = args.fusion_on_device and data_truncating == "fusion"
 
     # concatenate values in each dictionary. if it is a tensor, concatenate. if it is a list, extend.
     data_preprocessed = []
 
     for sample in batch:
-        prepped = preprocess_single(sample, audio_ext, text_ext, max_len, audio_cfg, tmodel, class_index_dict, data_filling,
-                              data_truncating, text_augment_selection)
+        prepped = preprocess_single(sample, audio_ext, text_ext, max_len, audio_cfg, tmodel, label_encoder, data_filling,
+                              data_truncating, text_augment_selection, fusion_on_device)
         data_preprocessed.append(
             prepped
         )
 
-
     batch_dict = {}
+    if label_encoder is not None:
+        class_labels = batch_buffers.get("class_label", (len(label_encoder),), torch.float32, len(data_preprocessed)) \
+            if batch_buffers is not None else None
+        batch_dict["class_label"] = label_encoder.encode_batch(
+            [sample.pop("tag") for sample in data_preprocessed], out=class_labels
+        )
+    if fusion_on_device:
+        # clips have different lengths, MelFusion only reads the first fusion_frames frames of each
+        batch_dict["fusion_waveform"] = torch.nn.utils.rnn.pad_sequence(
+            [sample.pop("fusion_waveform") for sample in data_preprocessed], batch_first=True
+        )
     for k in data_preprocessed[0].keys():
         if isinstance(data_preprocessed[0][k], dict):  # dealwith bert tokenizer output
             batch_dict[k] = {}
@@ -623,17 +1026,108 @@ def collate_fn_with_preprocess(batch,
                 tmp = []
                 for i in range(len(data_preprocessed)):
                     tmp.append(data_preprocessed[i][k][kk])
-                batch_dict[k][kk] = torch.vstack(tmp)
+                batch_dict[k][kk] = stack_into(tmp, batch_buffers, f"{k}.{kk}")
         elif isinstance(data_preprocessed[0][k], torch.Tensor):
-            batch_dict[k] = torch.stack([sample[k] for sample in data_preprocessed])
+            batch_dict[k] = stack_into([sample[k] for sample in data_preprocessed], batch_buffers, k)
         elif isinstance(data_preprocessed[0][k], np.ndarray):
             batch_dict[k] = torch.tensor(np.stack([sample[k] for sample in data_preprocessed]))
         else:
             batch_dict[k] = [sample[k] for sample in data_preprocessed]
+    if batch_buffers is not None:
+        batch_buffers.advance()
     del data_preprocessed
     return batch_dict
 
 
+def train_shard_stages(args, tarfile_to_samples, stream_index=0, shard_sizes=None):
+    """
+    Pipeline stages from a shard list to shuffled samples, for training and parallel eval.
+    Every call builds new stages, so each stream keeps its own shuffle buffer and epoch counter.
+    If shard_sizes is given, shards are split over nodes and workers by sample count with split_by_size.
+    """
+    if shard_sizes is not None:
+        split = [split_by_size(shard_sizes, seed=args.seed + stream_index)]
+    else:
+        split = [
+            wds.detshuffle(
+                bufsize=_SHARD_SHUFFLE_SIZE,
+                initial=_SHARD_SHUFFLE_INITIAL,
+                seed=args.seed + stream_index,
+            ),
+            wds.split_by_node,
+            wds.split_by_worker,
+        ]
+    return split + [
+        # at this point, we have an iterator over the shards assigned to each worker at each node
+        tarfile_to_samples(handler=log_and_continue),
+        wds.shuffle(
+            bufsize=_SAMPLE_SHUFFLE_SIZE,
+            initial=_SAMPLE_SHUFFLE_INITIAL,
+            rng=random.Random(args.seed + stream_index),
+        ),
+        # wds.repeatedly,  # FIXME determine if this is beneficial
+    ]
+
+
+class SharedEpoch:
+    """Epoch number set by the training loop and read by the dataloader workers, which are forked every epoch."""
+
+    def __init__(self, epoch=0):
+        self.shared_epoch = multiprocessing.Value("i", epoch)
+
+    def set_value(self, epoch):
+        self.shared_epoch.value = epoch
+
+    def get_value(self):
+        return self.shared_epoch.value
+
+
+class WeightedSourceMix(torch.utils.data.IterableDataset):
+    """
+    Interleave several sample streams, picking the next sample from source i with probability weights[i].
+    Each source is restarted when it runs out, so small sources are cycled through (with a new shard
+    shuffle each pass) while large ones are read only as far as their weight requires.
+    A source that yields nothing on this worker (e.g. fewer shards than workers) is dropped from the mix.
+    The interleaving is seeded by (seed, epoch, rank, worker), the epoch read from `epoch` (a SharedEpoch),
+    or counted by this object if None.
+    """
+
+    def __init__(self, sources, weights, seed=0, epoch=None):
+        assert len(sources) == len(weights), "need one weight per source"
+        self.sources = sources
+        self.weights = weights
+        self.seed = seed
+        self.epoch = epoch if epoch is not None else -1
+
+    @staticmethod
+    def endless(source):
+        while True:
+            empty = True
+            for sample in source:
+                empty = False
+                yield sample
+            if empty:
+                return
+
+    def __iter__(self):
+        if isinstance(self.epoch, SharedEpoch):
+            epoch = self.epoch.get_value()
+        else:
+            self.epoch += 1
+            epoch = self.epoch
+        rank, _, worker, _ = wds.utils.pytorch_worker_info()
+        rng = random.Random(f"{self.seed}-{epoch}-{rank}-{worker}")
+        streams = [self.endless(source) for source in self.sources]
+        weights = list(self.weights)
+        while streams:
+            i = rng.choices(range(len(streams)), weights=weights)[0]
+            try:
+                yield next(streams[i])
+            except StopIteration:
+                del streams[i]
+                del weights[i]
+
+
 def get_wds_dataset(
         args,
         model_cfg,
@@ -681,61 +1175,115 @@ def get_wds_dataset(
                     args.val_num_samples or 0
             )  # eval will just exhaust the iterator if not specified
 
-    pipeline = [wds.SimpleShardList(input_shards)]
-    # at this point we have an iterator over all the shards
-    # TODO: (yusong): add a if statement of distributed. If not, we don't need to split_by_node
-    if is_train or args.parallel_eval:
-        pipeline.extend(
-            [
-                wds.detshuffle(
-                    bufsize=_SHARD_SHUFFLE_SIZE,
-                    initial=_SHARD_SHUFFLE_INITIAL,
-                    seed=args.seed,
-                ),
-                wds.split_by_node,
-                wds.split_by_worker,
-                # at this point, we have an iterator over the shards assigned to each worker at each node
-                wds.tarfile_to_samples(handler=log_and_continue),
-                wds.shuffle(
-                    bufsize=_SAMPLE_SHUFFLE_SIZE,
-                    initial=_SAMPLE_SHUFFLE_INITIAL,
-                    rng=random.Random(args.seed),
-                ),
-                # wds.repeatedly,  # FIXME determine if this is beneficial
-            ]
+    if args.shard_cache_dir:
+        shard_cache = ShardCache(args.shard_cache_dir, args.shard_cache_size * 1024 ** 3)
+        tarfile_to_samples = partial(cached_tarfile_to_samples, cache=shard_cache)
+    else:
+        shard_cache = None
+        tarfile_to_samples = wds.tarfile_to_samples
+
+    shard_sizes = None
+    if args.balanced_shard_split and (is_train or args.parallel_eval):
+        shard_sizes = get_shard_sizes(input_shards, sizefilepath_=sizefilepath_, is_local=is_local)
+        if is_master(args):
+            log_shard_balance(input_shards, shard_sizes, args.world_size, max(1, args.workers), args.seed)
+
+    shared_epoch = None
+    if is_train and args.train_data_weights:
+        # one endless stream per source, interleaved by the source weights
+        shared_epoch = SharedEpoch()
+        pipeline = [
+            WeightedSourceMix(
+                [
+                    wds.DataPipeline(wds.SimpleShardList(shards), *train_shard_stages(args, tarfile_to_samples, i, shard_sizes))
+                    for i, shards in enumerate(args.train_data_sources)
+                ],
+                args.train_data_weights,
+                seed=args.seed,
+                epoch=shared_epoch,
+            )
+        ]
+    elif is_train or args.parallel_eval:
+        # at this point we have an iterator over all the shards
+        # TODO: (yusong): add a if statement of distributed. If not, we don't need to split_by_node
+        pipeline = [wds.SimpleShardList(input_shards)] + train_shard_stages(
+            args, tarfile_to_samples, shard_sizes=shard_sizes
         )
     else:
-        pipeline.extend(
-            [
-                wds.split_by_worker,
-                # at this point, we have an iterator over the shards assigned to each worker
-                wds.tarfile_to_samples(handler=log_and_continue),
-            ]
+        pipeline = [
+            wds.SimpleShardList(input_shards),
+            wds.split_by_worker,
+            # at this point, we have an iterator over the shards assigned to each worker
+            tarfile_to_samples(handler=log_and_continue),
+        ]
+
+    label_encoder = ClassLabelEncoder(args.class_index_dict) if args.class_index_dict is not None else None
+
+    num_crops = args.crops_per_clip if is_train else 1
+    pipeline.extend(
+        [
+            partial(decode_audio_crops, max_len=max_len, data_truncating=args.data_truncating, num_crops=num_crops),
+            # the audio is decoded above, this only decodes the remaining (json) fields
+            wds.decode(wds.torch_audio, partial=True),
+        ]
+    )
+    if num_crops > 1:
+        # crops of the same clip share a caption, spread them over several batches. The buffer holds
+        # batch_size * num_crops decoded crops per worker, e.g. ~1.9 MB each for 10 s of float32 at 48 kHz
+        pipeline.append(
+            wds.shuffle(
+                bufsize=args.batch_size * num_crops,
+                initial=args.batch_size * num_crops,
+                rng=random.Random(args.seed),
+            )
         )
 
-    pipeline.append(
-        wds.decode(wds.torch_audio),
-    )
+    if is_train:
+        if args.prefetch_factor:
+            prefetch_factor = args.prefetch_factor
+        else:
+            prefetch_factor = max(2, args.batch_size // args.workers)
+    else:
+        prefetch_factor = 2
+
+    # a worker can have prefetch_factor batches in flight, plus the one being copied to pinned memory
+    batch_buffers = BatchBuffers(depth=prefetch_factor + 2) if args.reuse_batch_buffers else None
 
     pipeline.append(
         wds.batched(
             args.batch_size,
-            partial=not (is_train or args.parallel_eval),
+            partial=not is_train,
             collation_fn=partial(collate_fn_with_preprocess,
                                  audio_ext=audio_ext,
                                  text_ext=text_ext,
                                  max_len=max_len,
                                  audio_cfg=model_cfg['audio_cfg'],
                                  args=args,
+                                 label_encoder=label_encoder,
+                                 batch_buffers=batch_buffers,
                                  ),
 
         )
     )
 
+    if num_crops > 1:
+        # long clips yield up to num_crops samples each, short ones fewer: count them from the clip durations
+        num_clips = num_samples
+        num_samples = get_num_crops(
+            input_shards, num_crops, max_len, model_cfg['audio_cfg']['sample_rate'],
+            sizefilepath_=sizefilepath_, is_local=is_local,
+        )
+        if num_samples is None:
+            num_samples = num_clips
+            logging.warning(
+                "No durations.json next to sizes.json, cannot count the crops of --crops-per-clip: "
+                f"an epoch is counted as one sample per clip ({num_clips} samples)."
+            )
+        elif is_master(args):
+            logging.info(f"{num_clips} clips yield {num_samples} crops per epoch with --crops-per-clip {num_crops}")
+
     dataset = wds.DataPipeline(*pipeline)
-    if is_train or args.parallel_eval:
-        # (yusong): Currently parallel evaluation will be not precise as we are repeat the last few samples.
-        # (yusong): See comments below.
+    if is_train:
         # roll over and repeat a few samples to get same number of full batches on each node
         global_batch_size = args.batch_size * args.world_size
         num_batches = math.ceil(num_samples / global_batch_size)
@@ -748,6 +1296,10 @@ def get_wds_dataset(
         dataset = dataset.with_epoch(
             num_worker_batches
         )  # each worker is iterating over this
+    elif args.parallel_eval:
+        # every rank exhausts its own shards with partial last batches, the features are gathered
+        # once after the eval loop (see gather_parallel_eval_info), so ranks need not stay in step
+        num_batches = math.ceil(num_samples / (args.batch_size * args.world_size))
     else:
         # last batches are partial, eval is done on single (master) node
         num_batches = math.ceil(num_samples / args.batch_size)
@@ -756,14 +1308,6 @@ def get_wds_dataset(
     if args.horovod:  # multi-node training on summit
         kwargs["multiprocessing_context"] = "forkserver"
 
-    if is_train:
-        if args.prefetch_factor:
-            prefetch_factor = args.prefetch_factor
-        else:
-            prefetch_factor = max(2, args.batch_size // args.workers)
-    else:
-        prefetch_factor = 2
-
     dataloader = wds.WebLoader(
         dataset,
         batch_size=None,
@@ -791,6 +1335,12 @@ def get_wds_dataset(
     # add meta-data to dataloader instance for convenience
     dataloader.num_batches = num_batches
     dataloader.num_samples = num_samples
+    dataloader.shard_cache = shard_cache
+    # the training loop sets the epoch of the source interleaving, see WeightedSourceMix
+    dataloader.shared_epoch = shared_epoch
+    # builds "mel_fusion" on the training device, see get_audio_features
+    dataloader.mel_fusion = MelFusion(model_cfg['audio_cfg'], max_len) \
+        if args.fusion_on_device and args.data_truncating == "fusion" else None
 
     return DataInfo(dataloader, None)
 
@@ -823,7 +1373,7 @@ def get_toy_dataset(args, model_cfg, is_train):
     ipc_path = args.train_ipc if is_train else args.val_ipc
     assert index_path and ipc_path
     eval_mode = not is_train
-    dataset = ToyDataset(index_path, ipc_path, model_cfg, eval_mode=eval_mode)
+    dataset = ToyDataset(index_path, ipc_path, model_cfg, eval_mode=eval_mode, chunk_aligned=args.h5_chunk_aligned)
 
     num_samples = len(dataset)
     sampler = (
@@ -862,15 +1412,34 @@ def get_data(args, model_cfg):
 
     if args.datasetinfos is None:
         args.datasetinfos = ["train", "unbalanced_train", "balanced_train"]
+    args.train_data_weights = None
     if args.dataset_type == "webdataset":
-        args.train_data = get_tar_path_from_dataset_name(
-            args.datasetnames,
-            args.datasetinfos,
-            islocal=not args.remotedata,
-            proportion=args.dataset_proportion,
-            dataset_path=args.datasetpath,
-            full_dataset=args.full_train_dataset,
-        )
+        if args.dataset_weights is None:
+            args.train_data = get_tar_path_from_dataset_name(
+                args.datasetnames,
+                args.datasetinfos,
+                islocal=not args.remotedata,
+                proportion=args.dataset_proportion,
+                dataset_path=args.datasetpath,
+                full_dataset=args.full_train_dataset,
+            )
+        else:
+            assert len(args.dataset_weights) == len(args.datasetnames), \
+                "--dataset-weights needs one weight per dataset in --datasetnames"
+            args.train_data_sources, args.train_data_weights = [], []
+            for n, w in zip(args.datasetnames, args.dataset_weights):
+                shards = get_tar_path_from_dataset_name(
+                    [n],
+                    args.datasetinfos,
+                    islocal=not args.remotedata,
+                    proportion=args.dataset_proportion,
+                    dataset_path=args.datasetpath,
+                    full_dataset=args.full_train_dataset,
+                )
+                if shards:
+                    args.train_data_sources.append(shards)
+                    args.train_data_weights.append(w)
+            args.train_data = sum(args.train_data_sources, [])
 
         if args.full_train_dataset is None:
             args.full_train_dataset = []
@@ -419,7 +419,8 @@ def main():
         pretrained_audio=args.pretrained_audio,
         pretrained_text=args.pretrained_text,
         enable_fusion=args.enable_fusion,
-        fusion_type=args.fusion_type
+        fusion_type=args.fusion_type,
+        modalities={"audio"},  # the linear probe only uses the audio branch
     )
 
     args.lp_out_ch = len(list(args.class_index_dict.keys()))
@@ -10,7 +10,7 @@ def get_default_params(model_name):
         return {"lr": 5.0e-4, "beta1": 0.9, "beta2": 0.999, "eps": 1.0e-8}
 
 
-def parse_args():
+def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--train-data",
@@ -48,6 +48,12 @@ def parse_args():
         default=None,
         help="Path to npy file of the number of instance per class in validation data",
     )
+    parser.add_argument(
+        "--h5-chunk-aligned",
+        default=False,
+        action="store_true",
+        help="For the toy dataset, read whole hdf5 chunks and reuse them for neighbouring waveforms.",
+    )
     parser.add_argument(
         "--train-num-samples",
         type=int,
@@ -126,12 +132,41 @@ def parse_args():
         default=1.0,
         help="How much proportion of dataset we want to train.",
     )
+    parser.add_argument(
+        "--dataset-weights",
+        nargs="+",
+        type=float,
+        default=None,
+        help="Sampling weight of each training dataset in --datasetnames, e.g. 0.5 0.3 0.2. "
+             "If set, each dataset is streamed separately and the streams are interleaved by these weights, "
+             "instead of concatenating all shards.",
+    )
+    parser.add_argument(
+        "--balanced-shard-split",
+        default=False,
+        action="store_true",
+        help="Split webdataset shards over nodes and workers by their sample counts in sizes.json, "
+             "instead of round-robin.",
+    )
     parser.add_argument(
         "--remotedata",
         default=False,
         action="store_true",
         help="if the dataset is remote, set this flag",
     )
+    parser.add_argument(
+        "--shard-cache-dir",
+        type=str,
+        default=None,
+        help="Local directory to cache remote webdataset shards in, so later epochs read them from disk. "
+             "Disabled if not set.",
+    )
+    parser.add_argument(
+        "--shard-cache-size",
+        type=float,
+        default=100,
+        help="Maximum size of the shard cache in GB. Least recently used shards are evicted first.",
+    )
     parser.add_argument(
         "--class-label-path",
         type=str,
@@ -543,12 +578,50 @@ def parse_args():
         action="store_true",
         help="Enable mixup in finetuning training.",
     )
+    parser.add_argument(
+        "--crops-per-clip",
+        type=int,
+        default=1,
+        help="With rand_trunc, emit up to this many non-overlapping crops of each long training clip "
+             "as separate samples, so each decoded file yields more training examples. The epoch length is "
+             "counted from the clip durations in the durations.json next to sizes.json (one sample per clip "
+             "without it). Crops are mixed in a shuffle buffer of batch_size * crops-per-clip decoded crops per "
+             "dataloader worker, about 1.9 MB each for 10 s clips at 48 kHz, on top of the prefetched batches.",
+    )
+    parser.add_argument(
+        "--fusion-on-device",
+        default=False,
+        action="store_true",
+        help="With fusion, ship the raw clips and chunk offsets from the dataloader and build the fusion mels "
+             "of the whole batch on the training device instead of per sample in the dataloader workers.",
+    )
+    parser.add_argument(
+        "--reuse-batch-buffers",
+        default=False,
+        action="store_true",
+        help="Collate webdataset batches into buffers preallocated once per dataloader worker "
+             "instead of allocating new batch tensors for every batch.",
+    )
     parser.add_argument(
         "--text-augment-selection",
         type=str,
         default=None,
         help="For selecting levels of augmented text. Type is among ['all', 'augment_only', 'none']",
     )
+    parser.add_argument(
+        "--profile-steps",
+        type=str,
+        default=None,
+        help="Profile the global training steps start:end with torch.profiler and save a chrome trace "
+             "to the log directory.",
+    )
+    parser.add_argument(
+        "--profile-timers",
+        default=False,
+        action="store_true",
+        help="Time forward, loss, backward, optimizer and logit scale clamp of every training step. "
+             "Synchronizes CUDA at every phase, so it slows training down.",
+    )
     parser.add_argument(
         "--prefetch-factor",
         type=int,
@@ -556,7 +629,7 @@ def parse_args():
         help="The prefetch factor for dataloader. Larger value will use more memory and CPU but faster.",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     # If some params are not passed, we use the default values based on model name.
     default_params = get_default_params(args.amodel)
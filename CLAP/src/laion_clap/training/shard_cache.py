@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import webdataset as wds
+from webdataset import gopen
+from webdataset.tariterators import group_by_keys, tar_file_expander
+
+
+_STATS_KEYS = ("hits", "misses", "bypassed", "hit_bytes", "miss_bytes", "evictions", "evicted_bytes")
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive flock on `path`, shared across processes."""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class _TeeStream:
+    """
+    Read-through wrapper around a remote shard stream.
+    Every byte handed to the tar reader is also written to a temporary file in the cache.
+    On close, the rest of the stream is drained and the file is atomically renamed into place,
+    so a cache entry is either a complete shard or absent.
+    """
+
+    def __init__(self, stream, tmp_path, final_path, on_commit):
+        self.stream = stream
+        self.tmp_path = tmp_path
+        self.final_path = final_path
+        self.on_commit = on_commit
+        self.tmp = open(tmp_path, "wb")
+        self.closed = False
+
+    def read(self, n=-1):
+        data = self.stream.read(n)
+        self.tmp.write(data)
+        return data
+
+    def close(self, commit=True):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if commit:
+                while True:
+                    data = self.stream.read(1 << 20)
+                    if not data:
+                        break
+                    self.tmp.write(data)
+            self.tmp.flush()
+            os.fsync(self.tmp.fileno())
+            self.tmp.close()
+            # closing a `pipe:` stream raises if the download command failed
+            self.stream.close()
+        except Exception:
+            commit = False
+            raise
+        finally:
+            if not self.tmp.closed:
+                self.tmp.close()
+            if commit:
+                os.replace(self.tmp_path, self.final_path)
+                self.on_commit(self.final_path)
+            elif os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+    def abort(self):
+        try:
+            self.stream.close()
+        except Exception:
+            pass
+        self.close(commit=False)
+
+    def __str__(self):
+        return f"<TeeStream {self.final_path}>"
+
+
+class ShardCache:
+    """
+    Bounded local disk cache for remote webdataset shards (e.g. `pipe:aws s3 cp ... -` urls).
+    The first read of a shard tees it into `cache_dir`; later reads open the local copy.
+    Entries are evicted least-recently-used first once the cache exceeds `max_bytes`.
+    Dataloader workers share the directory: writers take a per-shard flock, and a worker
+    that finds the shard being written by someone else streams it remotely instead of waiting.
+    Only plain paths and numbers are stored, so the object is cheap to pickle into workers.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        if fcntl is None:
+            raise RuntimeError("ShardCache needs file locks (fcntl), which this platform lacks.")
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._last_stats = dict.fromkeys(_STATS_KEYS, 0)
+
+    def _path(self, url, suffix=".tar"):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + suffix)
+
+    def _update_stats(self, **deltas):
+        stats_path = os.path.join(self.cache_dir, "stats.json")
+        with _locked(stats_path + ".lock"):
+            stats = self._read_stats(stats_path)
+            for k, v in deltas.items():
+                stats[k] += v
+            tmp_path = f"{stats_path}.tmp-{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, stats_path)
+
+    @staticmethod
+    def _read_stats(stats_path):
+        stats = dict.fromkeys(_STATS_KEYS, 0)
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                stats.update(json.load(f))
+        return stats
+
+    def stats(self):
+        """Cumulative hit/miss counters shared by all processes using this cache directory."""
+        return self._read_stats(os.path.join(self.cache_dir, "stats.json"))
+
+    def stats_since_last_call(self):
+        """Counters accumulated since the previous call in this process, e.g. for per-epoch logging."""
+        stats = self.stats()
+        delta = {k: stats[k] - self._last_stats[k] for k in _STATS_KEYS}
+        self._last_stats = stats
+        return delta
+
+    def size(self):
+        return sum(e.stat().st_size for e in os.scandir(self.cache_dir) if e.name.endswith(".tar"))
+
+    def evict(self):
+        """Drop least-recently-used shards until the cache fits in `max_bytes`."""
+        with _locked(os.path.join(self.cache_dir, "evict.lock")):
+            entries = []
+            for e in os.scandir(self.cache_dir):
+                if e.name.endswith(".tar"):
+                    st = e.stat()
+                    entries.append((st.st_mtime, st.st_size, e.path))
+            total = sum(size for _, size, _ in entries)
+            evictions, evicted_bytes = 0, 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    # readers that already opened the shard keep their file handle
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                evictions += 1
+                evicted_bytes += size
+        if evictions:
+            self._update_stats(evictions=evictions, evicted_bytes=evicted_bytes)
+
+    def _on_commit(self, path):
+        self._update_stats(misses=1, miss_bytes=os.path.getsize(path))
+        self.evict()
+
+    def open(self, url):
+        """Open `url` for reading, from the cache if possible. Local files are opened directly."""
+        if not url.startswith("pipe:") and os.path.exists(url):
+            return gopen.gopen(url)
+
+        path = self._path(url)
+        try:
+            stream = open(path, "rb")
+        except FileNotFoundError:
+            pass
+        else:
+            # bump the entry to most-recently-used
+            os.utime(path)
+            self._update_stats(hits=1, hit_bytes=os.fstat(stream.fileno()).st_size)
+            return stream
+
+        lock_path = self._path(url, ".lock")
+        lock_file = open(lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another worker is filling this entry, do not block on it
+            lock_file.close()
+            self._update_stats(bypassed=1)
+            return gopen.gopen(url)
+
+        if os.path.exists(path):
+            # filled by another worker between our lookup and taking the lock
+            lock_file.close()
+            return self.open(url)
+
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+
+        def on_commit(final_path):
+            lock_file.close()
+            self._on_commit(final_path)
+
+        try:
+            tee = _TeeStream(gopen.gopen(url), tmp_path, path, on_commit)
+        except Exception:
+            lock_file.close()
+            raise
+        tee.lock_file = lock_file
+        return tee
+
+
+def cached_url_opener(data, cache, handler=wds.reraise_exception):
+    """Like `webdataset.tariterators.url_opener`, but opening shards through a `ShardCache`."""
+    for sample in data:
+        assert isinstance(sample, dict), sample
+        assert "url" in sample
+        url = sample["url"]
+        try:
+            stream = cache.open(url)
+        except Exception as exn:
+            exn.args = exn.args + (url,)
+            if handler(exn):
+                continue
+            else:
+                break
+        sample.update(stream=stream)
+        finished = False
+        try:
+            yield sample
+            finished = True
+        finally:
+            if isinstance(stream, _TeeStream):
+                if finished:
+                    # the tar reader is done with this shard: finish the download and publish it
+                    try:
+                        stream.close()
+                    except Exception as exn:
+                        exn.args = exn.args + (url,)
+                        if not handler(exn):
+                            raise
+                    finally:
+                        stream.lock_file.close()
+                else:
+                    # the pipeline stopped mid-shard (e.g. end of epoch), keep the cache consistent
+                    stream.abort()
+                    stream.lock_file.close()
+            else:
+                stream.close()
+
+
+def cached_tarfile_samples(src, cache, handler=wds.reraise_exception):
+    streams = cached_url_opener(src, cache, handler=handler)
+    files = tar_file_expander(streams, handler=handler)
+    samples = group_by_keys(files, handler=handler)
+    return samples
+
+
+cached_tarfile_to_samples = wds.pipelinefilter(cached_tarfile_samples)
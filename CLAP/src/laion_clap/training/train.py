@@ -8,6 +8,7 @@ from contextlib import suppress
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 
 try:
@@ -15,7 +16,12 @@ try:
 except ImportError:
     wandb = None
 
-from clap_module import ClipLoss, gather_features
+try:
+    import horovod.torch as hvd
+except ImportError:
+    hvd = None
+
+from clap_module import ClipLoss, topk_search
 from .distributed import is_master
 
 
@@ -38,6 +44,49 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class StepTimer(object):
+    """
+    Wall-clock time of the phases of a training step (forward, loss, backward, optimizer, clamp).
+    CUDA is synchronized at every mark so the times are attributed to the right phase,
+    which slows training down, hence it is only enabled with --profile-timers.
+    """
+
+    def __init__(self, device, enabled=False):
+        self.device = device
+        self.enabled = enabled
+        self.meters = {}
+        self.last = None
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def start(self):
+        if self.enabled:
+            self._sync()
+            self.last = time.time()
+
+    def mark(self, name):
+        if not self.enabled:
+            return
+        self._sync()
+        now = time.time()
+        self.meters.setdefault(name, AverageMeter()).update(now - self.last)
+        self.last = now
+
+    def reset(self):
+        for m in self.meters.values():
+            m.reset()
+
+
+def parse_profile_steps(profile_steps):
+    """Parse a "start:end" --profile-steps value into a (start, end) tuple of global steps, or None."""
+    if not profile_steps:
+        return None
+    start, end = profile_steps.split(":")
+    return int(start), int(end)
+
+
 def unwrap_model(model):
     if hasattr(model, "module"):
         return model.module
@@ -65,8 +114,12 @@ def train_one_epoch(
     dataloader, sampler = data["train"].dataloader, data["train"].sampler
     if args.distributed and sampler is not None:
         sampler.set_epoch(epoch)
+    shared_epoch = getattr(dataloader, "shared_epoch", None)
+    if shared_epoch is not None:
+        shared_epoch.set_value(epoch)
     num_batches_per_epoch = dataloader.num_batches
     sample_digits = math.ceil(math.log(dataloader.num_samples + 1, 10))
+    mel_fusion = getattr(dataloader, "mel_fusion", None)
 
     # for toy dataset
     if args.dataset_type == "toy":
@@ -75,6 +128,12 @@ def train_one_epoch(
     loss_m = AverageMeter()
     batch_time_m = AverageMeter()
     data_time_m = AverageMeter()
+    # not reset per log window, for the stall report at the end of the epoch
+    epoch_data_time_m = AverageMeter()
+    epoch_batch_time_m = AverageMeter()
+    step_timer = StepTimer(device, enabled=args.profile_timers)
+    profile_steps = parse_profile_steps(args.profile_steps)
+    profiler = None
     end = time.time()
 
     for i, batch in enumerate(dataloader):
@@ -82,6 +141,13 @@ def train_one_epoch(
         # logging.info(f"batch {i} of {num_batches_per_epoch}")
         step = num_batches_per_epoch * epoch + i
 
+        if profile_steps is not None and step == profile_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            profiler.__enter__()
+
         if isinstance(scheduler, dict):
             for s in scheduler.values():
                 s(step)
@@ -93,6 +159,11 @@ def train_one_epoch(
         # texts = texts.to(device=device, non_blocking=True)
 
         data_time_m.update(time.time() - end)
+        epoch_data_time_m.update(time.time() - end)
+        step_timer.start()
+        if mel_fusion is not None:
+            mel_fusion(audios, device)
+            step_timer.mark("mel_fusion")
         if isinstance(optimizer, dict):
             for o_ in optimizer.values():
                 o_.zero_grad()
@@ -108,6 +179,7 @@ def train_one_epoch(
                 logit_scale_a,
                 logit_scale_t,
             ) = model(audios, texts, device)
+            step_timer.mark("forward")
 
             if args.clap_mlploss:
                 total_loss = loss(
@@ -124,9 +196,11 @@ def train_one_epoch(
                     text_features=text_features,
                     logit_scale_a=logit_scale_a
                 )
+            step_timer.mark("loss")
         if isinstance(optimizer, dict):
             if scaler is not None:
                 scaler.scale(total_loss).backward()
+                step_timer.mark("backward")
                 for o_ in optimizer.values():
                     if args.horovod:
                         o_.synchronize()
@@ -138,11 +212,13 @@ def train_one_epoch(
                 scaler.update()
             else:
                 total_loss.backward()
+                step_timer.mark("backward")
                 for o_ in optimizer.values():
                     o_.step()
         else:
             if scaler is not None:
                 scaler.scale(total_loss).backward()
+                step_timer.mark("backward")
                 if args.horovod:
                     optimizer.synchronize()
                     scaler.unscale_(optimizer)
@@ -153,15 +229,32 @@ def train_one_epoch(
                 scaler.update()
             else:
                 total_loss.backward()
+                step_timer.mark("backward")
                 optimizer.step()
+        step_timer.mark("optimizer")
 
         # Note: we clamp to 4.6052 = ln(100), as in the original paper.
         with torch.no_grad():
             unwrap_model(model).logit_scale_a.clamp_(0, math.log(100))
             if args.clap_mlploss:
                 unwrap_model(model).logit_scale_t.clamp_(0, math.log(100))
+        step_timer.mark("clamp")
+
+        if profiler is not None:
+            profiler.step()
+            if step == profile_steps[1] or i + 1 == num_batches_per_epoch:
+                profiler.__exit__(None, None, None)
+                os.makedirs(os.path.join(args.logs, args.name), exist_ok=True)
+                trace_path = os.path.join(
+                    args.logs, args.name, f"trace_rank{args.rank}_steps{profile_steps[0]}-{step}.json"
+                )
+                profiler.export_chrome_trace(trace_path)
+                logging.info(f"Saved profiler trace of steps {profile_steps[0]}-{step} to {trace_path}")
+                profiler = None
+                profile_steps = None
 
         batch_time_m.update(time.time() - end)
+        epoch_batch_time_m.update(time.time() - end)
         end = time.time()
         batch_count = i + 1
         if is_master(args) and (i % 100 == 0 or batch_count == num_batches_per_epoch):
@@ -252,6 +345,14 @@ def train_one_epoch(
                         "scale_audio": logit_scale_scalar_a,
                         "lr": optimizer.param_groups[0]["lr"],
                     }
+            log_data["data_wait_ratio"] = data_time_m.sum / max(batch_time_m.sum, 1e-8)
+            log_data["samples_per_sec_per_rank"] = batch_size * batch_time_m.count / max(batch_time_m.sum, 1e-8)
+            if step_timer.enabled:
+                logging.info(
+                    "Step time (s): " + " ".join(f"{k}: {m.avg:.4f}" for k, m in step_timer.meters.items())
+                )
+                log_data.update({"time_" + k: m.avg for k, m in step_timer.meters.items()})
+                step_timer.reset()
             for name, val in log_data.items():
                 name = "train/" + name
                 if tb_writer is not None:
@@ -265,6 +366,87 @@ def train_one_epoch(
             data_time_m.reset()
     # end for
 
+    # data wait above 10% of the step time means the GPU is waiting for the dataloader
+    data_wait_ratio = epoch_data_time_m.sum / max(epoch_batch_time_m.sum, 1e-8)
+    logging.info(
+        f"Train Epoch: {epoch} rank {args.rank} "
+        f"{'input-bound' if data_wait_ratio > 0.1 else 'compute-bound'}: "
+        f"data wait {100 * data_wait_ratio:.1f}% of step time, "
+        f"data (t): {epoch_data_time_m.avg:.3f} batch (t): {epoch_batch_time_m.avg:.3f}"
+    )
+
+    shard_cache = getattr(dataloader, "shard_cache", None)
+    if is_master(args) and shard_cache is not None:
+        cache_stats = shard_cache.stats_since_last_call()
+        logging.info(
+            f"Train Epoch: {epoch} shard cache "
+            f"hits: {cache_stats['hits']} ({cache_stats['hit_bytes'] / 1024 ** 3:.2f} GB) "
+            f"misses: {cache_stats['misses']} ({cache_stats['miss_bytes'] / 1024 ** 3:.2f} GB) "
+            f"bypassed: {cache_stats['bypassed']} "
+            f"evictions: {cache_stats['evictions']}"
+        )
+        for name in ("hits", "misses", "bypassed", "evictions"):
+            if tb_writer is not None:
+                tb_writer.add_scalar("train/shard_cache_" + name, cache_stats[name], epoch)
+
+
+def gather_parallel_eval_info(local_eval_info, args):
+    """
+    Gather the eval outputs of all ranks on the master for exact parallel evaluation.
+    local_eval_info holds the audio/text features, texts, dataset names and sample keys seen by this rank.
+    Samples repeated to pad ranks to the same number of batches are dropped by key, keeping the first one.
+    Return the eval_info dict of evaluate(), with an entry per dataset name and "all", on the master,
+    and None on the other ranks.
+    """
+    if args.horovod:
+        gathered = hvd.allgather_object(local_eval_info)
+    elif args.distributed:
+        gathered = [None] * args.world_size if is_master(args) else None
+        dist.gather_object(local_eval_info, gathered, dst=0)
+    else:
+        gathered = [local_eval_info]
+    if not is_master(args):
+        return None
+
+    seen = set()
+    audio_features, text_features, texts, names = [], [], [], []
+    for info in gathered:
+        if not info["keys"]:
+            continue
+        idx = []
+        for i, key in enumerate(info["keys"]):
+            if key not in seen:
+                seen.add(key)
+                idx.append(i)
+        idx_t = torch.tensor(idx).long()
+        audio_features.append(torch.cat(info["all_audio_features"]).index_select(0, idx_t))
+        text_features.append(torch.cat(info["all_text_features"]).index_select(0, idx_t))
+        texts.extend([info["texts"][i] for i in idx])
+        names.extend([info["names"][i] for i in idx])
+    if not audio_features:
+        return {}
+    audio_features = torch.cat(audio_features)
+    text_features = torch.cat(text_features)
+    logging.info(f"Parallel eval: {len(seen)} unique samples out of {sum(len(info['keys']) for info in gathered)}")
+
+    names = np.array(names)
+    eval_info = {
+        "all": {
+            "all_audio_features": [audio_features],
+            "all_text_features": [text_features],
+            "texts": texts,
+        }
+    }
+    for n in np.unique(names):
+        idx = np.where(names == n)[0]
+        idx_t = torch.from_numpy(idx).long()
+        eval_info[n] = {
+            "all_audio_features": [audio_features.index_select(0, idx_t)],
+            "all_text_features": [text_features.index_select(0, idx_t)],
+            "texts": [texts[i] for i in idx],
+        }
+    return eval_info
+
 
 def evaluate(model, data, epoch, args, tb_writer=None):
     metrics = {}
@@ -299,6 +481,7 @@ def evaluate(model, data, epoch, args, tb_writer=None):
         dataloader = data["val"].dataloader
         num_samples = 0
         samples_per_val = dataloader.num_samples
+        mel_fusion = getattr(dataloader, "mel_fusion", None)
 
         # FIXME this does not scale past small eval datasets
         # all_audio_features @ all_text_features will blow up memory and compute very quickly
@@ -321,6 +504,16 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                 "all_text_features": [],
                 "texts": []
             }  # cumu
+        if args.parallel_eval:
+            if args.clap_mlploss:
+                raise NotImplementedError("Parallel evaluation not supported with MLP loss.")
+            parallel_eval_info = {
+                "all_audio_features": [],
+                "all_text_features": [],
+                "texts": [],
+                "names": [],
+                "keys": [],
+            }
         # all_audio_features, all_text_features, all_audio_features_mlp, all_text_features_mlp = [], [], [], []
         with torch.no_grad():
             for i, batch in enumerate(dataloader):
@@ -328,6 +521,8 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                 #     break
 
                 audios = batch  # contains mel_spec, wavform, and longer list
+                if mel_fusion is not None:
+                    mel_fusion(audios, device)
                 texts = batch['text']
                 all_texts = batch["raw_text"]
                 # audios = audios.to(device=device, non_blocking=True)
@@ -364,41 +559,18 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                     ) = model(audios, texts, device)
 
                     if args.parallel_eval:
-                        # multi-GPU eval
-                        if args.clap_mlploss:
-                            (
-                                audio_features,
-                                text_features,
-                                audio_features_mlp,
-                                text_features_mlp,
-                            ) = gather_features(
-                                audio_features=audio_features,
-                                text_features=text_features,
-                                audio_features_mlp=audio_features_mlp,
-                                text_features_mlp=text_features_mlp,
-                                local_loss=False,
-                                gather_with_grad=False,
-                                rank=args.rank,
-                                world_size=args.world_size,
-                                use_horovod=args.horovod,
-                                mlp_loss=args.clap_mlploss
-                            )
-                        else:
-                            (
-                                audio_features,
-                                text_features,
-                            ) = gather_features(
-                                audio_features=audio_features,
-                                text_features=text_features,
-                                local_loss=False,
-                                gather_with_grad=False,
-                                rank=args.rank,
-                                world_size=args.world_size,
-                                use_horovod=args.horovod,
-                                mlp_loss=args.clap_mlploss
-                            )
-
-                    if is_master(args):
+                        # multi-GPU eval: keep this rank's outputs, they are gathered once after the loop
+                        num_samples += audio_features.shape[0] * args.world_size
+                        parallel_eval_info["all_audio_features"].append(audio_features.cpu())
+                        parallel_eval_info["all_text_features"].append(text_features.cpu())
+                        parallel_eval_info["texts"].extend(all_texts)
+                        parallel_eval_info["names"].extend(["-".join(b.split("/")[-3:-1]) for b in batch['__url__']])
+                        # with_epoch and shard splitting can repeat samples, the url and key identify each one
+                        parallel_eval_info["keys"].extend(
+                            [f"{url}/{key}" for url, key in zip(batch['__url__'], batch['__key__'])]
+                        )
+
+                    elif is_master(args):
                         num_samples += audio_features.shape[0]
                         for n in [*all_names, "all"]:
                             if n == "all":
@@ -453,6 +625,8 @@ def evaluate(model, data, epoch, args, tb_writer=None):
                     logging.info(
                         f"Eval Epoch: {epoch} [{num_samples} / {samples_per_val}]"
                     )
+            if args.parallel_eval:
+                eval_info = gather_parallel_eval_info(parallel_eval_info, args)
             if is_master(args):
                 val_metrics_per_dataset = {}
                 for n in eval_info.keys():
@@ -697,10 +871,13 @@ def evaluate_clotho_audiocaps(
     """
     # TODO: (yusong) only support single GPU evaluation and only support non-mlp case for now.
     dataloader = data["val"].dataloader
+    mel_fusion = getattr(dataloader, "mel_fusion", None)
     with torch.no_grad():
         eval_info = {}
         for i, batch in enumerate(dataloader):
             audios = batch  # contains mel_spec, wavform, and longer list
+            if mel_fusion is not None:
+                mel_fusion(audios, device)
 
             # each item in the list has 5 texts
             if args.tmodel == "transformer":
@@ -799,11 +976,10 @@ def evaluate_clotho_audiocaps(
             # text to audio: do 5 times
             pred_text = []
             for d in range(5):
-                logit = logits_per_text.reshape(num_samples, 5, num_samples)[:, d, :]
-                ground_truth = torch.arange(len(logit)).view(-1, 1)
-                ranking = torch.argsort(logit, descending=True)  # [num_samples, num_samples]
-                preds = torch.where(ranking == ground_truth)[1]
-                pred_text.append(preds.detach().cpu().numpy())
+                # the d-th text of every audio against all audios, same ranking as logits_per_text without the sort
+                text_queries = text_features.reshape(num_samples, 5, -1)[:, d, :]
+                preds = topk_search(text_queries, audio_features, k=0, targets=torch.arange(num_samples)).ranks
+                pred_text.append(preds.numpy())
             pred_text_concat = np.concatenate(pred_text, axis=0)  # [5*num_samples]
             metrics[f"text_to_audio_mean_rank"] = pred_text_concat.mean() + 1
             metrics[f"text_to_audio_median_rank"] = np.floor(np.median(pred_text_concat)) + 1
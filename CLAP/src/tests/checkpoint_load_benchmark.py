@@ -0,0 +1,73 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+
+def memory_mb():
+    """Private and shared resident memory of this process, from /proc/self/smaps_rollup (Linux)."""
+    usage = {"private": 0, "shared": 0}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name.startswith("Private_"):
+                usage["private"] += int(value.split()[0])
+            elif name.startswith("Shared_"):
+                usage["shared"] += int(value.split()[0])
+    return {k: v / 1024 for k, v in usage.items()}
+
+
+def load(ckpt, amodel, mmap_weights):
+    import laion_clap
+    start = time.time()
+    model = laion_clap.CLAP_Module(enable_fusion=False, device="cpu", amodel=amodel)
+    model.load_ckpt(ckpt, verbose=False, mmap_weights=mmap_weights)
+    result = {
+        "load_sec": time.time() - start,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    result.update(memory_mb())
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Cold start time and memory of CLAP_Module.load_ckpt, for a torch checkpoint and its safetensors "
+                    "conversion (python -m clap_module.checkpoint)."
+    )
+    parser.add_argument("--ckpt", type=str, required=True, help="Training checkpoint (.pt).")
+    parser.add_argument("--safetensors", type=str, required=True, help="The same checkpoint converted to .safetensors.")
+    parser.add_argument("--amodel", type=str, default="HTSAT-tiny")
+    parser.add_argument("--processes", type=int, default=4, help="Processes loading the checkpoint at the same time.")
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        ckpt, mmap_weights = json.loads(args.child)
+        print(json.dumps(load(ckpt, args.amodel, mmap_weights)))
+        sys.exit()
+
+    # drop the page cache beforehand (echo 3 > /proc/sys/vm/drop_caches) to measure truly cold starts
+    for name, ckpt, mmap_weights in [
+        ("torch.load", args.ckpt, False),
+        ("safetensors", args.safetensors, False),
+        ("safetensors mmap", args.safetensors, True),
+    ]:
+        children = [
+            subprocess.Popen(
+                [sys.executable, __file__, "--ckpt", args.ckpt, "--safetensors", args.safetensors,
+                 "--amodel", args.amodel, "--child", json.dumps([ckpt, mmap_weights])],
+                stdout=subprocess.PIPE, text=True,
+            )
+            for _ in range(args.processes)
+        ]
+        results = [json.loads(child.communicate()[0].strip().splitlines()[-1]) for child in children]
+        print(
+            f"{name:>16}: load {max(r['load_sec'] for r in results):.1f} s, "
+            f"peak RSS {max(r['peak_rss_mb'] for r in results):.0f} MB per process, "
+            f"private {sum(r['private'] for r in results):.0f} MB / shared {max(r['shared'] for r in results):.0f} MB "
+            f"over {args.processes} processes"
+        )
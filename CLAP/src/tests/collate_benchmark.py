@@ -0,0 +1,77 @@
+import argparse
+import time
+
+import torch
+from laion_clap.training.data import BatchBuffers, stack_into
+
+
+def make_samples(batch_size, max_len, mel_frames, mel_bins, num_tokens):
+    return [
+        {
+            "waveform": torch.randn(max_len),
+            "mel_fusion": torch.randn(4, mel_frames, mel_bins),
+            "longer": torch.tensor([True]),
+            "text": {
+                "input_ids": torch.randint(0, 1000, (num_tokens,)),
+                "attention_mask": torch.ones(num_tokens, dtype=torch.long),
+            },
+        }
+        for _ in range(batch_size)
+    ]
+
+
+def collate(samples, batch_buffers):
+    batch = {}
+    for k, v in samples[0].items():
+        if isinstance(v, dict):
+            batch[k] = {kk: stack_into([s[k][kk] for s in samples], batch_buffers, f"{k}.{kk}") for kk in v}
+        else:
+            batch[k] = stack_into([s[k] for s in samples], batch_buffers, k)
+    if batch_buffers is not None:
+        batch_buffers.advance()
+    return batch
+
+
+def flat_tensors(batch):
+    for v in batch.values():
+        if isinstance(v, dict):
+            yield from v.values()
+        else:
+            yield v
+
+
+def run(samples, batch_buffers, num_batches):
+    seen_storages = set()
+    # keep the batches alive so freed storage addresses are not reused and counted as one
+    keep_alive = []
+    allocated_bytes = 0
+    start = time.time()
+    for _ in range(num_batches):
+        batch = collate(samples, batch_buffers)
+        for t in flat_tensors(batch):
+            ptr = t.untyped_storage().data_ptr()
+            if ptr not in seen_storages:
+                seen_storages.add(ptr)
+                allocated_bytes += t.untyped_storage().nbytes()
+        keep_alive.append(batch)
+    elapsed = time.time() - start
+    return elapsed / num_batches, allocated_bytes / num_batches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-len", type=int, default=480000)
+    parser.add_argument("--mel-frames", type=int, default=1001)
+    parser.add_argument("--mel-bins", type=int, default=64)
+    parser.add_argument("--num-tokens", type=int, default=77)
+    parser.add_argument("--num-batches", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=4)
+    args = parser.parse_args()
+
+    samples = make_samples(args.batch_size, args.max_len, args.mel_frames, args.mel_bins, args.num_tokens)
+    for name, batch_buffers in [("torch.stack", None), ("BatchBuffers", BatchBuffers(args.depth))]:
+        per_batch_time, per_batch_bytes = run(samples, batch_buffers, args.num_batches)
+        print(
+            f"{name:>12}: {per_batch_time * 1000:.1f} ms/batch, "
+            f"{per_batch_bytes / 1024 ** 2:.1f} MB newly allocated/batch"
+        )
@@ -0,0 +1,51 @@
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+from laion_clap.clap_module.factory import create_model
+from laion_clap.clap_module.export import export_audio_embedding, load_exported, onnxruntime
+
+
+def time_fn(fn, runs, *args):
+    with torch.no_grad():
+        fn(*args)  # warm up
+        start = time.time()
+        for _ in range(runs):
+            fn(*args)
+    return (time.time() - start) / runs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Parity of the exported audio embedding pipeline with CLAP.get_audio_embedding, and CPU latency."
+    )
+    parser.add_argument("--amodel", nargs="+", default=["HTSAT-tiny", "PANN-14"])
+    parser.add_argument("--tmodel", type=str, default="roberta")
+    # different from the export batch size, to check that the batch dimension is dynamic
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    formats = ["torchscript", "onnx"] if onnxruntime is not None else ["torchscript"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for amodel in args.amodel:
+            model, _ = create_model(amodel, args.tmodel, precision="fp32", device=torch.device("cpu"))
+            model.eval()
+            paths = export_audio_embedding(model, os.path.join(tmp_dir, amodel), formats, batch_size=2)
+
+            waveform = torch.randn(args.batch_size, model.audio_cfg.clip_samples).clamp(-1, 1)
+            eager = lambda x: model.get_audio_embedding([{"waveform": w} for w in x])
+            with torch.no_grad():
+                reference = eager(waveform)
+            print(f"{amodel} eager: {time_fn(eager, args.runs, waveform) * 1000:.1f} ms / batch {args.batch_size}")
+            for fmt, path in paths.items():
+                exported = load_exported(path)
+                with torch.no_grad():
+                    diff = (exported(waveform) - reference).abs().max().item()
+                print(
+                    f"{amodel} {fmt}: {time_fn(exported, args.runs, waveform) * 1000:.1f} ms / batch {args.batch_size}, "
+                    f"max abs difference {diff:.2e} ({'ok' if diff <= args.atol else 'MISMATCH'})"
+                )
@@ -0,0 +1,68 @@
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+from laion_clap.filters import FilterIndex
+from laion_clap.store import EmbeddingStore
+
+
+def post_filter_search(store, queries, mask, k, chunk_rows=65536):
+    """Baseline: score every row, then drop the rows failing the filter."""
+    queries = torch.from_numpy(queries)
+    scores = torch.cat([
+        queries @ torch.from_numpy(np.asarray(block, dtype=np.float32)).t() for _, block in store.chunks(chunk_rows)
+    ], dim=1)
+    scores[:, ~torch.from_numpy(mask)] = -np.inf
+    return scores.topk(k, dim=1).indices.numpy()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filtered search versus full scan with post-filtering.")
+    parser.add_argument("--num-rows", type=int, default=2000000)
+    parser.add_argument("--num-queries", type=int, default=16)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    deployments = np.array([f"deployment-{i:04d}" for i in range(1000)])
+    regions = np.array([f"region-{i}" for i in range(10)])
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EmbeddingStore.create(
+            f"{tmp}/store", dim=512, columns={"path": "str", "deployment": "str", "region": "str", "timestamp": "int64"}
+        )
+        for start in range(0, args.num_rows, 262144):
+            n = min(262144, args.num_rows - start)
+            embeddings = rng.standard_normal((n, 512)).astype(np.float32)
+            store.append(embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True), {
+                "deployment": deployments[rng.integers(len(deployments), size=n)],
+                "region": regions[rng.integers(len(regions), size=n)],
+                "timestamp": np.sort(rng.integers(0, 365 * 86400, size=n)) + start,
+            })
+        filter_index = FilterIndex.build(store, ["deployment", "region", "timestamp"])
+        queries = rng.standard_normal((args.num_queries, 512)).astype(np.float32)
+
+        start = time.time()
+        filter_index.search(queries, k=args.k)
+        full = time.time() - start
+        print(f"unfiltered scan: {full * 1000:.0f} ms")
+        for name, filters in [
+            ("1 deployment (~0.1%)", {"deployment": "deployment-0042"}),
+            ("1 region, 1 month (~0.8%)", {"region": "region-3", "timestamp": (0, 30 * 86400)}),
+            ("1 region (~10%)", {"region": "region-3"}),
+            ("2 regions (~20%)", {"region": ["region-3", "region-7"]}),
+        ]:
+            candidates = filter_index.rows(filters)
+            mask = np.zeros(len(store), dtype=bool)
+            mask[candidates] = True
+            start = time.time()
+            _, rows = filter_index.search(queries, filters, args.k)
+            filtered = time.time() - start
+            start = time.time()
+            expected = post_filter_search(store, queries, mask, args.k)
+            post = time.time() - start
+            print(
+                f"{name:>26}: filtered {filtered * 1000:.0f} ms, post-filtered scan {post * 1000:.0f} ms "
+                f"({post / filtered:.1f}x), same hits {np.array_equal(np.sort(rows), np.sort(expected))}"
+            )
@@ -0,0 +1,110 @@
+import argparse
+import time
+
+import torch
+from laion_clap.clap_module.factory import get_model_config
+from laion_clap.clap_module.htsat import create_htsat_model, WindowAttention
+from laion_clap.clap_module.model import CLAPAudioCfp
+
+
+def build_model(amodel):
+    audio_cfg = CLAPAudioCfp(**get_model_config(amodel)["audio_cfg"])
+    model = create_htsat_model(audio_cfg)
+    model.eval()
+    return model, audio_cfg
+
+
+def time_forward(model, batch, runs, **kwargs):
+    with torch.no_grad():
+        model(batch, device="cpu", **kwargs)  # warm up
+        start = time.time()
+        for _ in range(runs):
+            model(batch, device="cpu", **kwargs)
+    return (time.time() - start) / runs
+
+
+def interpolate_wav2img(model, x):
+    """The former F.interpolate + permute implementation of reshape_wav2img, as reference."""
+    target_T = int(model.spec_size * model.freq_ratio)
+    target_F = model.spec_size // model.freq_ratio
+    if x.shape[2] < target_T:
+        x = torch.nn.functional.interpolate(x, (target_T, x.shape[3]), mode="bicubic", align_corners=True)
+    if x.shape[3] < target_F:
+        x = torch.nn.functional.interpolate(x, (x.shape[2], target_F), mode="bicubic", align_corners=True)
+    x = x.permute(0, 1, 3, 2).contiguous()
+    x = x.reshape(x.shape[0], x.shape[1], x.shape[2], model.freq_ratio, x.shape[3] // model.freq_ratio)
+    x = x.permute(0, 1, 3, 2, 4).contiguous()
+    return x.reshape(x.shape[0], x.shape[1], x.shape[2] * x.shape[3], x.shape[4])
+
+
+def time_fn(fn, runs, *args):
+    fn(*args)  # warm up
+    start = time.time()
+    for _ in range(runs):
+        fn(*args)
+    return (time.time() - start) / runs
+
+
+def set_fused_attn(model, fused):
+    for m in model.modules():
+        if isinstance(m, WindowAttention):
+            m.fused_attn = fused
+
+
+def allocated_mb(model, batch, **kwargs):
+    """Total CPU memory allocated by one forward pass, in MB."""
+    with torch.no_grad(), torch.profiler.profile(profile_memory=True) as prof:
+        model(batch, device="cpu", **kwargs)
+    return sum(max(0, e.self_cpu_memory_usage) for e in prof.key_averages()) / 1024 ** 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU latency of the HTSAT audio encoder.")
+    parser.add_argument("--amodel", nargs="+", default=["HTSAT-tiny", "HTSAT-base"])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    for amodel in args.amodel:
+        model, audio_cfg = build_model(amodel)
+        batch = {"waveform": torch.randn(args.batch_size, audio_cfg.clip_samples)}
+        all_outputs = time_forward(model, batch, args.runs)
+        embedding_only = time_forward(model, batch, args.runs, outputs=("embedding",))
+        print(
+            f"{amodel} batch {args.batch_size}: all outputs {all_outputs * 1000:.1f} ms, "
+            f"embedding only {embedding_only * 1000:.1f} ms "
+            f"({100 * (all_outputs - embedding_only) / all_outputs:.1f}% saved)"
+        )
+
+        # explicit softmax attention vs F.scaled_dot_product_attention in WindowAttention
+        results = {}
+        for fused in [False, True]:
+            set_fused_attn(model, fused)
+            with torch.no_grad():
+                embedding = model(batch, device="cpu", outputs=("embedding",))["embedding"]
+            results[fused] = (
+                time_forward(model, batch, args.runs, outputs=("embedding",)),
+                allocated_mb(model, batch, outputs=("embedding",)),
+                embedding,
+            )
+        print(
+            f"{amodel} batch {args.batch_size}: explicit attention {results[False][0] * 1000:.1f} ms "
+            f"{results[False][1]:.0f} MB, fused attention {results[True][0] * 1000:.1f} ms {results[True][1]:.0f} MB, "
+            f"max abs embedding difference {(results[False][2] - results[True][2]).abs().max().item():.2e}"
+        )
+
+        # reshape_wav2img against bicubic F.interpolate, for the 1-channel and the 4-channel fusion input
+        frames = audio_cfg.clip_samples // audio_cfg.hop_size + 1
+        for channels in [1, 4]:
+            mel = torch.randn(args.batch_size, channels, frames, audio_cfg.mel_bins)
+            with torch.no_grad():
+                diff = (model.reshape_wav2img(mel) - interpolate_wav2img(model, mel)).abs().max().item()
+                reference = time_fn(interpolate_wav2img, args.runs, model, mel)
+                precomputed = time_fn(model.reshape_wav2img, args.runs, mel)
+            print(
+                f"{amodel} reshape_wav2img {tuple(mel.shape)}: interpolate {reference * 1000:.2f} ms, "
+                f"precomputed {precomputed * 1000:.2f} ms, max abs difference {diff:.2e}"
+            )
@@ -0,0 +1,64 @@
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+from laion_clap.index import IVFPQIndex, recall_at_k
+
+
+def clustered_embeddings(n, dim, num_clusters=1000, spread=0.3, seed=0):
+    """Normalized random embeddings around `num_clusters` centers, a stand-in for real audio embeddings."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(num_clusters, size=n)] + spread * rng.standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def exact_search(queries, embeddings, k, chunk_size=262144):
+    queries = torch.from_numpy(queries)
+    scores, ids = None, None
+    for i in range(0, len(embeddings), chunk_size):
+        chunk_scores = queries @ torch.from_numpy(np.asarray(embeddings[i:i + chunk_size], dtype=np.float32)).t()
+        chunk_ids = torch.arange(i, i + chunk_scores.shape[1]).expand_as(chunk_scores)
+        if scores is not None:
+            chunk_scores, chunk_ids = torch.cat([scores, chunk_scores], 1), torch.cat([ids, chunk_ids], 1)
+        scores, top = chunk_scores.topk(k, dim=1)
+        ids = chunk_ids.gather(1, top)
+    return ids.numpy()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query latency and recall@k of IVFPQIndex versus exact search.")
+    parser.add_argument("--embeddings", type=str, default=None,
+                        help="(N, 512) .npy of audio embeddings, clustered random embeddings if not set.")
+    parser.add_argument("--num-rows", type=int, default=1000000)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--nlist", type=int, default=4096)
+    parser.add_argument("--pq-m", type=int, default=64, help="0 for float16 rows without PQ.")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.embeddings is not None:
+        embeddings = np.load(args.embeddings, mmap_mode="r")
+    else:
+        embeddings = clustered_embeddings(args.num_rows, 512)
+    # corpus rows perturbed a little serve as queries
+    queries = np.asarray(embeddings[:args.num_queries], dtype=np.float32)
+    queries = queries + 0.05 * np.random.default_rng(1).standard_normal(queries.shape).astype(np.float32)
+
+    start = time.time()
+    exact_ids = exact_search(queries, embeddings, args.k)
+    print(f"exact: {(time.time() - start) / args.num_queries * 1000:.2f} ms/query over {len(embeddings)} rows")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.time()
+        index = IVFPQIndex.build(f"{tmp}/index", embeddings, nlist=args.nlist, pq_m=args.pq_m or None)
+        print(f"build: {time.time() - start:.1f} s")
+        for nprobe in args.nprobe:
+            index.search(queries[:4], args.k, nprobe)  # warm up
+            start = time.time()
+            _, ids = index.search(queries, args.k, nprobe)
+            latency = (time.time() - start) / args.num_queries * 1000
+            print(f"nprobe {nprobe:>4}: {latency:.2f} ms/query, recall@{args.k} {recall_at_k(ids, exact_ids):.3f}")
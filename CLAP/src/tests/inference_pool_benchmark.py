@@ -0,0 +1,46 @@
+import argparse
+import time
+
+import numpy as np
+import psutil
+import laion_clap
+
+
+def pool_memory_mb(pool):
+    """Private (unique) memory of the workers and the proportional size of the memory they share."""
+    private, shared = 0, 0
+    for worker in pool.workers:
+        info = psutil.Process(worker.pid).memory_full_info()
+        private += info.uss
+        shared += info.pss - info.uss
+    return private / 1024 ** 2, shared / 1024 ** 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audio embedding throughput of CLAPInferencePool per worker count.")
+    parser.add_argument("--ckpt", type=str, default=None)
+    parser.add_argument("--amodel", type=str, default="HTSAT-tiny")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--num-clips", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=4)
+    args = parser.parse_args()
+
+    model = laion_clap.CLAP_Module(enable_fusion=False, device="cpu", amodel=args.amodel, modalities={"audio"})
+    if args.ckpt is not None:
+        model.load_ckpt(args.ckpt, verbose=False)
+    clips = np.random.uniform(-0.5, 0.5, (args.num_clips, 480000)).astype(np.float32)
+
+    base = None
+    for num_workers in args.workers:
+        with laion_clap.CLAPInferencePool(model, num_workers, args.threads_per_worker) as pool:
+            pool.get_audio_embedding_from_data(clips[:num_workers * args.batch_size], args.batch_size)  # warm up
+            start = time.time()
+            pool.get_audio_embedding_from_data(clips, args.batch_size)
+            throughput = args.num_clips / (time.time() - start)
+            private, shared = pool_memory_mb(pool)
+        base = base or throughput / num_workers
+        print(
+            f"workers {num_workers:>3}: {throughput:.1f} clips/sec ({throughput / base:.2f}x one worker), "
+            f"private {private:.0f} MB, shared {shared:.0f} MB in total"
+        )
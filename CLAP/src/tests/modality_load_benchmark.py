@@ -0,0 +1,43 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+
+def load(ckpt, amodel, modalities):
+    import laion_clap
+    start = time.time()
+    model = laion_clap.CLAP_Module(enable_fusion=False, device="cpu", amodel=amodel, modalities=modalities)
+    model.load_ckpt(ckpt, verbose=False)
+    return {
+        "load_sec": time.time() - start,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load time and peak RSS of CLAP_Module per set of modalities.")
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--amodel", type=str, default="HTSAT-tiny")
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        modalities = json.loads(args.child)
+        print(json.dumps(load(args.ckpt, args.amodel, set(modalities) if modalities else None)))
+        sys.exit()
+
+    # every setting runs in a fresh process, so its peak RSS is not hidden by the previous ones
+    for modalities in [None, ["audio"], ["text"]]:
+        output = subprocess.run(
+            [sys.executable, __file__, "--ckpt", args.ckpt, "--amodel", args.amodel, "--child", json.dumps(modalities)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{'+'.join(modalities) if modalities else 'audio+text':>10}: load {result['load_sec']:.1f} s, "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
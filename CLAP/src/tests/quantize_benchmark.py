@@ -0,0 +1,70 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import laion_clap
+
+
+def retrieval_metrics(audio_embed, text_embed):
+    """Text-to-audio R@1/5/10 and mAP@10, the i-th caption describes the i-th clip."""
+    ranking = torch.argsort(text_embed @ audio_embed.t(), descending=True)
+    preds = torch.where(ranking == torch.arange(len(text_embed)).view(-1, 1))[1].numpy()
+    metrics = {f"R@{k}": np.mean(preds < k) for k in [1, 5, 10]}
+    metrics["mAP@10"] = np.mean(np.where(preds < 10, 1 / (preds + 1), 0.0))
+    return metrics
+
+
+def embed(model, audio_files, captions, batch_size):
+    audio_embed, text_embed = [], []
+    start = time.time()
+    with torch.no_grad():
+        for i in range(0, len(audio_files), batch_size):
+            audio_embed.append(model.get_audio_embedding_from_filelist(audio_files[i:i + batch_size], use_tensor=True))
+        audio_time = time.time() - start
+        start = time.time()
+        for i in range(0, len(captions), batch_size):
+            text_embed.append(model.get_text_embedding(captions[i:i + batch_size], use_tensor=True))
+        text_time = time.time() - start
+    return torch.cat(audio_embed), torch.cat(text_embed), audio_time, text_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and CPU throughput of quantize='int8' against fp32.")
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--amodel", type=str, default="HTSAT-tiny")
+    parser.add_argument("--heldout", type=str, required=True,
+                        help='JSON list of {"audio": <file path>, "caption": <text>} pairs.')
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    with open(args.heldout) as f:
+        heldout = json.load(f)
+    audio_files = [item["audio"] for item in heldout]
+    captions = [item["caption"] for item in heldout]
+
+    results = {}
+    for quantize in [None, "int8"]:
+        model = laion_clap.CLAP_Module(enable_fusion=False, device="cpu", amodel=args.amodel, quantize=quantize)
+        model.load_ckpt(args.ckpt, verbose=False)
+        results[quantize] = embed(model, audio_files, captions, args.batch_size)
+
+    for i, modality in enumerate(["audio", "text"]):
+        cosine = F.cosine_similarity(results[None][i], results["int8"][i], dim=-1)
+        speedup = results[None][i + 2] / results["int8"][i + 2]
+        print(
+            f"{modality}: cosine to fp32 mean {cosine.mean().item():.4f} min {cosine.min().item():.4f}, "
+            f"{len(heldout) / results['int8'][i + 2]:.1f} items/sec ({speedup:.2f}x fp32)"
+        )
+    fp32_metrics = retrieval_metrics(results[None][0], results[None][1])
+    int8_metrics = retrieval_metrics(results["int8"][0], results["int8"][1])
+    for name in fp32_metrics:
+        print(
+            f"text-to-audio {name}: fp32 {fp32_metrics[name]:.4f}, int8 {int8_metrics[name]:.4f} "
+            f"({int8_metrics[name] - fp32_metrics[name]:+.4f})"
+        )
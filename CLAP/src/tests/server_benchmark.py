@@ -0,0 +1,52 @@
+import argparse
+import asyncio
+import time
+
+import aiohttp
+import numpy as np
+
+
+async def client(session, url, kind, num_requests, latencies):
+    rng = np.random.default_rng()
+    for _ in range(num_requests):
+        start = time.monotonic()
+        if kind == "text":
+            request = session.post(f"{url}/embed/text", json={"texts": ["a bird singing in the rain"]})
+        else:
+            clip = rng.uniform(-0.5, 0.5, 480000).astype(np.float32)
+            request = session.post(f"{url}/embed/audio", data=clip.tobytes(),
+                                   headers={"Content-Type": "application/octet-stream"})
+        async with request as response:
+            response.raise_for_status()
+            await response.read()
+        latencies.append(time.monotonic() - start)
+
+
+async def run(url, kind, concurrency, num_requests):
+    latencies = []
+    async with aiohttp.ClientSession() as session:
+        start = time.monotonic()
+        await asyncio.gather(*[client(session, url, kind, num_requests, latencies) for _ in range(concurrency)])
+        elapsed = time.monotonic() - start
+        async with session.get(f"{url}/metrics") as response:
+            metrics = (await response.json())[kind]
+    latencies = np.array(latencies) * 1000
+    print(
+        f"{kind} x {concurrency:>3} clients: {len(latencies) / elapsed:.1f} req/sec, "
+        f"p50 {np.percentile(latencies, 50):.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms, "
+        f"server batch fill {metrics['batch_fill']:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load a running laion_clap.server with concurrent single-item requests."
+    )
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080")
+    parser.add_argument("--kind", type=str, default="text", choices=["text", "audio"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--requests-per-client", type=int, default=20)
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        asyncio.run(run(args.url, args.kind, concurrency, args.requests_per_client))
@@ -0,0 +1,72 @@
+import argparse
+import multiprocessing as mp
+import tempfile
+import time
+
+import numpy as np
+from laion_clap.store import EmbeddingStore
+
+
+def append_worker(path, worker, num_batches, batch_size, dim):
+    store = EmbeddingStore(path)
+    rng = np.random.default_rng(worker)
+    for b in range(num_batches):
+        # the first value of every row encodes its writer, checked against the metadata afterwards
+        embeddings = rng.standard_normal((batch_size, dim)).astype(np.float32)
+        embeddings[:, 0] = worker
+        store.append(embeddings, {
+            "path": [f"worker{worker}/clip{b}_{i}.wav" for i in range(batch_size)],
+            "source": f"worker{worker}",
+            "offset": np.arange(batch_size, dtype=np.float32) * 10,
+        })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append, random access and scan speed of EmbeddingStore.")
+    parser.add_argument("--num-rows", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--dtype", type=str, default="float16", choices=["float16", "float32"])
+    parser.add_argument("--shard-rows", type=int, default=1 << 18)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--writers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EmbeddingStore.create(f"{tmp}/store", args.dim, args.dtype, args.shard_rows)
+        num_batches = args.num_rows // (args.writers * args.batch_size)
+        start = time.time()
+        workers = [
+            mp.Process(target=append_worker, args=(store.path, w, num_batches, args.batch_size, args.dim))
+            for w in range(args.writers)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+        store.refresh()
+        print(f"append: {len(store) / elapsed:.0f} rows/sec from {args.writers} processes, {len(store)} rows")
+
+        sources = store.column("source")
+        writers = np.array([s.replace("worker", "") for s in sources], dtype=np.float32)
+        consistent = all(
+            np.array_equal(np.asarray(part[:, 0], dtype=np.float32), writers[first:first + len(part)])
+            for first, part in store.chunks()
+        )
+        print(f"rows consistent with their metadata: {consistent}")
+
+        rows = np.random.default_rng(0).integers(len(store), size=10000)
+        start = time.time()
+        for row in rows:
+            store[row]
+        print(f"random row: {(time.time() - start) / len(rows) * 1e6:.1f} us")
+        start = time.time()
+        store.take(rows)
+        print(f"take of {len(rows)} random rows: {(time.time() - start) * 1000:.1f} ms")
+
+        query = np.random.default_rng(1).standard_normal(args.dim).astype(np.float32)
+        start = time.time()
+        for _, part in store.chunks(65536):
+            part.astype(np.float32) @ query
+        elapsed = time.time() - start
+        print(f"scan: {len(store) / elapsed / 1e6:.1f} M rows/sec")
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import torch
+import laion_clap
+from laion_clap.clap_module.checkpoint import convert_checkpoint, load_mmap_state_dict
+from laion_clap.clap_module.factory import load_state_dict
+
+pytest.importorskip("safetensors")
+
+
+@pytest.fixture(scope="module")
+def source():
+    torch.manual_seed(0)
+    return laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+
+
+@pytest.fixture(scope="module")
+def checkpoints(source, tmp_path_factory):
+    """A training checkpoint with optimizer state and its safetensors conversion."""
+    tmp = tmp_path_factory.mktemp("ckpt")
+    state_dict = {f"module.{k}": v for k, v in source.model.state_dict().items()}
+    torch.save({"state_dict": state_dict, "optimizer": {"state": {0: torch.randn(1000)}}, "epoch": 3}, tmp / "train.pt")
+    convert_checkpoint(str(tmp / "train.pt"), str(tmp / "model.safetensors"))
+    return str(tmp / "train.pt"), str(tmp / "model.safetensors")
+
+
+def test_mmap_state_dict_matches_torch_load(checkpoints):
+    pt, safetensors = checkpoints
+    expected = load_state_dict(pt)
+    state_dict = load_mmap_state_dict(safetensors)
+    assert state_dict.keys() == expected.keys()
+    for k, v in expected.items():
+        assert state_dict[k].dtype == v.dtype
+        torch.testing.assert_close(state_dict[k], v, rtol=0, atol=0)
+
+
+def test_convert_checkpoint_by_modality(checkpoints, tmp_path):
+    pt, _ = checkpoints
+    convert_checkpoint(pt, str(tmp_path / "audio.safetensors"), modalities={"audio"})
+    state_dict = load_mmap_state_dict(str(tmp_path / "audio.safetensors"))
+    assert state_dict.keys() == load_state_dict(pt, modalities={"audio"}).keys()
+
+
+@pytest.mark.parametrize("mmap_weights", [False, True])
+def test_mmap_weights_match_the_pt_checkpoint(source, checkpoints, mmap_weights):
+    pt, safetensors = checkpoints
+    waveforms = (0.1 * np.random.default_rng(0).standard_normal((2, 480000))).astype(np.float32)
+    model = laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+    model.load_ckpt(safetensors, verbose=False, mmap_weights=mmap_weights)
+    reference = laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+    reference.load_ckpt(pt, verbose=False)
+    if mmap_weights:
+        assert not any(p.requires_grad for p in model.model.parameters())
+    with torch.no_grad():
+        np.testing.assert_array_equal(
+            model.get_audio_embedding_from_data(waveforms), reference.get_audio_embedding_from_data(waveforms)
+        )
+
+
+def test_mmap_weights_needs_safetensors(checkpoints):
+    pt, _ = checkpoints
+    model = laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+    with pytest.raises(ValueError, match="safetensors"):
+        model.load_ckpt(pt, verbose=False, mmap_weights=True)
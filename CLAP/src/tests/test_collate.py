@@ -0,0 +1,48 @@
+import torch
+from laion_clap.training.data import BatchBuffers, stack_into
+
+
+def samples(batch_size, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randn(4, 5, generator=generator) for _ in range(batch_size)]
+
+
+def test_stack_into_matches_torch_stack():
+    batch_buffers = BatchBuffers(depth=2)
+    for seed in range(5):
+        tensors = samples(3, seed)
+        torch.testing.assert_close(stack_into(tensors, batch_buffers, "waveform"), torch.stack(tensors))
+        batch_buffers.advance()
+    assert stack_into(samples(3, 0), None, "waveform").shape == (3, 4, 5)
+
+
+def test_buffers_are_reused_round_robin():
+    batch_buffers = BatchBuffers(depth=3)
+    storages = []
+    for seed in range(6):
+        storages.append(stack_into(samples(2, seed), batch_buffers, "mel").untyped_storage().data_ptr())
+        batch_buffers.advance()
+    # a ring of 3 buffers, the 4th batch reuses the storage of the 1st
+    assert len(set(storages[:3])) == 3
+    assert storages[3:] == storages[:3]
+
+
+def test_batch_stays_valid_until_the_ring_wraps():
+    batch_buffers = BatchBuffers(depth=2)
+    first = stack_into(samples(2, 0), batch_buffers, "mel")
+    batch_buffers.advance()
+    stack_into(samples(2, 1), batch_buffers, "mel")
+    torch.testing.assert_close(first, torch.stack(samples(2, 0)))
+
+
+def test_smaller_last_batch_and_new_shapes():
+    batch_buffers = BatchBuffers(depth=2)
+    stack_into(samples(4, 0), batch_buffers, "mel")
+    batch_buffers.advance()
+    # the last batch of an epoch is smaller, a view of the same buffers
+    last = stack_into(samples(3, 1), batch_buffers, "mel")
+    assert last.shape == (3, 4, 5)
+    torch.testing.assert_close(last, torch.stack(samples(3, 1)))
+    # another sample shape or dtype reallocates the ring
+    other = stack_into([torch.zeros(2, 2, dtype=torch.long)] * 4, batch_buffers, "mel")
+    assert other.dtype == torch.long and other.shape == (4, 2, 2)
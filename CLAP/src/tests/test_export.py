@@ -0,0 +1,33 @@
+import pytest
+import torch
+from laion_clap.clap_module.export import export_audio_embedding, load_exported
+from laion_clap.clap_module.factory import create_model
+
+
+@pytest.fixture(scope="module", params=["HTSAT-tiny", "PANN-14"])
+def model(request):
+    torch.manual_seed(0)
+    # the text branch is not exported, and would need a download
+    model, _ = create_model(request.param, "roberta", precision="fp32", device=torch.device("cpu"),
+                            modalities={"audio"})
+    return model.eval()
+
+
+@pytest.mark.parametrize("fmt", ["torchscript", "onnx"])
+def test_export_matches_get_audio_embedding(model, fmt, tmp_path):
+    if fmt == "onnx":
+        pytest.importorskip("onnxruntime")
+    paths = export_audio_embedding(model, str(tmp_path / "audio"), [fmt], batch_size=2)
+    exported = load_exported(paths[fmt])
+    # a batch size other than the traced one, the batch dimension is dynamic
+    waveform = torch.randn(3, model.audio_cfg.clip_samples).clamp(-1, 1)
+    with torch.no_grad():
+        expected = model.get_audio_embedding([{"waveform": w} for w in waveform])
+        torch.testing.assert_close(exported(waveform), expected, rtol=1e-4, atol=1e-4)
+
+
+def test_fusion_models_are_not_exported(tmp_path):
+    model, _ = create_model("HTSAT-tiny", "roberta", precision="fp32", device=torch.device("cpu"),
+                            enable_fusion=True, fusion_type="aff_2d", modalities={"audio"})
+    with pytest.raises(NotImplementedError):
+        export_audio_embedding(model.eval(), str(tmp_path / "audio"), ["torchscript"])
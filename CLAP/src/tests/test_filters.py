@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from laion_clap.filters import FilterIndex
+from laion_clap.store import EmbeddingStore
+
+COLUMNS = {"deployment": "str", "region": "str", "timestamp": "int64", "duration": "float32"}
+INDEXED = ["deployment", "timestamp", "duration"]
+
+
+def append_rows(store, rng, n, deployments, with_duration=True):
+    embeddings = rng.standard_normal((n, store.dim)).astype(np.float32)
+    metadata = {
+        "deployment": rng.choice(deployments, size=n),
+        "region": rng.choice(["north", "south"], size=n),
+        "timestamp": rng.integers(0, 1000, size=n),
+    }
+    if with_duration:
+        metadata["duration"] = rng.choice([5.0, 10.0, 30.0], size=n).astype(np.float32)
+    store.append(embeddings, metadata)
+
+
+@pytest.fixture(scope="module")
+def filter_index(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    store = EmbeddingStore.create(str(tmp_path_factory.mktemp("filters") / "store"), dim=16, columns=COLUMNS)
+    append_rows(store, rng, 300, ["a", "b", "c"])
+    # rows without a duration are stored as nan
+    append_rows(store, rng, 100, ["a", "b", "c"], with_duration=False)
+    filter_index = FilterIndex.build(store, INDEXED)
+    # rows appended after the build, with a deployment the build has not seen
+    append_rows(store, rng, 150, ["b", "d"])
+    append_rows(store, rng, 50, ["d"], with_duration=False)
+    return filter_index
+
+
+def expected_mask(store, filters):
+    mask = np.ones(len(store), dtype=bool)
+    for name, predicate in filters.items():
+        values = store.column(name)
+        if store.columns[name] == "str":
+            mask &= np.isin(values, [predicate] if isinstance(predicate, str) else predicate)
+        elif isinstance(predicate, tuple):
+            low, high = predicate
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+        else:
+            mask &= values == predicate
+    return mask
+
+
+def post_filtered_search(store, queries, mask, k):
+    scores = queries @ store.read().astype(np.float32).T
+    scores[:, ~mask] = -np.inf
+    rows = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    top = np.take_along_axis(scores, rows, axis=1)
+    return top, np.where(np.isneginf(top), -1, rows)
+
+
+FILTERS = [
+    {"deployment": "a"},
+    {"deployment": "d"},  # only in rows appended after the build
+    {"deployment": ["c", "d", "unknown"]},
+    {"region": "north"},  # not indexed
+    {"timestamp": (100, 400)},
+    {"timestamp": (None, 50), "deployment": ["b", "d"]},
+    {"duration": (8.0, None)},  # nan (missing) durations never match
+    {"duration": (None, 10.0), "region": "south"},
+    {"duration": 30.0, "timestamp": (500, None)},
+    {"deployment": "unknown"},
+]
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_rows_match_the_column_values(filter_index, filters):
+    mask = expected_mask(filter_index.store, filters)
+    np.testing.assert_array_equal(filter_index.rows(filters), np.flatnonzero(mask))
+
+
+@pytest.mark.parametrize("filters", FILTERS + [None])
+# all blocks gathered, the default switch, all blocks scored whole
+@pytest.mark.parametrize("dense_ratio", [1.01, 0.25, 0.0])
+def test_search_matches_post_filtered_scan(filter_index, filters, dense_ratio):
+    store = filter_index.store
+    queries = np.random.default_rng(1).standard_normal((4, store.dim)).astype(np.float32)
+    k = 20
+    scores, rows = filter_index.search(queries, filters, k, chunk_rows=64, dense_ratio=dense_ratio)
+    mask = expected_mask(store, filters or {})
+    expected_scores, expected_rows = post_filtered_search(store, queries, mask, k)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-4, atol=1e-4)
+    np.testing.assert_array_equal(rows, expected_rows)
+    assert all(mask[rows[rows >= 0]])
+
+
+def test_unknown_column(filter_index):
+    with pytest.raises(ValueError):
+        filter_index.rows({"site": "x"})
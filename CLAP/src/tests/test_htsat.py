@@ -0,0 +1,155 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from laion_clap.clap_module.factory import get_model_config
+from laion_clap.clap_module.htsat import (
+    WindowAttention, bicubic_weights, create_htsat_model, window_partition, window_reverse
+)
+from laion_clap.clap_module.model import CLAPAudioCfp
+
+ALL_OUTPUTS = ("framewise_output", "clipwise_output", "fine_grained_embedding", "embedding")
+
+
+@pytest.fixture(scope="module")
+def audio_cfg():
+    return CLAPAudioCfp(**get_model_config("HTSAT-tiny")["audio_cfg"])
+
+
+@pytest.fixture(scope="module")
+def model(audio_cfg):
+    torch.manual_seed(0)
+    model = create_htsat_model(audio_cfg)
+    model.eval()
+    return model
+
+
+@pytest.fixture(scope="module")
+def batch(audio_cfg):
+    torch.manual_seed(1)
+    return {"waveform": torch.randn(2, audio_cfg.clip_samples)}
+
+
+def test_embedding_only_matches_full_forward(model, batch):
+    with torch.no_grad():
+        full = model(batch, device="cpu")
+        embedding_only = model(batch, device="cpu", outputs=("embedding",))
+    assert set(full) == set(ALL_OUTPUTS)
+    assert set(embedding_only) == {"embedding"}
+    torch.testing.assert_close(embedding_only["embedding"], full["embedding"])
+
+
+@pytest.mark.parametrize("outputs", [("clipwise_output",), ("framewise_output", "embedding"), ALL_OUTPUTS])
+def test_output_selection(model, batch, outputs):
+    with torch.no_grad():
+        full = model(batch, device="cpu")
+        selected = model(batch, device="cpu", outputs=outputs)
+    assert set(selected) == set(outputs)
+    for key in outputs:
+        torch.testing.assert_close(selected[key], full[key])
+
+
+def set_fused_attn(model, fused):
+    for m in model.modules():
+        if isinstance(m, WindowAttention):
+            m.fused_attn = fused
+
+
+def shift_mask(num_windows, N):
+    """A 0/-100 mask like SwinTransformerBlock.attn_mask, different for every window."""
+    return torch.where(torch.rand(num_windows, N, N) < 0.3, -100.0, 0.0)
+
+
+@pytest.mark.parametrize("masked", [False, True])
+@pytest.mark.parametrize("qk_scale", [None, 0.1])
+def test_fused_attention_matches_explicit(masked, qk_scale):
+    torch.manual_seed(0)
+    attention = WindowAttention(dim=64, window_size=(4, 4), num_heads=4, qk_scale=qk_scale).eval()
+    num_windows, batch_size, N = 3, 2, 16
+    x = torch.randn(batch_size * num_windows, N, 64)
+    mask = shift_mask(num_windows, N) if masked else None
+    with torch.no_grad():
+        attention.fused_attn = False
+        expected, attn = attention(x, mask=mask, return_attn=True)
+        attention.fused_attn = True
+        fused, no_attn = attention(x, mask=mask)
+    assert attn.shape == (batch_size * num_windows, 4, N, N)
+    assert no_attn is None
+    torch.testing.assert_close(fused, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_fused_attention_matches_explicit_in_the_model(model, batch):
+    with torch.no_grad():
+        set_fused_attn(model, False)
+        expected = model(batch, device="cpu", outputs=("embedding",))["embedding"]
+        set_fused_attn(model, True)
+        fused = model(batch, device="cpu", outputs=("embedding",))["embedding"]
+    torch.testing.assert_close(fused, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_relative_position_bias_cache_follows_the_table():
+    torch.manual_seed(0)
+    attention = WindowAttention(dim=32, window_size=(4, 4), num_heads=2).eval()
+    with torch.no_grad():
+        first = attention.get_relative_position_bias()
+        assert attention.get_relative_position_bias() is first
+        state = {k: torch.randn_like(v) if k == "relative_position_bias_table" else v
+                 for k, v in attention.state_dict().items()}
+        attention.load_state_dict(state)
+        updated = attention.get_relative_position_bias()
+    assert updated is not first
+    table = state["relative_position_bias_table"]
+    expected = table[attention.relative_position_index.view(-1)].view(16, 16, -1).permute(2, 0, 1)
+    torch.testing.assert_close(updated, expected)
+    # the bias is recomputed with autograd so that the table gets gradients
+    attention.train()
+    assert attention.get_relative_position_bias().requires_grad
+
+
+@pytest.mark.parametrize("in_size,out_size", [(1001, 1024), (64, 64), (7, 20), (2, 5)])
+def test_bicubic_weights_match_interpolate(in_size, out_size):
+    x = torch.randn(3, in_size, dtype=torch.float64)
+    expected = F.interpolate(x[None, None], (3, out_size), mode="bicubic", align_corners=True)[0, 0]
+    torch.testing.assert_close(x @ bicubic_weights(in_size, out_size).t(), expected)
+
+
+def interpolate_wav2img(model, x):
+    """The former F.interpolate + permute implementation of reshape_wav2img."""
+    target_T = int(model.spec_size * model.freq_ratio)
+    target_F = model.spec_size // model.freq_ratio
+    if x.shape[2] < target_T:
+        x = F.interpolate(x, (target_T, x.shape[3]), mode="bicubic", align_corners=True)
+    if x.shape[3] < target_F:
+        x = F.interpolate(x, (x.shape[2], target_F), mode="bicubic", align_corners=True)
+    x = x.permute(0, 1, 3, 2).contiguous()
+    x = x.reshape(x.shape[0], x.shape[1], x.shape[2], model.freq_ratio, x.shape[3] // model.freq_ratio)
+    x = x.permute(0, 1, 3, 2, 4).contiguous()
+    return x.reshape(x.shape[0], x.shape[1], x.shape[2] * x.shape[3], x.shape[4])
+
+
+# 1001 frames of a 10 s clip, the 4 channels of the fusion input, a full-length and a shorter mel
+@pytest.mark.parametrize("channels,frames,mel_bins", [(1, 1001, 64), (4, 1001, 64), (1, 1024, 64), (1, 900, 48)])
+def test_reshape_wav2img_matches_interpolate(model, channels, frames, mel_bins):
+    torch.manual_seed(0)
+    x = torch.randn(2, channels, frames, mel_bins)
+    with torch.no_grad():
+        expected = interpolate_wav2img(model, x)
+        out = model.reshape_wav2img(x)
+        # the cached operands give the same result on the next batch
+        torch.testing.assert_close(model.reshape_wav2img(x), out)
+    assert out.shape == expected.shape
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_reshape_wav2img_reads_non_contiguous_input(model):
+    torch.manual_seed(0)
+    # bn0 is applied between two transposes, so reshape_wav2img gets a non-contiguous tensor
+    x = torch.randn(2, 64, 1001, 1).transpose(1, 3)
+    assert not x.is_contiguous()
+    with torch.no_grad():
+        torch.testing.assert_close(model.reshape_wav2img(x), interpolate_wav2img(model, x), rtol=1e-4, atol=1e-5)
+
+
+def test_window_reverse_keeps_the_batch_dynamic_when_traced():
+    traced = torch.jit.trace(lambda windows: window_reverse(windows, 4, 8, 12), torch.randn(2 * 6, 4, 4, 3))
+    x = torch.randn(3, 8, 12, 3)
+    torch.testing.assert_close(traced(window_partition(x, 4)), x)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import torch
+from laion_clap.index import PQ_CENTROIDS, IVFPQIndex
+
+
+def normalized(n, dim=32, seed=0):
+    x = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def reference_scores(index, queries):
+    """Score of every (query, indexed row) as search computes it, and whether the row is in a probed list."""
+    queries = torch.from_numpy(queries)
+    coarse = queries @ index.centroids.t()
+    rows_scores, rows_ids, rows_lists = [], [], []
+    for segment in index.segments:
+        codes = torch.from_numpy(np.asarray(segment["codes"]))
+        lists = torch.repeat_interleave(torch.arange(index.nlist), torch.from_numpy(np.diff(segment["offsets"])))
+        if index.pq_m is None:
+            scores = queries @ codes.float().t()
+        else:
+            luts = torch.einsum("qmd,mkd->qmk", queries.view(len(queries), index.pq_m, -1), index.codebooks)
+            scores = luts.flatten(1)[:, codes.long() + torch.arange(index.pq_m) * PQ_CENTROIDS].sum(2)
+            scores += coarse[:, lists]
+        rows_scores.append(scores)
+        rows_ids.append(torch.from_numpy(np.asarray(segment["ids"])))
+        rows_lists.append(lists)
+    return torch.cat(rows_scores, 1), torch.cat(rows_ids), torch.cat(rows_lists), coarse
+
+
+def reference_search(index, queries, k, nprobe):
+    """Per query top-k over the rows of its probed lists."""
+    scores, ids, lists, coarse = reference_scores(index, queries)
+    probes = (coarse - 0.5 * (index.centroids ** 2).sum(1)).topk(min(nprobe, index.nlist), dim=1).indices
+    expected_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    expected_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for qi in range(len(queries)):
+        probed = torch.isin(lists, probes[qi])
+        top = scores[qi, probed].topk(min(k, int(probed.sum())))
+        expected_scores[qi, :len(top.values)] = top.values.numpy()
+        expected_ids[qi, :len(top.values)] = ids[probed][top.indices].numpy()
+    return expected_scores, expected_ids
+
+
+@pytest.mark.parametrize("pq_m", [None, 8])
+@pytest.mark.parametrize("batch_pairs", [1 << 22, 100])
+def test_batched_search_matches_per_query_search(tmp_path, pq_m, batch_pairs):
+    embeddings = normalized(3000)
+    index = IVFPQIndex.build(str(tmp_path / "index"), embeddings[:2000], nlist=16, pq_m=pq_m, niter=5)
+    # a second segment, whose lists are merged with the ones of the first
+    index.add(embeddings[2000:])
+    queries = normalized(20, seed=1)
+
+    scores, ids = index.search(queries, k=10, nprobe=4, batch_pairs=batch_pairs)
+    expected_scores, expected_ids = reference_search(index, queries, k=10, nprobe=4)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, atol=1e-5)
+    # ids may only differ between tied scores, each hit is found once with its own score
+    all_scores, all_ids, _, _ = reference_scores(index, queries)
+    for qi in range(len(queries)):
+        assert len(np.unique(ids[qi])) == len(ids[qi])
+        score_of = dict(zip(all_ids.tolist(), all_scores[qi].tolist()))
+        np.testing.assert_allclose([score_of[i] for i in ids[qi]], scores[qi], rtol=1e-5, atol=1e-5)
+
+
+def test_all_lists_without_pq_is_exact(tmp_path):
+    embeddings = normalized(500)
+    index = IVFPQIndex.build(str(tmp_path / "index"), embeddings, nlist=8, pq_m=None, niter=5)
+    queries = normalized(5, seed=1)
+    _, ids = index.search(queries, k=5, nprobe=8)
+    exact = np.argsort(-(queries @ embeddings.astype(np.float16).astype(np.float32).T), axis=1)[:, :5]
+    np.testing.assert_array_equal(ids, exact)
+
+
+def test_fewer_rows_than_k_are_padded(tmp_path):
+    index = IVFPQIndex.build(str(tmp_path / "index"), normalized(40), nlist=4, pq_m=None, niter=5)
+    scores, ids = index.search(normalized(3, seed=1), k=50, nprobe=1)
+    for qi in range(3):
+        found = ids[qi] >= 0
+        assert 0 < found.sum() < 50
+        assert np.all(found[:found.sum()]) and np.all(np.isneginf(scores[qi, ~found]))
+        assert np.all(np.diff(scores[qi, found]) <= 0)
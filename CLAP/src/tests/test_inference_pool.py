@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pytest
+import torch
+import laion_clap
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    model = laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+    model.eval()
+    return model
+
+
+def test_pool_matches_the_model(model):
+    waveforms = (0.1 * np.random.default_rng(0).standard_normal((5, 480000))).astype(np.float32)
+    with torch.no_grad():
+        expected = model.get_audio_embedding_from_data(waveforms)
+    with laion_clap.CLAPInferencePool(model, num_workers=2, pin_cores=False) as pool:
+        # 3 batches over 2 workers, returned in order
+        embeddings = pool.get_audio_embedding_from_data(waveforms, batch_size=2)
+    assert embeddings.shape == expected.shape
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_pool_shares_the_weights(model):
+    with laion_clap.CLAPInferencePool(model, num_workers=1, pin_cores=False):
+        assert all(p.is_shared() for p in model.model.parameters())
+
+
+def test_worker_errors_reach_the_caller(model):
+    with laion_clap.CLAPInferencePool(model, num_workers=1, pin_cores=False) as pool:
+        with pytest.raises(RuntimeError, match="without the text branch"):
+            pool.get_text_embedding(["a bird call"])
+        # the worker keeps serving after a failed task
+        assert pool.get_audio_embedding_from_data(np.zeros((1, 480000), dtype=np.float32)).shape == (1, 512)
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"), reason="core pinning is Linux only")
+def test_pinned_workers_stay_in_the_affinity_set(model):
+    waveforms = (0.1 * np.random.default_rng(0).standard_normal((3, 480000))).astype(np.float32)
+    with torch.no_grad():
+        expected = model.get_audio_embedding_from_data(waveforms)
+    allowed = os.sched_getaffinity(0)
+    with laion_clap.CLAPInferencePool(model, num_workers=2) as pool:
+        embeddings = pool.get_audio_embedding_from_data(waveforms, batch_size=2)
+        for worker in pool.workers:
+            assert os.sched_getaffinity(worker.pid) <= allowed
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_dead_worker_fails_the_pending_tasks(model):
+    with laion_clap.CLAPInferencePool(model, num_workers=1, pin_cores=False) as pool:
+        pool.workers[0].kill()
+        with pytest.raises(RuntimeError, match="exited"):
+            pool.get_audio_embedding_from_data(np.zeros((1, 480000), dtype=np.float32))
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+import laion_clap
+from laion_clap.clap_module.factory import load_state_dict
+
+
+@pytest.fixture(scope="module")
+def source():
+    torch.manual_seed(0)
+    return laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+
+
+@pytest.fixture(scope="module")
+def full_ckpt(source, tmp_path_factory):
+    """A checkpoint of both branches, as saved by training: the text tensors are stand-ins (roberta needs a download)."""
+    state_dict = {f"module.{k}": v for k, v in source.model.state_dict().items()}
+    state_dict["module.text_branch.embeddings.word_embeddings.weight"] = torch.randn(1000, 768)
+    state_dict["module.text_projection.0.weight"] = torch.randn(512, 768)
+    path = str(tmp_path_factory.mktemp("ckpt") / "full.pt")
+    torch.save({"state_dict": state_dict, "optimizer": {}, "epoch": 1}, path)
+    return path
+
+
+def test_audio_only_load_skips_the_text_branch(source, full_ckpt):
+    state_dict = load_state_dict(full_ckpt, modalities={"audio"})
+    assert not any(k.startswith(("text_branch.", "text_projection.")) for k in state_dict)
+    assert "logit_scale_t" in state_dict
+    expected = source.model.state_dict()
+    for k in expected:
+        torch.testing.assert_close(state_dict[k], expected[k])
+
+
+def test_audio_only_module_matches_the_source(source, full_ckpt):
+    waveforms = (0.1 * np.random.default_rng(0).standard_normal((2, 480000))).astype(np.float32)
+    model = laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+    model.load_ckpt(full_ckpt, verbose=False)
+    assert model.model.text_branch is None
+    with torch.no_grad():
+        np.testing.assert_allclose(
+            model.get_audio_embedding_from_data(waveforms), source.get_audio_embedding_from_data(waveforms)
+        )
+
+
+def test_missing_modality_raises_a_clear_error(source):
+    with pytest.raises(ValueError, match="without the text branch"):
+        source.get_text_embedding(["a bird call"])
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+import laion_clap
+
+
+@pytest.fixture(scope="module")
+def float_ckpt(tmp_path_factory):
+    """Randomly initialized weights of the audio branch, the text branch needs a download."""
+    torch.manual_seed(0)
+    model = laion_clap.CLAP_Module(device="cpu", modalities={"audio"})
+    path = str(tmp_path_factory.mktemp("ckpt") / "float.pt")
+    model.save_ckpt(path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def waveforms():
+    return (0.1 * np.random.default_rng(0).standard_normal((2, 480000))).astype(np.float32)
+
+
+def load(ckpt, quantize=None):
+    model = laion_clap.CLAP_Module(device="cpu", quantize=quantize, modalities={"audio"})
+    model.load_ckpt(ckpt, verbose=False)
+    return model
+
+
+def embed(model, waveforms):
+    with torch.no_grad():
+        return model.get_audio_embedding_from_data(waveforms, use_tensor=False)
+
+
+def test_quantized_embeddings_stay_close_to_float(float_ckpt, waveforms):
+    expected = torch.from_numpy(embed(load(float_ckpt), waveforms))
+    quantized = load(float_ckpt, quantize="int8")
+    linear_types = {type(m) for m in quantized.model.audio_branch.layers.modules() if "Linear" in type(m).__name__}
+    assert linear_types == {torch.ao.nn.quantized.dynamic.Linear}
+    # the patch embedding stays in float
+    assert isinstance(quantized.model.audio_branch.patch_embed.proj, torch.nn.Conv2d)
+    cosine = F.cosine_similarity(torch.from_numpy(embed(quantized, waveforms)), expected, dim=-1)
+    assert cosine.min().item() > 0.95
+
+
+def test_quantized_checkpoint_round_trip(float_ckpt, waveforms, tmp_path):
+    quantized = load(float_ckpt, quantize="int8")
+    path = str(tmp_path / "int8.pt")
+    quantized.save_ckpt(path)
+    assert os.path.getsize(path) < os.path.getsize(float_ckpt)
+    np.testing.assert_array_equal(embed(load(path, quantize="int8"), waveforms), embed(quantized, waveforms))
+    with pytest.raises(ValueError, match="quantized"):
+        load(path)
+
+
+def test_quantize_needs_cpu():
+    with pytest.raises(ValueError):
+        laion_clap.CLAP_Module(device="cuda:0", quantize="int8", modalities={"audio"})
+    with pytest.raises(ValueError):
+        laion_clap.CLAP_Module(device="cpu", quantize="int4", modalities={"audio"})
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from laion_clap.clap_module import topk_search
+
+
+def random_problem(num_queries=50, corpus_size=1000, dim=32, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    corpus = F.normalize(torch.randn(corpus_size, dim, generator=generator), dim=-1)
+    targets = torch.randint(corpus_size, (num_queries,), generator=generator)
+    queries = F.normalize(corpus[targets] + 0.5 * torch.randn(num_queries, dim, generator=generator), dim=-1)
+    return queries, corpus, targets
+
+
+def argsort_ranks(queries, corpus, targets):
+    """The former ranking of the evaluators: a full argsort of the dense similarity matrix."""
+    ranking = torch.argsort(queries @ corpus.t(), descending=True)
+    return torch.where(ranking == targets.view(-1, 1))[1]
+
+
+# one chunk, and chunks of 64 and 7 rows holding the targets of different queries
+@pytest.mark.parametrize("chunk_size", [1000, 64, 7])
+def test_ranks_and_top_k_match_argsort(chunk_size):
+    queries, corpus, targets = random_problem()
+    result = topk_search(queries, corpus, k=10, chunk_size=chunk_size, targets=targets)
+    torch.testing.assert_close(result.ranks, argsort_ranks(queries, corpus, targets))
+    expected = (queries @ corpus.t()).topk(10, dim=1)
+    torch.testing.assert_close(result.scores, expected.values)
+    torch.testing.assert_close(result.indices, expected.indices)
+
+
+@pytest.mark.parametrize("k", [0, None])
+def test_ranks_only(k):
+    queries, corpus, targets = random_problem()
+    result = topk_search(queries, corpus, k=k, chunk_size=64, targets=targets)
+    torch.testing.assert_close(result.ranks, argsort_ranks(queries, corpus, targets))
+    assert result.scores.shape == (len(queries), 0) and result.indices.shape == (len(queries), 0)
+
+
+def test_fewer_rows_than_k_are_padded():
+    queries, corpus, targets = random_problem(corpus_size=5)
+    result = topk_search(queries, corpus, k=8, chunk_size=2, targets=targets)
+    expected = (queries @ corpus.t()).topk(5, dim=1)
+    torch.testing.assert_close(result.scores[:, :5], expected.values)
+    torch.testing.assert_close(result.indices[:, :5], expected.indices)
+    assert torch.isneginf(result.scores[:, 5:]).all()
+    assert (result.indices[:, 5:] == -1).all()
+    torch.testing.assert_close(result.ranks, argsort_ranks(queries, corpus, targets))
+
+
+def test_numpy_inputs():
+    queries, corpus, targets = random_problem()
+    result = topk_search(queries.numpy(), corpus.numpy(), k=10, chunk_size=64, targets=targets.numpy())
+    torch.testing.assert_close(result.ranks, argsort_ranks(queries, corpus, targets))
+    assert result.indices.device.type == "cpu"
+
+
+def test_no_targets():
+    queries, corpus, _ = random_problem()
+    assert topk_search(queries, corpus, k=3, chunk_size=64).ranks is None
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a second device")
+@pytest.mark.parametrize("queries_device,corpus_device", [("cuda", "cpu"), ("cpu", "cuda")])
+def test_corpus_on_another_device(queries_device, corpus_device):
+    queries, corpus, targets = random_problem()
+    expected = argsort_ranks(queries, corpus, targets)
+    result = topk_search(queries.to(queries_device), corpus.to(corpus_device), k=10, chunk_size=64, targets=targets)
+    # the search runs on the device of the queries
+    assert result.ranks.device.type == queries_device
+    torch.testing.assert_close(result.ranks.cpu(), expected)
+    torch.testing.assert_close(result.indices.cpu(), (queries @ corpus.t()).topk(10, dim=1).indices)
@@ -0,0 +1,66 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("aiohttp")
+from aiohttp.test_utils import TestClient, TestServer
+from laion_clap.server import EmbeddingService
+
+
+class FakeModel:
+    """Embeds a text as (its length, ckpt id) and a clip as (its sum, ckpt id)."""
+
+    def __init__(self, ckpt_id):
+        self.ckpt_id = ckpt_id
+
+    def get_text_embedding(self, x, use_tensor=False):
+        return np.array([[len(t), self.ckpt_id] for t in x], dtype=np.float32)
+
+    def get_audio_embedding_from_data(self, x, use_tensor=False):
+        return np.array([[w.sum(), self.ckpt_id] for w in x], dtype=np.float32)
+
+
+class FakeService(EmbeddingService):
+    def load_model(self, ckpt):
+        return FakeModel(0 if ckpt is None else int(ckpt))
+
+
+def test_service_created_outside_of_the_event_loop():
+    # the queues and the lock must bind to the loop of the app, not to the one current at construction
+    service = FakeService({}, max_batch_size=4, max_wait_ms=50)
+
+    async def run():
+        async with TestClient(TestServer(service.app())) as client:
+            responses = await asyncio.gather(*[
+                client.post("/embed/text", json={"texts": ["a" * i]}) for i in range(1, 9)
+            ])
+            lengths = [(await r.json())["embeddings"][0][0] for r in responses]
+            assert lengths == list(range(1, 9))
+
+            response = await client.post("/embed/audio", data=np.ones(480, dtype=np.float32).tobytes(),
+                                         headers={"Content-Type": "application/octet-stream"})
+            assert (await response.json())["embedding"] == [480, 0]
+
+            response = await client.post("/admin/checkpoint", json={"ckpt": "7"})
+            assert response.status == 200
+            response = await client.post("/embed/text", json={"texts": ["abc"]})
+            assert (await response.json())["embeddings"] == [[3, 7]]
+
+            metrics = await (await client.get("/metrics")).json()
+            assert metrics["ckpt"] == "7"
+            assert sum(service.batchers["text"].batch_sizes) == 9
+            assert max(service.batchers["text"].batch_sizes) <= 4
+
+    asyncio.run(run())
+
+
+def test_bad_requests():
+    service = FakeService({})
+
+    async def run():
+        async with TestClient(TestServer(service.app())) as client:
+            assert (await client.post("/embed/text", json={"texts": "not a list"})).status == 400
+            assert (await client.post("/embed/audio", json={"waveform": []})).status == 400
+
+    asyncio.run(run())
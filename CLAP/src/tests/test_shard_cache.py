@@ -0,0 +1,187 @@
+import io
+import multiprocessing as mp
+import os
+import tarfile
+
+import pytest
+from laion_clap.training.shard_cache import ShardCache, _TeeStream, cached_tarfile_samples
+
+
+def make_shard(path, num_samples=3, payload_size=1000):
+    """A webdataset shard of `num_samples` samples with a .txt and a .bin member each."""
+    with tarfile.open(path, "w") as tar:
+        for i in range(num_samples):
+            for ext, data in [("txt", f"sample {i}".encode()), ("bin", os.urandom(payload_size))]:
+                info = tarfile.TarInfo(f"{i:06d}.{ext}")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """A local directory standing in for S3, its shards are read through `pipe:cat` like `pipe:aws s3 cp`."""
+    remote_dir = tmp_path / "remote"
+    remote_dir.mkdir()
+    return remote_dir
+
+
+def url_of(path):
+    return f"pipe:cat {path}"
+
+
+def read_samples(cache, url):
+    return [(s["__key__"], s["txt"], s["bin"]) for s in cached_tarfile_samples([{"url": url}], cache)]
+
+
+def cached_shards(cache):
+    return sorted(name for name in os.listdir(cache.cache_dir) if name.endswith(".tar"))
+
+
+def leftover_tmp_files(cache):
+    return [name for name in os.listdir(cache.cache_dir) if ".tmp-" in name]
+
+
+def test_miss_tees_the_shard_then_hits(tmp_path, remote):
+    shard = make_shard(remote / "0.tar")
+    cache = ShardCache(tmp_path / "cache", max_bytes=1 << 30)
+
+    first = read_samples(cache, url_of(shard))
+    assert len(first) == 3
+    assert len(cached_shards(cache)) == 1
+    with open(shard, "rb") as f, open(cache._path(url_of(shard)), "rb") as g:
+        assert f.read() == g.read()
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"]) == (1, 0)
+    assert stats["miss_bytes"] == os.path.getsize(shard)
+
+    # the remote copy is gone, the samples now come from the cache
+    os.remove(shard)
+    assert read_samples(cache, url_of(shard)) == first
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"]) == (1, 1)
+    assert cache.stats_since_last_call()["hits"] == 1
+    assert cache.stats_since_last_call()["hits"] == 0
+
+
+def test_local_paths_are_not_cached(tmp_path, remote):
+    shard = make_shard(remote / "0.tar")
+    cache = ShardCache(tmp_path / "cache", max_bytes=1 << 30)
+    assert len(read_samples(cache, str(shard))) == 3
+    assert cached_shards(cache) == []
+
+
+def test_lru_eviction_by_bytes(tmp_path, remote):
+    shards = [make_shard(remote / f"{i}.tar") for i in range(3)]
+    shard_bytes = os.path.getsize(shards[0])
+    cache = ShardCache(tmp_path / "cache", max_bytes=int(2.5 * shard_bytes))
+
+    read_samples(cache, url_of(shards[0]))
+    read_samples(cache, url_of(shards[1]))
+    os.utime(cache._path(url_of(shards[0])), (100, 100))
+    os.utime(cache._path(url_of(shards[1])), (200, 200))
+    # a hit makes shard 0 the most recently used, so shard 1 is evicted to make room for shard 2
+    read_samples(cache, url_of(shards[0]))
+    read_samples(cache, url_of(shards[2]))
+
+    assert os.path.exists(cache._path(url_of(shards[0])))
+    assert not os.path.exists(cache._path(url_of(shards[1])))
+    assert os.path.exists(cache._path(url_of(shards[2])))
+    assert cache.size() <= cache.max_bytes
+    stats = cache.stats()
+    assert (stats["evictions"], stats["evicted_bytes"]) == (1, shard_bytes)
+
+
+def test_interrupted_stream_leaves_no_entry(tmp_path, remote):
+    shard = make_shard(remote / "0.tar", num_samples=20, payload_size=100000)
+    cache = ShardCache(tmp_path / "cache", max_bytes=1 << 30)
+
+    # the pipeline stops after the first sample, e.g. at the end of an epoch
+    samples = cached_tarfile_samples([{"url": url_of(shard)}], cache)
+    next(samples)
+    samples.close()
+    assert cached_shards(cache) == []
+    assert leftover_tmp_files(cache) == []
+
+    # a partially read stream is never published, an aborted one is discarded
+    tee = cache.open(url_of(shard))
+    assert isinstance(tee, _TeeStream)
+    tee.read(1024)
+    assert not os.path.exists(cache._path(url_of(shard)))
+    tee.abort()
+    tee.lock_file.close()
+    assert cached_shards(cache) == []
+    assert leftover_tmp_files(cache) == []
+
+    # the shard is cached in full by the next complete read
+    assert len(read_samples(cache, url_of(shard))) == 20
+    with open(shard, "rb") as f, open(cache._path(url_of(shard)), "rb") as g:
+        assert f.read() == g.read()
+
+
+def test_failed_download_leaves_no_entry(tmp_path, remote):
+    cache = ShardCache(tmp_path / "cache", max_bytes=1 << 30)
+    with pytest.raises(Exception):
+        read_samples(cache, url_of(remote / "missing.tar"))
+    assert cached_shards(cache) == []
+    assert leftover_tmp_files(cache) == []
+
+
+def _open_and_read(cache, url, results):
+    stream = cache.open(url)
+    results.put((isinstance(stream, _TeeStream), stream.read()))
+    stream.close()
+
+
+def _read_shard(cache, url, barrier, results):
+    barrier.wait()
+    results.put(read_samples(cache, url))
+
+
+def test_writer_lock_makes_other_processes_bypass(tmp_path, remote):
+    shard = make_shard(remote / "0.tar")
+    cache = ShardCache(tmp_path / "cache", max_bytes=1 << 30)
+
+    tee = cache.open(url_of(shard))
+    assert isinstance(tee, _TeeStream)
+    # while this process fills the entry, another one streams the shard remotely instead of waiting
+    results = mp.Queue()
+    other = mp.Process(target=_open_and_read, args=(cache, url_of(shard), results))
+    other.start()
+    is_tee, data = results.get(timeout=60)
+    other.join()
+    assert not is_tee
+    with open(shard, "rb") as f:
+        assert data == f.read()
+    assert cache.stats()["bypassed"] == 1
+
+    tee.close()
+    tee.lock_file.close()
+    assert len(cached_shards(cache)) == 1
+
+
+def test_processes_racing_for_one_shard(tmp_path, remote):
+    shard = make_shard(remote / "0.tar", num_samples=20, payload_size=100000)
+    cache = ShardCache(tmp_path / "cache", max_bytes=1 << 30)
+    num_processes = 4
+    barrier = mp.Barrier(num_processes)
+    results = mp.Queue()
+    processes = [
+        mp.Process(target=_read_shard, args=(cache, url_of(shard), barrier, results)) for _ in range(num_processes)
+    ]
+    for p in processes:
+        p.start()
+    outputs = [results.get(timeout=120) for _ in processes]
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    assert all(output == outputs[0] for output in outputs)
+    assert len(outputs[0]) == 20
+    assert len(cached_shards(cache)) == 1
+    assert leftover_tmp_files(cache) == []
+    with open(shard, "rb") as f, open(cache._path(url_of(shard)), "rb") as g:
+        assert f.read() == g.read()
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["misses"] + stats["hits"] + stats["bypassed"] == num_processes
@@ -0,0 +1,107 @@
+import multiprocessing as mp
+import os
+
+import numpy as np
+import pytest
+from laion_clap.store import EmbeddingStore
+
+BATCH_SIZE = 50
+
+
+@pytest.fixture
+def store(tmp_path):
+    return EmbeddingStore.create(str(tmp_path / "store"), dim=8, dtype="float32", shard_rows=64)
+
+
+def file_sizes(store):
+    return {
+        name: os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(store.path) for name in names
+    }
+
+
+def test_append_and_read(store):
+    embeddings = np.random.default_rng(0).standard_normal((100, 8)).astype(np.float32)
+    rows = store.append(embeddings[:70], {"path": [f"{i}.wav" for i in range(70)], "species": "owl"})
+    np.testing.assert_array_equal(rows, np.arange(70))
+    store.append(embeddings[70:], {"offset": np.arange(30, dtype=np.float32), "species": "wren"})
+
+    assert len(store) == 100
+    # rows 70 to 100 span two shards
+    np.testing.assert_array_equal(store.read(), embeddings)
+    np.testing.assert_array_equal(store.take([99, 3, 64]), embeddings[[99, 3, 64]])
+    np.testing.assert_array_equal(store[-1], embeddings[-1])
+    assert list(store.column("species")) == ["owl"] * 70 + ["wren"] * 30
+    assert store.column("path")[69] == "69.wav" and store.column("path")[70] == ""
+    assert np.isnan(store.column("offset")[:70]).all()
+    assert store.vocabulary("species") == ["owl", "wren"]
+    np.testing.assert_array_equal(store.codes("species", ["wren", "crow"]), [1, -1])
+
+    reopened = EmbeddingStore(store.path)
+    np.testing.assert_array_equal(reopened.read(), embeddings)
+    assert list(reopened.metadata([0, 99])["species"]) == ["owl", "wren"]
+
+
+@pytest.mark.parametrize("metadata", [
+    {"species": ["owl", "wren"], "path": None},
+    {"species": ["owl", "wren"], "path": ["a.wav"]},
+    {"species": ["owl", "wren"], "offset": ["start", "end"]},
+    {"species": ["owl", "wren"], "site": "x"},
+])
+def test_invalid_metadata_writes_nothing(store, metadata):
+    store.append(np.ones((3, 8)), {"species": "owl"})
+    before = file_sizes(store)
+    with pytest.raises(ValueError):
+        store.append(np.ones((2, 8)), metadata)
+    assert file_sizes(store) == before
+    store.refresh()
+    assert len(store) == 3 and store.vocabulary("species") == ["owl"]
+
+
+def append_worker(path, worker, num_batches):
+    store = EmbeddingStore(path)
+    for b in range(num_batches):
+        # the first value of every row encodes its writer and the second its batch
+        embeddings = np.zeros((BATCH_SIZE, 8), dtype=np.float32)
+        embeddings[:, 0] = worker
+        embeddings[:, 1] = b
+        store.append(embeddings, {
+            "path": [f"worker{worker}/{b}/{i}.wav" for i in range(BATCH_SIZE)],
+            "source": f"worker{worker}",
+            "offset": np.full(BATCH_SIZE, b, dtype=np.float32),
+        })
+
+
+def check_consistent(store):
+    """Every visible row was fully written: its embedding matches its metadata."""
+    embeddings = store.read()
+    sources = store.column("source")
+    paths = store.column("path")
+    offsets = store.column("offset")
+    for row in range(len(store)):
+        worker, batch = int(embeddings[row, 0]), int(embeddings[row, 1])
+        assert sources[row] == f"worker{worker}"
+        assert paths[row].startswith(f"worker{worker}/{batch}/")
+        assert offsets[row] == batch
+
+
+def test_concurrent_appends(store):
+    num_workers, num_batches = 4, 10
+    workers = [mp.Process(target=append_worker, args=(store.path, w, num_batches)) for w in range(num_workers)]
+    for w in workers:
+        w.start()
+    # meanwhile, a reader only ever sees whole batches of committed rows
+    while any(w.is_alive() for w in workers):
+        store.refresh()
+        assert len(store) % BATCH_SIZE == 0
+        check_consistent(store)
+    for w in workers:
+        w.join()
+        assert w.exitcode == 0
+
+    store.refresh()
+    assert len(store) == num_workers * num_batches * BATCH_SIZE
+    check_consistent(store)
+    paths = store.column("path")
+    assert len(set(paths)) == len(paths)
+    assert sorted(store.vocabulary("source")) == [f"worker{w}" for w in range(num_workers)]
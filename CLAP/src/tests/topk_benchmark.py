@@ -0,0 +1,42 @@
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+from laion_clap.clap_module import topk_search
+
+
+def argsort_ranks(queries, corpus, targets):
+    """The ranking of the evaluators before topk_search: a full argsort of the dense similarity matrix."""
+    ranking = torch.argsort(queries @ corpus.t(), descending=True)
+    return torch.where(ranking == targets.view(-1, 1))[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Target ranks and top-k: dense argsort versus topk_search.")
+    parser.add_argument("--num-queries", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--corpus-factor", type=int, default=5, help="Corpus size as a multiple of the queries.")
+    parser.add_argument("--chunk-size", type=int, default=16384)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for num_queries in args.num_queries:
+        corpus = F.normalize(torch.randn(num_queries * args.corpus_factor, 512), dim=-1)
+        targets = torch.randint(len(corpus), (num_queries,))
+        queries = F.normalize(corpus[targets] + 0.5 * torch.randn(num_queries, 512), dim=-1)
+
+        start = time.time()
+        expected = argsort_ranks(queries, corpus, targets)
+        dense = time.time() - start
+        start = time.time()
+        result = topk_search(queries, corpus, args.k, args.chunk_size, targets)
+        streamed = time.time() - start
+        dense_mb = num_queries * len(corpus) * (4 + 8) / 1024 ** 2
+        streamed_mb = num_queries * (args.k + args.chunk_size) * (4 + 8) / 1024 ** 2
+        print(
+            f"{num_queries} x {len(corpus)}: argsort {dense:.2f} s (~{dense_mb:.0f} MB), "
+            f"topk_search {streamed:.2f} s (~{streamed_mb:.0f} MB), {dense / streamed:.1f}x, "
+            f"same ranks {torch.equal(result.ranks, expected)}, "
+            f"same top-1 {torch.equal(result.indices[:, 0], torch.argmax(queries @ corpus.t(), dim=1))}"
+        )
@@ -9,6 +9,7 @@ import shutil
 import tarfile
 from typing import List
 from pydub import AudioSegment
+import soundfile as sf
 import numpy as np
 import pandas as pd
 import os
@@ -38,9 +39,10 @@ def make_sizes_json(sizes: dict, sizes_output_path: str):
     with open(sizes_output_path, 'w') as json_file:
         json.dump(sizes, json_file)
 
-# function to create a single shard
+# function to create a single shard, returns its size and the duration (s) of each clip in it
 def create_shard(df, output_tar_path, shard_id):
     size = 0
+    durations = []
     with tarfile.open(output_tar_path, "w") as tar:
         for index, row in df.iterrows():
             audio_path = row[AUDIO_PATH_COLUMN]
@@ -60,6 +62,9 @@ def create_shard(df, output_tar_path, shard_id):
                 if not os.path.isfile(audio_path):
                     
                     continue
+                # read before anything is added to the tar, an unreadable clip is skipped whole
+                # and sizes.json / durations.json always match the shard
+                duration = sf.info(audio_path).duration
                 
                 with open(f"{audio_id}.json", "w") as jsonfile:
                     jsonfile.write(json.dumps({"text": captions}))
@@ -70,13 +75,14 @@ def create_shard(df, output_tar_path, shard_id):
                 
                 tar.add(f"{audio_id}.json", arcname=f"{audio_id}.json")
                 tar.add(audio_path, arcname=f"{audio_id}.flac")
+                durations.append(duration)
                 
                 size += 1
                 os.remove(f"{audio_id}.json")
             except Exception as e:
                 print("exception", e)
                 continue
-    return size
+    return size, durations
 
 # function to convert CSV data to webdataset format
 def csv_to_webdataset(csv_path, output_path, max_files_per_shard=50000):
@@ -84,6 +90,7 @@ def csv_to_webdataset(csv_path, output_path, max_files_per_shard=50000):
     n_shards = (len(df) // max_files_per_shard) + (len(df) % max_files_per_shard != 0)
 
     sizes = {}
+    durations = {}
 
     # Create a process pool
     with multiprocessing.Pool() as pool:
@@ -100,9 +107,11 @@ def csv_to_webdataset(csv_path, output_path, max_files_per_shard=50000):
 
         # collect sizes
         for shard_id, result in enumerate(results):
-            sizes[f"{shard_id}.tar"] = result.get()
+            sizes[f"{shard_id}.tar"], durations[f"{shard_id}.tar"] = result.get()
 
     make_sizes_json(sizes, os.path.join(output_path, "sizes.json"))
+    # clip durations, used to count the samples of --crops-per-clip
+    make_sizes_json(durations, os.path.join(output_path, "durations.json"))
 
 # usage
 if __name__ == "__main__":